@@ -2,14 +2,16 @@
 Backend Flask para Inventario Ciego - Render Deploy
 Conecta a Azure PostgreSQL
 """
-from flask import Flask, request, jsonify, send_from_directory, send_file, render_template_string
+from flask import Flask, request, jsonify, send_from_directory, send_file, render_template_string, g, Response, stream_with_context, has_request_context
 from flask_cors import CORS
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool
-from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import RealDictCursor, execute_values
 import os, secrets, smtplib
+import gzip, hashlib, threading, time, zlib
+from collections import OrderedDict
 from decimal import Decimal
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from io import BytesIO
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -17,25 +19,204 @@ from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 
 from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+try:
+    import orjson as _orjson
+except ImportError:  # sin orjson se usa json de stdlib con el mismo formato
+    _orjson = None
+
+# Politica de serializacion para lo que los handlers devuelven sin convertir
+JSON_DECIMAL = os.environ.get('JSON_DECIMAL', 'float')  # 'float' | 'str'
+JSON_FECHAS = os.environ.get('JSON_FECHAS', 'http')     # 'http' (RFC 822, el de Flask) | 'iso' (2026-01-31T08:00:00)
+
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return str(obj) if JSON_DECIMAL == 'str' else float(obj)
+    if isinstance(obj, date):
+        return http_date(obj) if JSON_FECHAS == 'http' else obj.isoformat()
+    return DefaultJSONProvider.default(obj)
+
+
+_ORJSON_OPCIONES = 0
+if _orjson is not None:
+    _ORJSON_OPCIONES = _orjson.OPT_NON_STR_KEYS
+    if JSON_FECHAS == 'http':
+        _ORJSON_OPCIONES |= _orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON de la app: orjson si esta instalado, json de stdlib si no.
+    Decimal y fechas se resuelven en _json_default segun JSON_DECIMAL / JSON_FECHAS."""
+
+    def _opciones(self):
+        # Mismo orden de claves que el provider de Flask (sort_keys=True por defecto)
+        return _ORJSON_OPCIONES | (_orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+
+    def dumps(self, obj, **kwargs):
+        if _orjson is not None and not kwargs:
+            return _orjson.dumps(obj, default=_json_default, option=self._opciones()).decode('utf-8')
+        kwargs.setdefault('default', _json_default)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if _orjson is not None and not kwargs:
+            return _orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if _orjson is None or self._app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        cuerpo = _orjson.dumps(obj, default=_json_default,
+                               option=self._opciones() | _orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(cuerpo, mimetype=self.mimetype)
 
-class CustomJSONProvider(DefaultJSONProvider):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super().default(obj)
 
 app = Flask(__name__, static_folder='static')
-app.json_provider_class = CustomJSONProvider
-app.json = CustomJSONProvider(app)
-CORS(app, origins=['https://inventario-ciego-5bdr.onrender.com'])
+app.json_provider_class = FastJSONProvider
+app.json = FastJSONProvider(app)
+CORS_ORIGENES = ['https://inventario-ciego-5bdr.onrender.com']
+CORS(app, origins=CORS_ORIGENES)
 
 @app.after_request
 def add_no_cache_headers(response):
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    # Con ETag el navegador puede guardar la respuesta pero debe revalidarla siempre (If-None-Match)
+    if response.headers.get('ETag'):
+        response.headers['Cache-Control'] = 'no-cache'
+    else:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '0'
     return response
 
+
+# ==================== COMPRESION DE RESPUESTAS ====================
+# gzip / brotli segun Accept-Encoding. No se comprimen cuerpos chicos ni tipos ya
+# comprimidos (xlsx, imagenes). Si la respuesta sale de un cache del servidor el handler
+# llama _respuesta_cacheada(clave) y el cuerpo comprimido se guarda junto a esa clave.
+try:
+    import brotli as _brotli
+except ImportError:  # sin brotli solo se ofrece gzip
+    _brotli = None
+
+COMPRESION_MIN_BYTES = int(os.environ.get('COMPRESION_MIN_BYTES', '1024'))
+COMPRESION_CACHE_MAX = int(os.environ.get('COMPRESION_CACHE_MAX', '64'))  # entradas (clave, encoding)
+COMPRESION_TIPOS = ('text/', 'application/json', 'application/javascript', 'application/x-ndjson',
+                    'image/svg+xml')
+
+_compresion_cache = OrderedDict()
+_compresion_lock = threading.Lock()
+
+
+def _respuesta_cacheada(clave):
+    """Marca la respuesta del request como contenido de cache: `clave` debe cambiar cuando cambia el cuerpo"""
+    g._clave_compresion = clave
+
+
+def _elegir_encoding(soportados=('br', 'gzip'), cabecera=None):
+    """'br', 'gzip' o None segun Accept-Encoding (respeta q=0).
+    cabecera: el valor ya leido (modo ASGI); None lo toma del request de Flask."""
+    if cabecera is None:
+        cabecera = request.headers.get('Accept-Encoding', '')
+    aceptados = {}
+    for parte in cabecera.split(','):
+        nombre, _, params = parte.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if nombre:
+            aceptados[nombre.lower()] = q
+    if 'br' in soportados and _brotli is not None and aceptados.get('br', 0) > 0:
+        return 'br'
+    if 'gzip' in soportados and aceptados.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def _comprimir(datos, encoding, nivel_alto=False):
+    if encoding == 'br':
+        return _brotli.compress(datos, quality=9 if nivel_alto else 5)
+    return gzip.compress(datos, compresslevel=9 if nivel_alto else 6)
+
+
+def _clave_estatico():
+    """Archivos de static: la clave es ruta + mtime + tamaño"""
+    ruta = (request.view_args or {}).get('path') or (request.view_args or {}).get('filename')
+    if not ruta:
+        return None
+    try:
+        st = os.stat(os.path.join(app.static_folder, ruta))
+    except OSError:
+        return None
+    return ('static', ruta, st.st_mtime_ns, st.st_size)
+
+
+def _gzip_stream(chunks):
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = formato gzip
+    for chunk in chunks:
+        datos = comp.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        datos += comp.flush(zlib.Z_SYNC_FLUSH)
+        if datos:
+            yield datos
+    yield comp.flush()
+
+
+@app.after_request
+def _comprimir_respuesta(response):
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if not (response.mimetype or '').startswith(COMPRESION_TIPOS):
+        return response
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed and not response.direct_passthrough:
+        # Streaming (?stream=): gzip incremental, sin buffer ni Content-Length
+        if _elegir_encoding(('gzip',)) is None:
+            return response
+        response.response = _gzip_stream(response.response)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers.pop('Content-Length', None)
+        return response
+
+    encoding = _elegir_encoding()
+    if encoding is None:
+        return response
+
+    clave = getattr(g, '_clave_compresion', None)
+    if clave is None and response.direct_passthrough and request.endpoint in ('static', 'static_files'):
+        clave = _clave_estatico()
+    if response.direct_passthrough and clave is None:
+        return response
+
+    comprimido = None
+    if clave is not None:
+        with _compresion_lock:
+            comprimido = _compresion_cache.get((clave, encoding))
+            if comprimido is not None:
+                _compresion_cache.move_to_end((clave, encoding))
+    if comprimido is None:
+        response.direct_passthrough = False
+        datos = response.get_data()
+        if len(datos) < COMPRESION_MIN_BYTES:
+            return response
+        comprimido = _comprimir(datos, encoding, nivel_alto=clave is not None)
+        if clave is not None:
+            with _compresion_lock:
+                _compresion_cache[(clave, encoding)] = comprimido
+                while len(_compresion_cache) > COMPRESION_CACHE_MAX:
+                    _compresion_cache.popitem(last=False)
+    else:
+        response.direct_passthrough = False
+        response.close()
+
+    response.set_data(comprimido)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 # Configuracion de la base de datos Azure PostgreSQL
 DB_CONFIG = {
     'host': os.environ.get('DB_HOST', 'chiosburguer.postgres.database.azure.com'),
@@ -51,36 +232,363 @@ DB_CONFIG = {
     'connect_timeout': 10
 }
 
+# ==================== AUDITORIA SQL (deteccion N+1) ====================
+# Cuenta las sentencias ejecutadas por request agrupadas por SQL normalizado y
+# avisa cuando una misma sentencia se repite mas de SQL_REPETICIONES_MAX veces.
+#   - Desarrollo: SQL_AUDITORIA=1 -> log "[N+1] ..." y header X-SQL-Sentencias
+#   - Tests/benchmarks: `with contar_sql() as sql: client.get(...)` y luego
+#     `assert not sql.violaciones('listar_bajas')`. Como fixture de pytest:
+#         @pytest.fixture
+#         def sql():
+#             with app_module.contar_sql() as c:
+#                 yield c
+import re
+import threading
+
+SQL_AUDITORIA = os.environ.get('SQL_AUDITORIA', '') == '1'
+SQL_REPETICIONES_MAX = int(os.environ.get('SQL_REPETICIONES_MAX', '5'))
+
+# Presupuestos conocidos por endpoint: repeticiones permitidas de una misma
+# sentencia (None = sin limite). Todo endpoint que no figure aqui usa
+# SQL_REPETICIONES_MAX. Al corregir un N+1, bajar o quitar su entrada.
+SQL_PRESUPUESTOS = {
+    'cargar_inventario': None,        # 1 upsert por producto del archivo
+    'guardar_asignaciones': None,     # 1 INSERT por persona
+    'registrar_baja': None,           # 1 INSERT por item
+    'actualizar_costos': None,        # 1 UPDATE por producto
+    'cruce_op_resultado': None,       # 1 INSERT por linea de detalle (worker)
+    'eval_guardar': None,             # 1 INSERT por categoria evaluada
+    'admin_crear_usuario': 20,        # 1 INSERT por bodega
+    'admin_editar_usuario': 20,
+    'admin_guardar_roles': 30,        # 1 INSERT por modulo
+    'carga_inicial_productos': None,  # carga unica de catalogo
+}
+
+_RE_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_RE_SQL_NUMERO = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_SQL_LISTA = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_RE_SQL_ESPACIOS = re.compile(r'\s+')
+
+
+def _normalizar_sql(query):
+    """Reduce una sentencia a su forma canonica: sin literales, parametros ni espacios extra"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    else:
+        query = str(query)
+    query = _RE_SQL_LITERAL.sub('?', query)
+    query = query.replace('%s', '?')
+    query = _RE_SQL_NUMERO.sub('?', query)
+    query = _RE_SQL_LISTA.sub('(?...)', query)
+    return _RE_SQL_ESPACIOS.sub(' ', query).strip()
+
+
+class ContadorSQL:
+    """Acumula sentencias ejecutadas mientras esta activo"""
+
+    def __init__(self):
+        self.sentencias = {}
+
+    @property
+    def total(self):
+        return sum(self.sentencias.values())
+
+    def registrar(self, query, veces=1):
+        clave = _normalizar_sql(query)
+        self.sentencias[clave] = self.sentencias.get(clave, 0) + veces
+
+    def violaciones(self, endpoint=None, limite=None):
+        """Sentencias que superan el presupuesto del endpoint: [(sql, veces), ...]"""
+        if limite is None:
+            limite = SQL_PRESUPUESTOS.get(endpoint, SQL_REPETICIONES_MAX)
+            if limite is None:
+                return []
+        return sorted(((q, n) for q, n in self.sentencias.items() if n > limite),
+                      key=lambda x: -x[1])
+
+
+_sql_local = threading.local()
+
+
+def _registrar_sql(query, veces=1):
+    pila = getattr(_sql_local, 'contadores', None)
+    if pila:
+        for contador in pila:
+            contador.registrar(query, veces)
+
+
+class contar_sql:
+    """Context manager: cuenta las sentencias ejecutadas en este thread"""
+
+    def __enter__(self):
+        self.contador = ContadorSQL()
+        if not hasattr(_sql_local, 'contadores'):
+            _sql_local.contadores = []
+        _sql_local.contadores.append(self.contador)
+        return self.contador
+
+    def __exit__(self, *exc):
+        _sql_local.contadores.remove(self.contador)
+        return False
+
+
+class _AuditoriaSQL:
+    """Mixin de cursor: reporta cada sentencia a los contadores activos"""
+
+    def execute(self, query, vars=None):
+        _registrar_sql(query)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        _registrar_sql(query, len(vars_list))
+        return super().executemany(query, vars_list)
+
+    # Sin logica propia: dejan un frame Python sobre el fetch en C para el perfilador por muestreo
+    def fetchall(self):
+        return super().fetchall()
+
+    def fetchmany(self, size=None):
+        return super().fetchmany(self.arraysize if size is None else size)
+
+
+class _CursorAuditado(_AuditoriaSQL, RealDictCursor):
+    """RealDictCursor auditado (cursor por defecto del pool)"""
+
+
+class _CursorTuplas(_AuditoriaSQL, psycopg2.extensions.cursor):
+    """Cursor de tuplas auditado, para lecturas grandes"""
+
+
+# NUMERIC -> float solo en los cursores rapidos; el resto de la app sigue con Decimal
+NUMERIC_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_FLOAT',
+    lambda valor, cur: float(valor) if valor is not None else None)
+
+
+def _cursor_rapido(conn, name=None):
+    """Cursor de tuplas con NUMERIC como float: sin dict ni Decimal por fila.
+    Para lecturas de muchas filas que solo se serializan o se escriben a Excel."""
+    cur = conn.cursor(name, cursor_factory=_CursorTuplas) if name else conn.cursor(cursor_factory=_CursorTuplas)
+    psycopg2.extensions.register_type(NUMERIC_FLOAT, cur)
+    return cur
+
+
+if SQL_AUDITORIA:
+    @app.before_request
+    def _iniciar_auditoria_sql():
+        auditoria = contar_sql()
+        g._auditoria_sql = (auditoria, auditoria.__enter__())
+
+    def _cerrar_auditoria_sql():
+        auditoria = g.pop('_auditoria_sql', None)
+        if auditoria is None:
+            return None
+        auditoria[0].__exit__(None, None, None)
+        return auditoria[1]
+
+    @app.after_request
+    def _reportar_auditoria_sql(response):
+        contador = _cerrar_auditoria_sql()
+        if contador is not None:
+            response.headers['X-SQL-Sentencias'] = str(contador.total)
+            for query, veces in contador.violaciones(request.endpoint):
+                print(f"[N+1] {request.method} {request.path} ({request.endpoint}): {veces}x {query[:160]}")
+        return response
+
+    @app.teardown_request
+    def _limpiar_auditoria_sql(exc):
+        _cerrar_auditoria_sql()
+
+
+# ==================== ADMISION (clases de carga) ====================
+# Cada request que usa la BD cae en una clase: escritura (guardados de conteo), lectura
+# (pantallas) o pesado (reportes largos y exportaciones). Las cuotas de conexiones de las tres
+# clases mas POOL_RESERVA (arranque, threads de fondo) suman exactamente POOL_MAX_CONEXIONES:
+# ninguna clase puede dejar sin conexion a otra y getconn nunca encuentra el pool agotado.
+# _admitir_request reserva la conexion del request antes de entrar al handler; si la cuota no
+# tiene lugar en `espera` segundos responde 503 con Retry-After. get_db usa esa reserva sin
+# esperar, asi que los handlers nunca ven un error de capacidad. Las conexiones extra (fan-out)
+# solo se toman si la cuota tiene lugar en ese momento.
+POOL_MAX_CONEXIONES = int(os.environ.get('POOL_MAX_CONEXIONES', '15'))
+POOL_RESERVA = int(os.environ.get('POOL_RESERVA', '2'))
+ADMISION = {
+    'lectura': {'conexiones': int(os.environ.get('ADMISION_LECTURA_CONEXIONES', '5')), 'espera': 5,
+                'retry_after': 2},
+    'pesado': {'conexiones': int(os.environ.get('ADMISION_PESADO_CONEXIONES', '3')),
+               'espera': float(os.environ.get('ADMISION_PESADO_ESPERA', '3')), 'retry_after': 15},
+}
+# Escrituras: todo lo que queda del pool
+ADMISION['escritura'] = {
+    'conexiones': POOL_MAX_CONEXIONES - POOL_RESERVA - sum(c['conexiones'] for c in ADMISION.values()),
+    'espera': 30, 'retry_after': 1}
+if ADMISION['escritura']['conexiones'] < 1:
+    raise ValueError(f"POOL_MAX_CONEXIONES={POOL_MAX_CONEXIONES} no alcanza para POOL_RESERVA + cuotas de "
+                     f"lectura y pesado: las escrituras quedarian sin conexiones")
+_ENDPOINTS_PESADOS = {
+    'reporte_dashboard', 'reporte_motivos', 'reporte_motivo_detalle', 'reporte_diferencias',
+    'reporte_diferencias_fecha', 'reporte_tendencias', 'reporte_tendencias_temporal',
+    'historico', 'historico_pivot', 'descuentos_reporte', 'cruce_detalle',
+    'exportar_excel', 'cruce_exportar_excel', 'descuentos_exportar_excel',
+}
+# Reportes compartidos (_reporte_compartido): no reservan en la admision. Toman lectura solo para
+# leer la version y pesado solo el request que calcula; los que esperan no ocupan nada.
+_ENDPOINTS_COMPARTIDOS = {
+    'reporte_dashboard', 'reporte_motivos', 'reporte_tendencias_temporal', 'cruce_resumen',
+    'descuentos_reporte',
+}
+# No usan la BD (estaticos, Airtable, perfiles en memoria): no ocupan cuota
+_ENDPOINTS_SIN_ADMISION = {
+    'index', 'static_files', 'static', 'pagina_establecer_clave', 'health', 'evaluacion_page',
+    'get_categorias', 'get_bodegas', 'get_catalogo_productos', 'get_personas', 'debug_personas',
+    'debug_personas_airtable', 'obtener_personas_cedulas', 'eval_locales', 'depositos_listar',
+    'depositos_resumen', 'depositos_aprobar', 'admin_listar_personas', 'listar_perfiles',
+    'descargar_perfil',
+}
+_cuotas = {c: threading.BoundedSemaphore(cfg['conexiones']) for c, cfg in ADMISION.items()}
+_reservas_lock = threading.Lock()
+_conexion_clase = {}  # id(conn) -> (clase, reserva del request o None si es una conexion extra)
+
+
+class SinCapacidad(Exception):
+    """La cuota de la clase no tiene lugar (solo conexiones extra: el fan-out sigue en serie)"""
+
+    def __init__(self, clase):
+        super().__init__(f'cuota de conexiones de {clase} agotada')
+        self.clase = clase
+
+
+def _clase_carga():
+    """Clase de carga del request actual (None: no pasa por admision)"""
+    endpoint = request.endpoint
+    if endpoint is None or endpoint in _ENDPOINTS_SIN_ADMISION:
+        return None
+    if endpoint in _ENDPOINTS_COMPARTIDOS and not _modo_stream():
+        return None
+    if endpoint in _ENDPOINTS_PESADOS or 'exportar' in request.path:
+        return 'pesado'
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+        return 'escritura'
+    return 'lectura'
+
+
+def _respuesta_ocupado(clase):
+    resp = jsonify({'error': 'Servidor ocupado, reintenta en unos segundos', 'clase': clase})
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(ADMISION[clase]['retry_after'])
+    return resp
+
+
+def _reservar(clase):
+    """Reserva para el request una conexion de la cuota de `clase` (espera lo de la clase)"""
+    if not _cuotas[clase].acquire(timeout=ADMISION[clase]['espera']):
+        print(f"[admision] {clase} saturado: 503 a {request.method} {request.path}")
+        return False
+    # libre: la conexion reservada no esta en uso; terminado: el request ya salio
+    g.reserva = {'clase': clase, 'libre': True, 'terminado': False}
+    return True
+
+
+def _soltar_reserva():
+    reserva = g.pop('reserva', None)
+    if reserva is None:
+        return
+    with _reservas_lock:
+        reserva['terminado'] = True
+        devolver = reserva['libre']
+    # Si la conexion sigue tomada, la cuota se devuelve en release_db
+    if devolver:
+        _cuotas[reserva['clase']].release()
+
+
+@app.before_request
+def _admitir_request():
+    clase = _clase_carga()
+    if clase is None or _reservar(clase):
+        return None
+    return _respuesta_ocupado(clase)
+
+
+@app.teardown_request
+def _liberar_reserva(exc):
+    # Corre tambien al terminar un stream (stream_with_context mantiene el contexto)
+    _soltar_reserva()
+
+
+@app.errorhandler(SinCapacidad)
+def _sin_capacidad(e):
+    # Respaldo: una conexion extra pedida fuera de un try (el camino normal nunca espera)
+    print(f"[admision] {e}: 503 a {request.method} {request.path}")
+    return _respuesta_ocupado(e.clase)
+
+
+def _tomar_cuota():
+    """Cupo de la clase para una conexion nueva: (clase, reserva) o (None, None) fuera de request"""
+    reserva = g.get('reserva') if has_request_context() else None
+    if reserva is None:
+        return None, None
+    with _reservas_lock:
+        if reserva['libre']:
+            reserva['libre'] = False
+            return reserva['clase'], reserva
+    if not _cuotas[reserva['clase']].acquire(blocking=False):
+        raise SinCapacidad(reserva['clase'])
+    return reserva['clase'], None
+
+
+def _devolver_cuota(clase, reserva):
+    if reserva is not None:
+        with _reservas_lock:
+            if not reserva['terminado']:
+                reserva['libre'] = True
+                return
+    _cuotas[clase].release()
+
+
 _connection_pool = None
 
 def _get_pool():
     global _connection_pool
     if _connection_pool is None:
-        _connection_pool = SimpleConnectionPool(
-            minconn=2, maxconn=15,
-            **DB_CONFIG, cursor_factory=RealDictCursor
+        # Threaded: el fan-out de consultas toma y devuelve conexiones desde varios threads
+        _connection_pool = ThreadedConnectionPool(
+            minconn=2, maxconn=POOL_MAX_CONEXIONES,
+            **DB_CONFIG, cursor_factory=_CursorAuditado
         )
     return _connection_pool
 
 def get_db():
-    """Obtiene conexion del pool, validando que este viva"""
-    conn = _get_pool().getconn()
+    """Obtiene conexion del pool, validando que este viva.
+    Dentro de un request usa la conexion reservada por la admision; una segunda conexion
+    simultanea (fan-out) solo si la cuota de la clase tiene lugar, si no SinCapacidad."""
+    clase, reserva = _tomar_cuota()
     try:
-        conn.cursor().execute("SELECT 1")
-        conn.rollback()
-    except Exception:
-        # Conexion stale - cerrar y crear nueva
+        conn = _get_pool().getconn()
         try:
-            _get_pool().putconn(conn, close=True)
+            conn.cursor(cursor_factory=psycopg2.extensions.cursor).execute("SELECT 1")
+            conn.rollback()
         except Exception:
+            # Conexion stale - cerrar y crear nueva
             try:
-                conn.close()
+                _get_pool().putconn(conn, close=True)
             except Exception:
-                pass
-        conn = psycopg2.connect(**DB_CONFIG, cursor_factory=RealDictCursor)
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            conn = psycopg2.connect(**DB_CONFIG, cursor_factory=_CursorAuditado)
+    except Exception:
+        if clase is not None:
+            _devolver_cuota(clase, reserva)
+        raise
+    if clase is not None:
+        _conexion_clase[id(conn)] = (clase, reserva)
     return conn
 
 def release_db(conn):
+    cuota = _conexion_clase.pop(id(conn), None)
+    if cuota is not None:
+        _devolver_cuota(*cuota)
     try:
         if conn.closed:
             return
@@ -92,6 +600,908 @@ def release_db(conn):
             pass
 
 
+# ==================== FAN-OUT DE CONSULTAS ====================
+# Endpoints con varias consultas independientes las corren en paralelo, cada una en su
+# propia conexion del pool:
+#   res = consultas_paralelas(conn, {'resumen': (sql, params), 'top': (sql2, params2),
+#                                    'filas': lambda c: ...})
+#   -> {'resumen': filas, 'top': filas, 'filas': valor}
+# (sql, params) devuelve cur.fetchall(); un callable recibe la conexion y devuelve lo que quiera
+# (corre en otro thread: no puede usar request ni g). `conn` ejecuta su parte en el thread del
+# request y se piden hasta FANOUT_CONEXIONES_MAX conexiones extra; si el pool no las entrega, lo
+# que falte corre en serie. Cada conexion lleva SET LOCAL statement_timeout.
+from concurrent.futures import ThreadPoolExecutor, wait as _esperar_futuros
+
+FANOUT_CONEXIONES_MAX = int(os.environ.get('FANOUT_CONEXIONES_MAX', '3'))      # extras por request
+FANOUT_STATEMENT_TIMEOUT_MS = int(os.environ.get('FANOUT_STATEMENT_TIMEOUT_MS', '20000'))
+_fanout_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('FANOUT_WORKERS', '8')),
+                                      thread_name_prefix='fanout')
+
+
+def _conexiones_extra(conn, n, snapshot=False):
+    """Hasta n conexiones del pool (menos si se agota). Con snapshot=True importan el snapshot
+    de `conn` (pg_export_snapshot) y ven exactamente los mismos datos."""
+    if n <= 0:
+        return []
+    id_snapshot = None
+    if snapshot:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_export_snapshot() AS snapshot")
+        id_snapshot = cur.fetchone()['snapshot']
+    extras = []
+    for _ in range(n):
+        try:
+            # Sin esperar: si la clase agoto su cuota, lo que falte corre en serie
+            extra = get_db()
+        except Exception as e:
+            print(f"Fan-out sin conexion extra: {e}")
+            break
+        if id_snapshot:
+            try:
+                c = extra.cursor()
+                c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                c.execute("SET TRANSACTION SNAPSHOT %s", (id_snapshot,))
+            except Exception as e:
+                print(f"Fan-out sin snapshot: {e}")
+                extra.rollback()
+                release_db(extra)
+                break
+        extras.append(extra)
+    return extras
+
+
+def _correr_consultas(conn, grupo, timeout_ms):
+    cur = conn.cursor()
+    cur.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+    resultados = []
+    for nombre, consulta in grupo:
+        if callable(consulta):
+            resultados.append((nombre, consulta(conn)))
+        else:
+            cur.execute(*consulta)
+            resultados.append((nombre, cur.fetchall()))
+    return resultados
+
+
+def consultas_paralelas(conn, consultas, conexiones_max=None, timeout_ms=None, snapshot=False):
+    """Ejecuta {nombre: (sql, params) | callable(conn)} repartidas entre `conn` y conexiones
+    extra del pool. Devuelve {nombre: resultado}. El statement_timeout queda puesto en `conn`
+    hasta el fin de su transaccion."""
+    items = list(consultas.items())
+    if conexiones_max is None:
+        conexiones_max = FANOUT_CONEXIONES_MAX
+    if timeout_ms is None:
+        timeout_ms = FANOUT_STATEMENT_TIMEOUT_MS
+    extras = _conexiones_extra(conn, min(conexiones_max, len(items) - 1), snapshot)
+    n = len(extras) + 1
+    grupos = [items[i::n] for i in range(n)]
+    futuros = []
+    try:
+        futuros = [_fanout_executor.submit(_correr_consultas, extra, grupo, timeout_ms)
+                   for extra, grupo in zip(extras, grupos[1:])]
+        resultados = dict(_correr_consultas(conn, grupos[0], timeout_ms))
+        for futuro in futuros:
+            resultados.update(futuro.result())
+        return resultados
+    finally:
+        # Ninguna conexion vuelve al pool mientras un worker la esta usando
+        _esperar_futuros(futuros)
+        for extra in extras:
+            try:
+                extra.rollback()
+            except Exception:
+                pass
+            release_db(extra)
+
+
+# ==================== PAGINACION (keyset) ====================
+# Uso en un endpoint de listado:
+#   resp = _respuesta_pagina(conn, sql_sin_order_by, params, orden, limite, cursor, con_total, 'clave')
+#   -> {clave: filas, 'siguiente': cursor opaco o None, 'total_filas': ... (si se pidio)}
+#   (o pagina = _leer_pagina(...) para armar la respuesta a mano)
+# Parametros del request: ?limit=N&cursor=<siguiente>&con_total=1
+# `orden` son expresiones sobre las columnas de la consulta base (alias q) con
+# direccion; la ultima debe ser unica (id) para que el cursor sea estable.
+# Una clave que puede ser NULL se marca con un tercer elemento True: se ordena NULLS LAST
+# y el cursor la compara con IS NULL (una comparacion de filas descartaria esas filas).
+import base64 as _b64
+import json as _json
+import uuid
+
+PAGINA_LIMITE_MAX = 5000
+PAGINA_CURSOR_SERVIDOR = 500  # paginas mas grandes se leen con cursor con nombre (server-side)
+PAGINA_ITERSIZE = 500
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def _codificar_cursor(valores):
+    texto = _json.dumps(valores, default=str, separators=(',', ':'))
+    return _b64.urlsafe_b64encode(texto.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decodificar_cursor(token, n):
+    try:
+        texto = _b64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        valores = _json.loads(texto)
+    except Exception:
+        raise CursorInvalido('cursor invalido')
+    if not isinstance(valores, list) or len(valores) != n:
+        raise CursorInvalido('cursor invalido')
+    return valores
+
+
+def _nullable(clave):
+    return len(clave) > 2 and clave[2]
+
+
+def _condicion_keyset(orden, valores):
+    """WHERE que selecciona las filas posteriores a `valores` segun `orden`"""
+    direcciones = {d for _, d, *_ in orden}
+    if len(direcciones) == 1 and not any(map(_nullable, orden)) and None not in valores:
+        # Misma direccion en todas las claves: comparacion de filas (usa el indice compuesto)
+        op = '>' if 'ASC' in direcciones else '<'
+        exprs = ', '.join(c[0] for c in orden)
+        marcas = ', '.join(['%s'] * len(orden))
+        return f"({exprs}) {op} ({marcas})", list(valores)
+    partes, params = [], []
+    for i, clave in enumerate(orden):
+        condicion, extra = [], []
+        for j in range(i):
+            if valores[j] is None:
+                condicion.append(f"{orden[j][0]} IS NULL")
+            else:
+                condicion.append(f"{orden[j][0]} = %s")
+                extra.append(valores[j])
+        if valores[i] is None:
+            continue  # NULLS LAST: en esta clave no hay nada despues de NULL
+        mayor = f"{clave[0]} {'>' if clave[1] == 'ASC' else '<'} %s"
+        condicion.append(f"({mayor} OR {clave[0]} IS NULL)" if _nullable(clave) else mayor)
+        partes.append('(' + ' AND '.join(condicion) + ')')
+        params.extend(extra + [valores[i]])
+    return ('(' + ' OR '.join(partes) + ')') if partes else 'FALSE', params
+
+
+def _iterar_filas(conn, sql, params, servidor=False, tuplas=False):
+    """Itera filas; con servidor=True usa un cursor con nombre para no traer todo a memoria.
+    Con tuplas=True las filas son tuplas con NUMERIC como float (ver _cursor_rapido)."""
+    nombre = f"cur_{uuid.uuid4().hex[:12]}" if servidor else None
+    if tuplas:
+        cur = _cursor_rapido(conn, nombre)
+    elif servidor:
+        cur = conn.cursor(name=nombre)
+    else:
+        cur = conn.cursor()
+    if servidor:
+        cur.itersize = PAGINA_ITERSIZE
+    try:
+        cur.execute(sql, params)
+        for fila in cur:
+            yield fila
+    finally:
+        cur.close()
+
+
+def _parametros_pagina():
+    """(limit, cursor, con_total) del request; limit None = sin paginar"""
+    limite = request.args.get('limit', type=int)
+    if limite is not None:
+        limite = max(1, min(limite, PAGINA_LIMITE_MAX))
+    return limite, request.args.get('cursor') or None, request.args.get('con_total') == '1'
+
+
+def _sql_pagina(sql_base, params, orden, limite, cursor):
+    """(sql, params) de una pagina: pide limite + 1 filas para saber si hay siguiente"""
+    claves = ', '.join(f"{c[0]} AS _k{i}" for i, c in enumerate(orden))
+    sql = f"SELECT q.*, {claves} FROM ({sql_base}) q"
+    sql_params = list(params)
+    if cursor:
+        condicion, extra = _condicion_keyset(orden, _decodificar_cursor(cursor, len(orden)))
+        sql += f" WHERE {condicion}"
+        sql_params += extra
+    sql += " ORDER BY " + ', '.join(f"{c[0]} {c[1]}" + (" NULLS LAST" if _nullable(c) else "")
+                                    for c in orden)
+    sql += " LIMIT %s"
+    sql_params.append(limite + 1)
+    return sql, sql_params
+
+
+def _recorrer_pagina(filas, n_claves, limite, estado):
+    """Genera las filas de la pagina sin las columnas _k; al terminar deja estado['siguiente']"""
+    ultimas_claves = None
+    estado['siguiente'] = None
+    for fila in filas:
+        if estado.setdefault('n', 0) == limite:
+            estado['siguiente'] = _codificar_cursor(ultimas_claves)
+            return
+        fila = dict(fila)
+        ultimas_claves = [fila.pop(f'_k{i}') for i in range(n_claves)]
+        estado['n'] += 1
+        yield fila
+
+
+def _total_pagina(conn, sql_base, params):
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) AS n FROM ({sql_base}) q", params)
+    return cur.fetchone()['n']
+
+
+def _leer_pagina(conn, sql_base, params, orden, limite, cursor=None, con_total=False):
+    """Una pagina de `sql_base` ordenada por `orden`, con cursor opaco a la siguiente"""
+    sql, sql_params = _sql_pagina(sql_base, params, orden, limite, cursor)
+    estado = {}
+    iterador = _iterar_filas(conn, sql, sql_params)
+    try:
+        filas = list(_recorrer_pagina(iterador, len(orden), limite, estado))
+    finally:
+        iterador.close()
+    pagina = {'filas': filas, 'siguiente': estado['siguiente']}
+    if con_total:
+        pagina['total_filas'] = _total_pagina(conn, sql_base, params)
+    return pagina
+
+
+def _cuerpo_pagina(pagina, clave, filas=None):
+    """Dict de respuesta: {clave: filas, 'siguiente': ..., 'total_filas': ... (si se pidio)}"""
+    cuerpo = {clave: pagina['filas'] if filas is None else filas, 'siguiente': pagina['siguiente']}
+    if 'total_filas' in pagina:
+        cuerpo['total_filas'] = pagina['total_filas']
+    return cuerpo
+
+
+def _respuesta_pagina(conn, sql_base, params, orden, limite, cursor, con_total, clave,
+                      transformar=None, campo_cantidad=None):
+    """Response JSON de una pagina. transformar(fila) -> item; campo_cantidad agrega las filas enviadas.
+    Paginas de mas de PAGINA_CURSOR_SERVIDOR filas salen en streaming desde un cursor de servidor,
+    sin juntarlas en memoria. Toma la conexion: el handler no debe liberarla si esto retorna."""
+    if limite <= PAGINA_CURSOR_SERVIDOR:
+        pagina = _leer_pagina(conn, sql_base, params, orden, limite, cursor, con_total)
+        filas = [transformar(f) for f in pagina['filas']] if transformar else pagina['filas']
+        cuerpo = _cuerpo_pagina(pagina, clave, filas)
+        if campo_cantidad:
+            cuerpo[campo_cantidad] = len(filas)
+        release_db(conn)
+        return jsonify(cuerpo)
+
+    sql, sql_params = _sql_pagina(sql_base, params, orden, limite, cursor)
+    estado = {}
+    if con_total:
+        estado['total_filas'] = _total_pagina(conn, sql_base, params)
+
+    def items(filas):
+        for fila in _recorrer_pagina(filas, len(orden), limite, estado):
+            yield transformar(fila) if transformar else fila
+
+    def cola():
+        extra = {'siguiente': estado['siguiente']}
+        if 'total_filas' in estado:
+            extra['total_filas'] = estado['total_filas']
+        if campo_cantidad:
+            extra[campo_cantidad] = estado.get('n', 0)
+        return extra
+
+    return _respuesta_stream(conn, sql, sql_params, 'json', items, clave, cola)
+
+
+# ==================== RESPUESTAS EN STREAMING ====================
+# ?stream=1      -> arreglo JSON escrito a medida que llegan las filas
+# ?stream=ndjson -> un objeto JSON por linea (application/x-ndjson); los campos finales del
+#                   endpoint (resumen, totales) van en una ultima linea {"_cola": {...}}
+# Las filas salen de un cursor de servidor: la memoria no crece con el tamaño del resultado.
+# Si la consulta falla a mitad de camino el status 200 ya salio: el cuerpo se cierra bien
+# formado y lleva "_error" (campo del objeto, ultimo item del arreglo o linea ndjson).
+STREAM_BLOQUE = 64 * 1024  # bytes acumulados antes de enviar un chunk
+
+
+def _modo_stream():
+    """'json', 'ndjson' o None segun ?stream="""
+    modo = (request.args.get('stream') or '').lower()
+    if modo == 'ndjson':
+        return 'ndjson'
+    if modo in ('1', 'true', 'json'):
+        return 'json'
+    return None
+
+
+def _respuesta_stream(conn, sql, params, modo, transformar=None, clave=None, cola=None, tuplas=False):
+    """Response que serializa `sql` fila a fila.
+    transformar(filas) -> iterable de items (por defecto cada fila tal cual);
+    con tuplas=True recibe tuplas de _cursor_rapido en vez de dicts.
+    Con clave, el arreglo va dentro de {clave: [...]} y cola() agrega los campos finales
+    (en ndjson, como ultima linea {"_cola": {...}}).
+    La conexion pasa a ser del generador: el handler no debe liberarla."""
+    dumps = app.json.dumps
+
+    def generar():
+        iterador = _iterar_filas(conn, sql, params, servidor=True, tuplas=tuplas)
+        items = transformar(iterador) if transformar else iterador
+        partes, tamano = [], 0
+        primero, en_arreglo = True, False
+        try:
+            if modo == 'json':
+                partes.append('{' + dumps(clave) + ':[' if clave else '[')
+                en_arreglo = True
+            for item in items:
+                texto = dumps(item)
+                if modo == 'ndjson':
+                    texto += '\n'
+                elif not primero:
+                    texto = ',' + texto
+                primero = False
+                partes.append(texto)
+                tamano += len(texto)
+                if tamano >= STREAM_BLOQUE:
+                    yield ''.join(partes)
+                    partes, tamano = [], 0
+            final = cola() if cola else {}
+            if modo == 'json':
+                partes.append(']')
+                en_arreglo = False
+                if clave:
+                    for k, v in final.items():
+                        partes.append(',' + dumps(k) + ':' + dumps(v))
+                    partes.append('}')
+            elif final:
+                partes.append(dumps({'_cola': final}) + '\n')
+            if partes:
+                yield ''.join(partes)
+        except Exception as e:
+            # Ya se envio el status 200: se cierra el cuerpo con una marca de error
+            print(f"Error en stream {request.path}: {e}")
+            error = dumps({'_error': 'Error generando la respuesta'})
+            if modo == 'ndjson':
+                partes.append(error + '\n')
+            elif en_arreglo:
+                partes.append(('' if primero else ',') + error + ']' + ('}' if clave else ''))
+            else:
+                # Fallo en cola(): el arreglo ya esta cerrado
+                partes.append(',"_error":' + dumps('Error generando la respuesta') + '}' if clave else '')
+            yield ''.join(partes)
+        finally:
+            iterador.close()
+            release_db(conn)
+
+    mimetype = 'application/x-ndjson' if modo == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generar()), mimetype=mimetype)
+
+
+# ==================== FORMATO COLUMNAR ====================
+# ?format=columnar: cada tabla sale como {'columnas', 'n', 'valores': [col0, col1, ...], 'diccionarios'}.
+# Las columnas de texto repetitivas van como indices a diccionarios[columna].
+def _formato_columnar():
+    return request.args.get('format') == 'columnar'
+
+
+def _tabla_columnar(columnas, filas, diccionario=()):
+    """Transpone `filas` (lista de tuplas en el orden de `columnas`) a arreglos paralelos"""
+    valores = [list(col) for col in zip(*filas)] if filas else [[] for _ in columnas]
+    diccionarios = {}
+    for i, nombre in enumerate(columnas):
+        if nombre in diccionario:
+            tabla, indices = {}, []
+            for v in valores[i]:
+                indices.append(tabla.setdefault(v, len(tabla)))
+            diccionarios[nombre] = list(tabla)
+            valores[i] = indices
+    return {'columnas': list(columnas), 'n': len(filas), 'valores': valores, 'diccionarios': diccionarios}
+
+
+# Expresiones de cada columna de goti.semanas_stats, evaluadas sobre una semana `s`
+_SQL_STATS_SEMANA = {
+    'productos_contados': """(
+        SELECT COUNT(DISTINCT c.codigo) FROM goti.inventario_ciego_conteos c
+        WHERE c.local = s.local AND c.fecha BETWEEN s.fecha_inicio AND s.fecha_fin
+          AND (c.cantidad_contada IS NOT NULL OR c.cantidad_contada_2 IS NOT NULL))""",
+    'total_asignado': """COALESCE((
+        SELECT SUM(ap.monto) FROM goti.asignacion_semanal a
+        JOIN goti.asignacion_semanal_personas ap ON ap.asignacion_semanal_id = a.id
+        WHERE a.semana_id = s.id), 0)""",
+    # Solo semanas cerradas (snapshot); las abiertas se calculan en vivo en listar_semanas
+    'total_diferencia_valorizada': """(
+        SELECT sn.total_valorizado FROM goti.semana_snapshot sn WHERE sn.semana_id = s.id)""",
+}
+
+
+def _refrescar_stats_semanas(cur, semana_id=None, local=None, fecha=None):
+    """Recalcula semanas_stats de una semana (semana_id) o de las semanas de `local` que contienen `fecha`"""
+    if semana_id is not None:
+        filtro, params = "s.id = %s", (semana_id,)
+    else:
+        filtro, params = "s.local = %s AND %s BETWEEN s.fecha_inicio AND s.fecha_fin", (local, fecha)
+    # Primero crear/bloquear la fila: el recalculo corre despues del lock y ve
+    # los conteos ya confirmados por otros guardados concurrentes de la misma semana
+    cur.execute(f"""
+        INSERT INTO goti.semanas_stats (semana_id)
+        SELECT s.id FROM goti.semanas_inventario s WHERE {filtro}
+        ON CONFLICT (semana_id) DO UPDATE SET updated_at = NOW()
+        RETURNING semana_id
+    """, params)
+    ids = [r['semana_id'] for r in cur.fetchall()]
+    if not ids:
+        return
+    cur.execute(f"""
+        UPDATE goti.semanas_stats st
+        SET productos_contados = {_SQL_STATS_SEMANA['productos_contados']},
+            total_asignado = {_SQL_STATS_SEMANA['total_asignado']},
+            total_diferencia_valorizada = {_SQL_STATS_SEMANA['total_diferencia_valorizada']},
+            updated_at = NOW()
+        FROM goti.semanas_inventario s
+        WHERE s.id = st.semana_id AND st.semana_id = ANY(%s)
+    """, (ids,))
+
+
+def _ajustar_contados_semana(cur, cambios):
+    """Suma/resta en semanas_stats.productos_contados los productos que pasaron de no contados a
+    contados (o al reves). `cambios`: filas con id, codigo, local, fecha, antes, ahora.
+    Un producto cuenta una vez por semana: si otro dia de la semana lo tiene contado no hay delta.
+    Las filas de stats de las semanas tocadas se bloquean (en orden) antes de mirar los otros dias:
+    dos guardados del mismo producto en dias distintos se serializan y el segundo ve el commit del
+    primero, asi el contador no se desvia."""
+    por_id = {}
+    for c in cambios:  # el mismo conteo puede venir dos veces (conteo 1 y 2 del mismo lote)
+        previo = por_id.get(c['id'])
+        por_id[c['id']] = dict(c, antes=previo['antes']) if previo else dict(c)
+    cambios = [c for c in por_id.values() if c['antes'] != c['ahora']]
+    if not cambios:
+        return
+    ids = [c['id'] for c in cambios]
+    cur.execute("""
+        SELECT DISTINCT s.id FROM goti.semanas_inventario s
+        JOIN unnest(%s::text[], %s::date[]) AS x(local, fecha)
+          ON s.local = x.local AND x.fecha BETWEEN s.fecha_inicio AND s.fecha_fin
+        ORDER BY s.id
+    """, ([c['local'] for c in cambios], [c['fecha'] for c in cambios]))
+    semanas = [r['id'] for r in cur.fetchall()]
+    if not semanas:
+        return
+    # Crea/bloquea las filas de stats; lo que sigue corre con un snapshot posterior al lock
+    cur.execute("""
+        INSERT INTO goti.semanas_stats (semana_id)
+        SELECT unnest(%s::int[]) ORDER BY 1
+        ON CONFLICT (semana_id) DO UPDATE SET updated_at = NOW()
+    """, (semanas,))
+    cur.execute("""
+        SELECT x.id, s.id AS semana_id, EXISTS (
+                   SELECT 1 FROM goti.inventario_ciego_conteos c
+                   WHERE c.local = s.local AND c.fecha BETWEEN s.fecha_inicio AND s.fecha_fin
+                     AND c.codigo = x.codigo AND c.id <> ALL(%s)
+                     AND (c.cantidad_contada IS NOT NULL OR c.cantidad_contada_2 IS NOT NULL)) AS otro_dia
+        FROM unnest(%s::int[], %s::text[], %s::text[], %s::date[]) AS x(id, codigo, local, fecha)
+        JOIN goti.semanas_inventario s ON s.local = x.local AND x.fecha BETWEEN s.fecha_inicio AND s.fecha_fin
+    """, (ids, ids, [c['codigo'] for c in cambios], [c['local'] for c in cambios],
+          [c['fecha'] for c in cambios]))
+    grupos = {}  # (semana, codigo) -> [contado antes, contado despues]
+    for r in cur.fetchall():
+        c = por_id[r['id']]
+        g = grupos.setdefault((r['semana_id'], c['codigo']), [r['otro_dia'], r['otro_dia']])
+        g[0] = g[0] or c['antes']
+        g[1] = g[1] or c['ahora']
+    deltas = {}
+    for (semana_id, _), (antes, ahora) in grupos.items():
+        deltas[semana_id] = deltas.get(semana_id, 0) + int(ahora) - int(antes)
+    for semana_id, delta in sorted(deltas.items()):
+        if delta:
+            cur.execute("""
+                UPDATE goti.semanas_stats
+                SET productos_contados = productos_contados + %s, updated_at = NOW()
+                WHERE semana_id = %s
+            """, (delta, semana_id))
+
+
+# ---- Ledger de descuentos (append-only) ----
+# Cada cierre de semana agrega un "cargo" por (persona, semana, local, codigo).
+# Reabrir/eliminar una semana cerrada agrega "reversos" (montos negativos con
+# reversa_de = id del cargo); nunca se actualiza ni borra una fila.
+# saldo_persona = acumulado de la persona despues de cada movimiento.
+_SQL_DESCUENTOS_ORIGEN = """
+    SELECT ap.persona, s.id AS semana_id, s.fecha_inicio, s.fecha_fin, s.local,
+           a.codigo, a.nombre, a.unidad,
+           COALESCE(ap.cantidad, 0) AS cantidad, COALESCE(ap.monto, 0) AS monto,
+           a.costo_unitario, a.diferencia_semanal
+    FROM goti.asignacion_semanal_personas ap
+    JOIN goti.asignacion_semanal a ON a.id = ap.asignacion_semanal_id
+    JOIN goti.semanas_inventario s ON s.id = a.semana_id
+"""
+
+
+def _ledger_registrar_cargos(cur, semana_id=None):
+    """Agrega al ledger los cargos de una semana cerrada (o de todas las cerradas sin cargos vigentes)"""
+    if semana_id is not None:
+        filtro, params = "s.id = %s", (semana_id,)
+    else:
+        filtro, params = """s.estado = 'cerrada' AND NOT EXISTS (
+            SELECT 1 FROM goti.descuentos_vigentes v WHERE v.semana_id = s.id)""", ()
+    # Serializa escritores del ledger para que saldo_persona sea consistente
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('goti.descuentos_ledger'))")
+    cur.execute(f"""
+        INSERT INTO goti.descuentos_ledger
+            (persona, semana_id, fecha_inicio, fecha_fin, local, codigo, nombre, unidad,
+             cantidad, monto, costo_unitario, diferencia_semanal, saldo_persona)
+        SELECT x.persona, x.semana_id, x.fecha_inicio, x.fecha_fin, x.local, x.codigo, x.nombre, x.unidad,
+               x.cantidad, x.monto, x.costo_unitario, x.diferencia_semanal,
+               COALESCE(sp.saldo, 0) + SUM(x.monto) OVER (
+                   PARTITION BY x.persona ORDER BY x.fecha_inicio, x.semana_id, x.codigo
+                   ROWS UNBOUNDED PRECEDING)
+        FROM ({_SQL_DESCUENTOS_ORIGEN} WHERE {filtro}) x
+        LEFT JOIN LATERAL (
+            SELECT l.saldo_persona AS saldo FROM goti.descuentos_ledger l
+            WHERE l.persona = x.persona ORDER BY l.id DESC LIMIT 1
+        ) sp ON TRUE
+        ORDER BY x.persona, x.fecha_inicio, x.semana_id, x.codigo
+    """, params)
+    return cur.rowcount
+
+
+def _ledger_reversar_semana(cur, semana_id):
+    """Agrega reversos de los cargos vigentes de una semana (al reabrirla o eliminarla)"""
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('goti.descuentos_ledger'))")
+    cur.execute("""
+        INSERT INTO goti.descuentos_ledger
+            (persona, semana_id, fecha_inicio, fecha_fin, local, codigo, nombre, unidad,
+             cantidad, monto, costo_unitario, diferencia_semanal, reversa_de, saldo_persona)
+        SELECT v.persona, v.semana_id, v.fecha_inicio, v.fecha_fin, v.local, v.codigo, v.nombre, v.unidad,
+               -v.cantidad, -v.monto, v.costo_unitario, v.diferencia_semanal, v.id,
+               COALESCE(sp.saldo, 0) - SUM(v.monto) OVER (
+                   PARTITION BY v.persona ORDER BY v.id ROWS UNBOUNDED PRECEDING)
+        FROM goti.descuentos_vigentes v
+        LEFT JOIN LATERAL (
+            SELECT l.saldo_persona AS saldo FROM goti.descuentos_ledger l
+            WHERE l.persona = v.persona ORDER BY l.id DESC LIMIT 1
+        ) sp ON TRUE
+        WHERE v.semana_id = %s
+        ORDER BY v.persona, v.id
+    """, (semana_id,))
+    return cur.rowcount
+
+
+def _sql_descuentos(fecha_desde=None, fecha_hasta=None, local=None, solo_cerradas=True, persona=None):
+    """(sql, params) de las filas de descuento por persona/semana/local/producto.
+    Semanas cerradas salen del ledger; con solo_cerradas=False se leen las asignaciones en vivo."""
+    filtros, params = [], []
+    if fecha_desde:
+        filtros.append("d.fecha_inicio >= %s"); params.append(fecha_desde)
+    if fecha_hasta:
+        filtros.append("d.fecha_fin <= %s"); params.append(fecha_hasta)
+    if local:
+        filtros.append("d.local = %s"); params.append(local)
+    if persona:
+        filtros.append("d.persona = %s"); params.append(persona)
+    where = ("WHERE " + " AND ".join(filtros)) if filtros else ""
+    if solo_cerradas:
+        origen = """
+            SELECT persona, fecha_inicio, fecha_fin, local, 'cerrada' AS estado,
+                   codigo, nombre, unidad, cantidad, monto, costo_unitario, diferencia_semanal,
+                   saldo_persona
+            FROM goti.descuentos_vigentes
+        """
+    else:
+        origen = f"""
+            SELECT o.persona, o.fecha_inicio, o.fecha_fin, o.local, s.estado,
+                   o.codigo, o.nombre, o.unidad, o.cantidad, o.monto, o.costo_unitario, o.diferencia_semanal,
+                   NULL::numeric AS saldo_persona
+            FROM ({_SQL_DESCUENTOS_ORIGEN}) o
+            JOIN goti.semanas_inventario s ON s.id = o.semana_id
+        """
+    return f"""
+        SELECT d.* FROM ({origen}) d
+        {where}
+        ORDER BY d.persona, d.fecha_inicio, d.local, d.nombre
+    """, params
+
+
+def _consultar_descuentos(cur, fecha_desde=None, fecha_hasta=None, local=None, solo_cerradas=True, persona=None):
+    """Filas de descuento (ver _sql_descuentos)"""
+    cur.execute(*_sql_descuentos(fecha_desde, fecha_hasta, local, solo_cerradas, persona))
+    return cur.fetchall()
+
+
+# ==================== VERSION POR (fecha, local) ====================
+# goti.versiones_datos guarda un contador por (fecha, local) que los triggers de init_db
+# suben en cada escritura a conteos, observaciones manuales, asignaciones y secciones.
+# Los GET de ese slice lo envian como ETag y responden 304 si no cambio.
+def _version_slice(cur, fecha, local):
+    cur.execute("SELECT version FROM goti.versiones_datos WHERE fecha = %s AND local = %s", (fecha, local))
+    fila = cur.fetchone()
+    return fila['version'] if fila else 0
+
+
+def _etag_version(version, *extra):
+    return '-'.join(str(x) for x in (version,) + extra)
+
+
+def _etag_slice(cur, fecha, local, *extra):
+    """ETag del slice; se lee ANTES que los datos para que nunca quede mas nuevo que ellos"""
+    return _etag_version(_version_slice(cur, fecha, local), *extra)
+
+
+def _no_modificado(etag):
+    """Response 304 si el cliente ya tiene `etag`, si no None"""
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag, weak=True)
+        return resp
+    return None
+
+
+def _con_etag(resp, etag):
+    # Debil: el cuerpo puede ir comprimido o no segun Accept-Encoding
+    resp.set_etag(etag, weak=True)
+    return resp
+
+
+# ==================== REPORTES COMPARTIDOS (single-flight + cache versionado) ====================
+# Al cierre de mes varios supervisores abren el mismo reporte con segundos de diferencia.
+# Requests con la misma clave (endpoint, parametros normalizados, version de datos) comparten
+# un solo calculo: el primero lo corre y los demas esperan su resultado.
+# La version de un rango es la suma de las versiones de sus slices (fecha, local) en
+# goti.versiones_datos, que los triggers de init_db suben en toda escritura a conteos,
+# observaciones manuales y asignaciones (guardar/corregir conteo, cargas, borrados, panel).
+# Mientras no cambie, el JSON se sirve desde el cache: LRU en memoria acotado en MB y, con
+# REPORTES_CACHE_DIR, un segundo nivel en disco que sobrevive reinicios.
+# Los reportes sobre tablas sin trigger (descuentos: ledger, asignaciones semanales y semanas;
+# cruces) pasan ttl y solo quedan esos segundos en memoria.
+REPORTES_TTL = float(os.environ.get('REPORTES_TTL', '30'))
+REPORTES_CACHE_MB = float(os.environ.get('REPORTES_CACHE_MB', '64'))
+REPORTES_CACHE_DIR = os.environ.get('REPORTES_CACHE_DIR', '')  # vacio = sin nivel en disco
+REPORTES_DISCO_MB = float(os.environ.get('REPORTES_DISCO_MB', '512'))
+REPORTES_ESPERA = 120  # segundos maximos esperando el calculo de otro request
+
+_reportes_lock = threading.Lock()
+_reportes_en_vuelo = {}          # clave y (endpoint, parametros) sin version -> _Vuelo
+_reportes_cache = OrderedDict()  # clave -> (expira o None, cuerpo JSON)
+_reportes_bytes = [0]
+_reportes_escrituras_disco = [0]
+
+
+class _Vuelo:
+    def __init__(self, clave):
+        self.clave = clave
+        self.listo = threading.Event()
+        self.cuerpo = None
+        self.error = None
+
+
+def _version_rango(cur, fecha_desde=None, fecha_hasta=None, locales=None):
+    """Version de datos de un rango de fechas (y locales): suma de las versiones de sus slices.
+    Cada version solo crece, asi que cualquier escritura en el rango cambia la suma, aunque
+    commitee despues de otra con numero mayor."""
+    locales = [l for l in (locales or []) if l] or None
+    cur.execute("""
+        SELECT COALESCE(SUM(version), 0) AS version FROM goti.versiones_datos
+        WHERE (%s::date IS NULL OR fecha >= %s::date) AND (%s::date IS NULL OR fecha <= %s::date)
+          AND (%s::text[] IS NULL OR local = ANY(%s::text[]))
+    """, (fecha_desde, fecha_desde, fecha_hasta, fecha_hasta, locales, locales))
+    return cur.fetchone()['version']
+
+
+def _clave_reporte(version, args=None):
+    """(endpoint, parametros sin vacios y en orden, version)"""
+    args = request.args if args is None else args
+    params = tuple(sorted((k, tuple(sorted(v for v in args.getlist(k) if v)))
+                          for k in set(args.keys())))
+    return (request.endpoint, tuple(p for p in params if p[1]), str(version))
+
+
+def _archivo_reporte(clave):
+    return os.path.join(REPORTES_CACHE_DIR, hashlib.sha256(repr(clave).encode('utf-8')).hexdigest() + '.json')
+
+
+def _disco_leer(clave):
+    if not REPORTES_CACHE_DIR:
+        return None
+    ruta = _archivo_reporte(clave)
+    try:
+        with open(ruta, 'r', encoding='utf-8') as f:
+            cuerpo = f.read()
+        os.utime(ruta)  # mtime = ultimo uso, para podar los menos usados
+        return cuerpo
+    except OSError:
+        return None
+
+
+def _disco_guardar(clave, cuerpo):
+    if not REPORTES_CACHE_DIR:
+        return
+    try:
+        os.makedirs(REPORTES_CACHE_DIR, exist_ok=True)
+        ruta = _archivo_reporte(clave)
+        tmp = f'{ruta}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(cuerpo)
+        os.replace(tmp, ruta)
+        _reportes_escrituras_disco[0] += 1
+        if _reportes_escrituras_disco[0] % 50 == 0:
+            _disco_podar()
+    except OSError as e:
+        print(f"Cache de reportes en disco: {e}")
+
+
+def _disco_podar():
+    """Borra los archivos menos usados hasta quedar bajo REPORTES_DISCO_MB"""
+    archivos = []
+    for nombre in os.listdir(REPORTES_CACHE_DIR):
+        if nombre.endswith('.json'):
+            try:
+                st = os.stat(os.path.join(REPORTES_CACHE_DIR, nombre))
+                archivos.append((st.st_mtime, st.st_size, nombre))
+            except OSError:
+                pass
+    total = sum(a[1] for a in archivos)
+    limite = REPORTES_DISCO_MB * 1024 * 1024
+    for _, tam, nombre in sorted(archivos):
+        if total <= limite:
+            break
+        try:
+            os.remove(os.path.join(REPORTES_CACHE_DIR, nombre))
+            total -= tam
+        except OSError:
+            pass
+
+
+def _cache_guardar(clave, expira, cuerpo):
+    """Guarda en el LRU de memoria (con _reportes_lock tomado)"""
+    anterior = _reportes_cache.pop(clave, None)
+    if anterior:
+        _reportes_bytes[0] -= len(anterior[1])
+    _reportes_cache[clave] = (expira, cuerpo)
+    _reportes_bytes[0] += len(cuerpo)
+    limite = REPORTES_CACHE_MB * 1024 * 1024
+    while _reportes_bytes[0] > limite and len(_reportes_cache) > 1:
+        _, (_, viejo) = _reportes_cache.popitem(last=False)
+        _reportes_bytes[0] -= len(viejo)
+
+
+def _esperar_vuelo(vuelo):
+    """Espera el calculo de otro request sin tener conexion ni cuota.
+    Devuelve su response, o None si no termino a tiempo (el que espera calcula por su cuenta)."""
+    if not vuelo.listo.wait(REPORTES_ESPERA):
+        return None
+    if isinstance(vuelo.error, SinCapacidad):
+        return _respuesta_ocupado(vuelo.error.clase)
+    if vuelo.error is not None:
+        raise vuelo.error
+    return _respuesta_reporte(vuelo.clave, vuelo.cuerpo)
+
+
+def _con_reserva(clase, funcion):
+    """funcion(conn) con una conexion de la cuota de `clase`, reservada solo mientras corre"""
+    if not _reservar(clase):
+        raise SinCapacidad(clase)
+    conn = None
+    try:
+        conn = get_db()
+        return funcion(conn)
+    finally:
+        if conn:
+            release_db(conn)
+        _soltar_reserva()
+
+
+def _reporte_compartido(leer_version, calcular, ttl=None):
+    """Response JSON de calcular(conn) compartido entre requests con los mismos parametros.
+    leer_version(cur) da la version de los datos del reporte, que entra en la clave.
+    ttl=None: el resultado vale hasta que el LRU lo desaloje (tambien en disco). Con ttl: solo
+    esos segundos en memoria.
+    Conexiones: la version se lee con una de lectura; solo el lider toma una de pesado para
+    calcular. Quien encuentra el mismo calculo en curso lo espera sin conexion ni cuota (antes de
+    leer la version: comparte el resultado de un calculo que empezo a lo sumo mientras llegaba).
+    Los errores no se guardan: se propagan a quienes esperaban y el siguiente request reintenta."""
+    parametros = _clave_reporte(None)[:2]
+    with _reportes_lock:
+        vuelo = _reportes_en_vuelo.get(parametros)
+    if vuelo is not None:
+        resp = _esperar_vuelo(vuelo)
+        if resp is not None:
+            return resp
+
+    def version_y_commit(conn):
+        version = leer_version(conn.cursor())
+        conn.commit()
+        return version
+    try:
+        clave = _clave_reporte(_con_reserva('lectura', version_y_commit))
+    except SinCapacidad as e:
+        return _respuesta_ocupado(e.clase)
+
+    with _reportes_lock:
+        guardado = _reportes_cache.get(clave)
+        if guardado and (guardado[0] is None or guardado[0] > time.monotonic()):
+            _reportes_cache.move_to_end(clave)
+            return _respuesta_reporte(clave, guardado[1])
+        vuelo = _reportes_en_vuelo.get(clave)
+        lider = vuelo is None
+        if lider:
+            vuelo = _Vuelo(clave)
+            _reportes_en_vuelo[clave] = _reportes_en_vuelo[parametros] = vuelo
+
+    if not lider:
+        resp = _esperar_vuelo(vuelo)
+        if resp is not None:
+            return resp
+        try:
+            return _respuesta_reporte(clave, app.json.dumps(_con_reserva('pesado', calcular)))
+        except SinCapacidad as e:
+            return _respuesta_ocupado(e.clase)
+
+    en_disco = False
+    try:
+        if ttl is None:
+            vuelo.cuerpo = _disco_leer(clave)
+            en_disco = vuelo.cuerpo is not None
+        if vuelo.cuerpo is None:
+            vuelo.cuerpo = app.json.dumps(_con_reserva('pesado', calcular))
+    except SinCapacidad as e:
+        vuelo.error = e
+        return _respuesta_ocupado(e.clase)
+    except Exception as e:
+        vuelo.error = e
+        raise
+    finally:
+        with _reportes_lock:
+            for k in (clave, parametros):
+                if _reportes_en_vuelo.get(k) is vuelo:
+                    del _reportes_en_vuelo[k]
+            if vuelo.cuerpo is not None and (ttl is None or ttl > 0):
+                _cache_guardar(clave, None if ttl is None else time.monotonic() + ttl, vuelo.cuerpo)
+        vuelo.listo.set()
+    if ttl is None and not en_disco:
+        _disco_guardar(clave, vuelo.cuerpo)
+    return _respuesta_reporte(clave, vuelo.cuerpo)
+
+
+def _respuesta_reporte(clave, cuerpo):
+    # El cuerpo es el mismo para toda la clave: la version comprimida tambien se reutiliza
+    _respuesta_cacheada(('reporte',) + clave)
+    return app.response_class(cuerpo, mimetype='application/json')
+
+
+# ==================== PARTICIONES MENSUALES DE CONTEOS ====================
+# Con la tabla ya particionada (sql/particionar_conteos.sql) se mantienen creados el mes
+# actual y los CONTEOS_MESES_ADELANTE siguientes: al arrancar y una vez por dia.
+CONTEOS_MESES_ADELANTE = int(os.environ.get('CONTEOS_MESES_ADELANTE', '3'))
+
+
+def _crear_particiones_conteos(cur):
+    """Crea las particiones que falten; no hace nada si la tabla no esta particionada"""
+    cur.execute("""
+        SELECT 1 FROM pg_partitioned_table
+        WHERE partrelid = to_regclass('goti.inventario_ciego_conteos')
+    """)
+    if not cur.fetchone():
+        return 0
+    cur.execute("""
+        SELECT goti.crear_particiones_conteos(
+            date_trunc('month', CURRENT_DATE)::date,
+            (date_trunc('month', CURRENT_DATE) + %s * INTERVAL '1 month')::date) AS creadas
+    """, (CONTEOS_MESES_ADELANTE,))
+    creadas = cur.fetchone()['creadas']
+    if creadas:
+        print(f'Particiones de conteos creadas: {creadas}')
+    return creadas
+
+
+def _mantener_particiones():
+    while True:
+        time.sleep(24 * 3600)
+        conn = None
+        try:
+            conn = get_db()
+            _crear_particiones_conteos(conn.cursor())
+            conn.commit()
+        except Exception as e:
+            print(f'Error creando particiones de conteos: {e}')
+        finally:
+            if conn:
+                release_db(conn)
+
+
+# False si init_db no pudo crear los indices unicos de asignacion_semanal(_personas):
+# asignar_semana no puede usar ON CONFLICT y reemplaza las filas bajo lock de la semana
+_asig_semanal_unica = True
+
+
 def init_db():
     """Crea tabla merma_operativa y migra asignacion_diferencias al startup"""
     conn = None
@@ -113,6 +1523,15 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Columnas de conteos que antes se aseguraban en cada /api/inventario/consultar
+        cur.execute("""
+            ALTER TABLE goti.inventario_ciego_conteos
+                ADD COLUMN IF NOT EXISTS observaciones TEXT,
+                ADD COLUMN IF NOT EXISTS motivo TEXT,
+                ADD COLUMN IF NOT EXISTS corregido BOOLEAN DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS justificado BOOLEAN DEFAULT FALSE,
+                ADD COLUMN IF NOT EXISTS cantidad_justificada NUMERIC(12,4) DEFAULT 0
+        """)
         cur.execute("""
             ALTER TABLE goti.asignacion_diferencias
                 ADD COLUMN IF NOT EXISTS codigo VARCHAR(50),
@@ -162,6 +1581,10 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Optimiza: listar_bajas (agrupacion por baja_grupo y filtro fecha + local)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_bajas_directas_grupo ON goti.bajas_directas (baja_grupo)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_bajas_directas_fecha_local ON goti.bajas_directas (fecha, local)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_bajas_asignaciones_grupo ON goti.bajas_asignaciones (baja_grupo)")
         # ---- Tablas para Asignación por Sección (prototipo) ----
         cur.execute("""
             CREATE TABLE IF NOT EXISTS goti.asignacion_seccion (
@@ -198,6 +1621,9 @@ def init_db():
                 monto NUMERIC(12,2)
             )
         """)
+        # Optimiza: listar_secciones_conteo (productos/personas por seccion)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_asig_seccion_productos_seccion ON goti.asig_seccion_productos (seccion_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_asig_seccion_personas_seccion ON goti.asig_seccion_personas (seccion_id)")
         # ---- Tablas para Asignacion Semanal ----
         cur.execute("""
             CREATE TABLE IF NOT EXISTS goti.semanas_inventario (
@@ -235,6 +1661,177 @@ def init_db():
                 monto NUMERIC(12,2) DEFAULT 0
             )
         """)
+        # Unicidad (semana, codigo) y (asignacion, persona) para el upsert de asignar_semana.
+        # Si hay duplicados previos se fusionan: personas a la fila de mayor id, montos sumados.
+        cur.execute("SELECT to_regclass('goti.uq_asignacion_semanal_codigo') AS idx")
+        if cur.fetchone()['idx'] is None:
+            try:
+                cur.execute("SAVEPOINT migrate_asig_semanal")
+                cur.execute("""
+                    WITH dup AS (
+                        SELECT id, MAX(id) OVER (PARTITION BY semana_id, codigo) AS conservar
+                        FROM goti.asignacion_semanal
+                    )
+                    UPDATE goti.asignacion_semanal_personas ap
+                    SET asignacion_semanal_id = dup.conservar
+                    FROM dup
+                    WHERE ap.asignacion_semanal_id = dup.id AND dup.id <> dup.conservar
+                """)
+                cur.execute("""
+                    DELETE FROM goti.asignacion_semanal a
+                    USING goti.asignacion_semanal b
+                    WHERE a.semana_id = b.semana_id AND a.codigo = b.codigo AND a.id < b.id
+                """)
+                cur.execute("""
+                    WITH tot AS (
+                        SELECT MAX(id) AS conservar, SUM(cantidad) AS cantidad, SUM(monto) AS monto
+                        FROM goti.asignacion_semanal_personas
+                        GROUP BY asignacion_semanal_id, persona
+                        HAVING COUNT(*) > 1
+                    )
+                    UPDATE goti.asignacion_semanal_personas ap
+                    SET cantidad = tot.cantidad, monto = tot.monto
+                    FROM tot WHERE ap.id = tot.conservar
+                """)
+                cur.execute("""
+                    DELETE FROM goti.asignacion_semanal_personas a
+                    USING goti.asignacion_semanal_personas b
+                    WHERE a.asignacion_semanal_id = b.asignacion_semanal_id
+                      AND a.persona = b.persona AND a.id < b.id
+                """)
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS uq_asignacion_semanal_personas
+                    ON goti.asignacion_semanal_personas (asignacion_semanal_id, persona)
+                """)
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS uq_asignacion_semanal_codigo
+                    ON goti.asignacion_semanal (semana_id, codigo)
+                """)
+                cur.execute("RELEASE SAVEPOINT migrate_asig_semanal")
+            except Exception as e:
+                global _asig_semanal_unica
+                _asig_semanal_unica = False
+                print('=' * 70)
+                print(f'init_db: NO se pudo crear unicidad de asignacion_semanal: {e}')
+                print('init_db: asignar_semana usa el guardado sin upsert hasta que se corrija')
+                print('=' * 70)
+                cur.execute("ROLLBACK TO SAVEPOINT migrate_asig_semanal")
+        # ---- Snapshot congelado del neteo semanal (se llena en cerrar_semana) ----
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS goti.semana_snapshot (
+                semana_id INT PRIMARY KEY,
+                productos INT DEFAULT 0,
+                total_diferencia NUMERIC(14,4) DEFAULT 0,
+                total_valorizado NUMERIC(14,2) DEFAULT 0,
+                generado_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS goti.semana_snapshot_productos (
+                id SERIAL PRIMARY KEY,
+                semana_id INT NOT NULL,
+                codigo VARCHAR(50) NOT NULL,
+                nombre VARCHAR(150),
+                unidad VARCHAR(20),
+                diferencia NUMERIC,
+                costo_unitario NUMERIC,
+                dias_contados INT,
+                justificado BOOLEAN,
+                total_justificado NUMERIC,
+                tiene_correccion BOOLEAN,
+                detalle_diario JSONB
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_semana_snapshot_productos_semana ON goti.semana_snapshot_productos (semana_id)")
+        cur.execute("SELECT to_regclass('goti.uq_semana_snapshot_productos') AS idx")
+        if cur.fetchone()['idx'] is None:
+            # Snapshots duplicados por materializaciones concurrentes: se descartan y se
+            # vuelven a generar en la siguiente lectura
+            cur.execute("""
+                WITH dup AS (
+                    SELECT DISTINCT semana_id FROM goti.semana_snapshot_productos
+                    GROUP BY semana_id, codigo HAVING COUNT(*) > 1
+                ), borrados AS (
+                    DELETE FROM goti.semana_snapshot_productos WHERE semana_id IN (SELECT semana_id FROM dup)
+                )
+                DELETE FROM goti.semana_snapshot WHERE semana_id IN (SELECT semana_id FROM dup)
+            """)
+            cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_semana_snapshot_productos
+                ON goti.semana_snapshot_productos (semana_id, codigo)
+            """)
+        # ---- Estadisticas por semana (mantenidas por conteos, asignar y cerrar) ----
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS goti.semanas_stats (
+                semana_id INT PRIMARY KEY,
+                productos_contados INT DEFAULT 0,
+                total_asignado NUMERIC(14,2) DEFAULT 0,
+                total_diferencia_valorizada NUMERIC(14,2),
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Optimiza: listar_semanas (filtro por local, orden y keyset por fecha_inicio)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_semanas_local_inicio ON goti.semanas_inventario (local, fecha_inicio DESC)")
+        # Semanas sin fila de stats (creadas antes de la tabla): calcular una sola vez
+        cur.execute(f"""
+            INSERT INTO goti.semanas_stats
+                (semana_id, productos_contados, total_asignado, total_diferencia_valorizada)
+            SELECT s.id, {_SQL_STATS_SEMANA['productos_contados']},
+                   {_SQL_STATS_SEMANA['total_asignado']},
+                   {_SQL_STATS_SEMANA['total_diferencia_valorizada']}
+            FROM goti.semanas_inventario s
+            WHERE NOT EXISTS (SELECT 1 FROM goti.semanas_stats st WHERE st.semana_id = s.id)
+        """)
+        # ---- Ledger de descuentos por persona (append-only, se escribe al cerrar semana) ----
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS goti.descuentos_ledger (
+                id BIGSERIAL PRIMARY KEY,
+                persona VARCHAR(100) NOT NULL,
+                semana_id INT NOT NULL,
+                fecha_inicio DATE NOT NULL,
+                fecha_fin DATE NOT NULL,
+                local VARCHAR(50) NOT NULL,
+                codigo VARCHAR(50) NOT NULL,
+                nombre VARCHAR(150),
+                unidad VARCHAR(20),
+                cantidad NUMERIC(12,4) NOT NULL DEFAULT 0,
+                monto NUMERIC(12,2) NOT NULL DEFAULT 0,
+                costo_unitario NUMERIC(12,4),
+                diferencia_semanal NUMERIC(12,4),
+                reversa_de BIGINT,
+                saldo_persona NUMERIC(14,2) NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Un cargo se reversa a lo sumo una vez (y el indice resuelve el anti-join de vigentes)
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_descuentos_ledger_reversa ON goti.descuentos_ledger (reversa_de) WHERE reversa_de IS NOT NULL")
+        # Optimiza: descuentos_reporte / exportar-excel / resumen-personas (filtros fecha + local, por persona)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_descuentos_ledger_local_fecha
+            ON goti.descuentos_ledger (local, fecha_inicio, fecha_fin)
+            INCLUDE (persona, semana_id, cantidad, monto) WHERE reversa_de IS NULL
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_descuentos_ledger_fecha
+            ON goti.descuentos_ledger (fecha_inicio, fecha_fin)
+            INCLUDE (persona, semana_id, local, cantidad, monto) WHERE reversa_de IS NULL
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_descuentos_ledger_persona_fecha
+            ON goti.descuentos_ledger (persona, fecha_inicio)
+            INCLUDE (local, semana_id, cantidad, monto) WHERE reversa_de IS NULL
+        """)
+        # Ultimo saldo por persona y cargos por semana
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_descuentos_ledger_persona_id ON goti.descuentos_ledger (persona, id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_descuentos_ledger_semana ON goti.descuentos_ledger (semana_id)")
+        cur.execute("""
+            CREATE OR REPLACE VIEW goti.descuentos_vigentes AS
+            SELECT l.* FROM goti.descuentos_ledger l
+            WHERE l.reversa_de IS NULL
+              AND NOT EXISTS (SELECT 1 FROM goti.descuentos_ledger r WHERE r.reversa_de = l.id)
+        """)
+        # Semanas cerradas antes de existir el ledger
+        _ledger_registrar_cargos(cur)
         # ---- Columnas de auditoria: quien contó y quien modificó ----
         cur.execute("""
             ALTER TABLE goti.inventario_ciego_conteos
@@ -371,6 +1968,190 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # Optimiza: listados paginados por keyset (cuadres, delivery, facturas)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_cuadres_caja_fecha_local ON goti.cuadres_caja (fecha DESC, local, id)")
+        # ---- Observaciones manuales (antes se aseguraba en cada GET) ----
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS goti.observaciones_manuales (
+                id SERIAL PRIMARY KEY,
+                fecha DATE NOT NULL,
+                local VARCHAR(100) NOT NULL,
+                codigo VARCHAR(50),
+                nombre VARCHAR(255) NOT NULL,
+                diferencia NUMERIC(12,3) DEFAULT 0,
+                motivo TEXT,
+                observaciones TEXT,
+                corregido BOOLEAN DEFAULT FALSE,
+                justificado BOOLEAN DEFAULT FALSE,
+                creado_por VARCHAR(100),
+                creado_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        cur.execute("ALTER TABLE goti.observaciones_manuales ADD COLUMN IF NOT EXISTS justificado BOOLEAN DEFAULT FALSE")
+        # ---- Cola offline: claves de idempotencia de /api/inventario/sincronizar ----
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS goti.sync_operaciones (
+                clave VARCHAR(64) PRIMARY KEY,
+                conteo_id INTEGER,
+                resultado VARCHAR(20),
+                procesado_at TIMESTAMP DEFAULT NOW()
+            )
+        """)
+        cur.execute("DELETE FROM goti.sync_operaciones WHERE procesado_at < NOW() - INTERVAL '30 days'")
+        # ---- Version por (fecha, local) para ETag ----
+        cur.execute("CREATE SEQUENCE IF NOT EXISTS goti.versiones_datos_seq")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS goti.versiones_datos (
+                fecha DATE NOT NULL,
+                local VARCHAR(100) NOT NULL,
+                version BIGINT NOT NULL,
+                actualizado_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (fecha, local)
+            )
+        """)
+        # Una transaccion toma el numero (y el lock de la fila del slice) en su primera
+        # escritura y lo reutiliza en las siguientes: las versiones quedan en orden de commit.
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION goti.tocar_version(p_fecha DATE, p_local TEXT) RETURNS BIGINT AS $$
+            DECLARE
+                clave TEXT;
+                v TEXT;
+            BEGIN
+                IF p_fecha IS NULL OR p_local IS NULL THEN
+                    RETURN NULL;
+                END IF;
+                clave := 'goti.v' || md5(p_fecha::text || '|' || p_local);
+                v := current_setting(clave, true);
+                IF v IS NULL OR v = '' THEN
+                    INSERT INTO goti.versiones_datos (fecha, local, version)
+                    VALUES (p_fecha, p_local, nextval('goti.versiones_datos_seq'))
+                    ON CONFLICT (fecha, local) DO UPDATE
+                        SET version = nextval('goti.versiones_datos_seq'), actualizado_at = NOW()
+                    RETURNING version::text INTO v;
+                    PERFORM set_config(clave, v, true);
+                END IF;
+                RETURN v::bigint;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION goti.trg_version_fecha_local() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    PERFORM goti.tocar_version(OLD.fecha, OLD.local);
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    PERFORM goti.tocar_version(NEW.fecha, NEW.local);
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        # Tablas hijas sin fecha/local: TG_ARGV = (tabla padre, columna FK)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION goti.trg_version_por_padre() RETURNS trigger AS $$
+            DECLARE
+                padre_id INT;
+                f DATE;
+                l TEXT;
+            BEGIN
+                FOR padre_id IN
+                    SELECT DISTINCT x FROM unnest(ARRAY[
+                        CASE WHEN TG_OP <> 'INSERT' THEN (to_jsonb(OLD) ->> TG_ARGV[1])::int END,
+                        CASE WHEN TG_OP <> 'DELETE' THEN (to_jsonb(NEW) ->> TG_ARGV[1])::int END]) x
+                    WHERE x IS NOT NULL
+                LOOP
+                    EXECUTE format('SELECT fecha, local FROM %s WHERE id = $1', TG_ARGV[0])
+                        INTO f, l USING padre_id;
+                    PERFORM goti.tocar_version(f, l);
+                END LOOP;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        # ---- row_version por conteo (delta sync: /api/inventario/cambios) ----
+        cur.execute("ALTER TABLE goti.inventario_ciego_conteos ADD COLUMN IF NOT EXISTS row_version BIGINT NOT NULL DEFAULT 0")
+        cur.execute("ALTER TABLE goti.versiones_datos ADD COLUMN IF NOT EXISTS ultimo_borrado BIGINT NOT NULL DEFAULT 0")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conteos_row_version
+            ON goti.inventario_ciego_conteos (fecha, local, row_version)
+        """)
+        # Cualquier cambio de la fila sube row_version (incluye stock, correcciones y costo): todo lo que
+        # mueve la version del slice desde esta tabla tiene que aparecer en /cambios. Un UPDATE que no
+        # cambia nada no la sube
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION goti.trg_conteo_row_version() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT'
+                   OR to_jsonb(NEW) - 'row_version' IS DISTINCT FROM to_jsonb(OLD) - 'row_version' THEN
+                    NEW.row_version := goti.tocar_version(NEW.fecha, NEW.local);
+                END IF;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION goti.trg_conteo_borrado() RETURNS trigger AS $$
+            DECLARE
+                v BIGINT;
+            BEGIN
+                -- Primero la version (crea la fila del slice si no existe), despues el UPDATE:
+                -- tocar_version dentro del SET modificaria la misma fila que se esta actualizando
+                v := goti.tocar_version(OLD.fecha, OLD.local);
+                IF v IS NOT NULL THEN
+                    UPDATE goti.versiones_datos
+                    SET ultimo_borrado = v
+                    WHERE fecha = OLD.fecha AND local = OLD.local;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS trg_row_version ON goti.inventario_ciego_conteos")
+        cur.execute("""
+            CREATE TRIGGER trg_row_version BEFORE INSERT OR UPDATE ON goti.inventario_ciego_conteos
+            FOR EACH ROW EXECUTE FUNCTION goti.trg_conteo_row_version()
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS trg_borrado ON goti.inventario_ciego_conteos")
+        cur.execute("""
+            CREATE TRIGGER trg_borrado AFTER DELETE ON goti.inventario_ciego_conteos
+            FOR EACH ROW EXECUTE FUNCTION goti.trg_conteo_borrado()
+        """)
+        for tabla, funcion in (
+                ('inventario_ciego_conteos', 'goti.trg_version_fecha_local()'),
+                ('observaciones_manuales', 'goti.trg_version_fecha_local()'),
+                ('asignacion_seccion', 'goti.trg_version_fecha_local()'),
+                ('asignacion_diferencias', "goti.trg_version_por_padre('goti.inventario_ciego_conteos', 'conteo_id')"),
+                ('asig_seccion_productos', "goti.trg_version_por_padre('goti.asignacion_seccion', 'seccion_id')"),
+                ('asig_seccion_personas', "goti.trg_version_por_padre('goti.asignacion_seccion', 'seccion_id')")):
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_version ON goti.{tabla}")
+            cur.execute(f"""
+                CREATE TRIGGER trg_version AFTER INSERT OR UPDATE OR DELETE ON goti.{tabla}
+                FOR EACH ROW EXECUTE FUNCTION {funcion}
+            """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_delivery_fecha_local ON goti.delivery_liquidaciones (fecha DESC, local, plataforma, id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_facturas_fecha_local ON goti.facturas_registro (fecha_emision DESC, local, id)")
+        # ---- Consultas de conteos sin filtro de fecha: indices parciales chicos ----
+        # (en la tabla particionada se crean uno por mes; ver sql/particionar_conteos.sql)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conteos_motivo ON goti.inventario_ciego_conteos (motivo)
+            WHERE motivo IS NOT NULL AND motivo != ''
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conteos_contado_por ON goti.inventario_ciego_conteos (contado_por)
+            WHERE contado_por IS NOT NULL AND contado_por != ''
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conteos_sin_costo ON goti.inventario_ciego_conteos (nombre)
+            WHERE costo_unitario IS NULL OR costo_unitario = 0
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conteos_con_diferencia
+            ON goti.inventario_ciego_conteos (local, codigo, nombre)
+            WHERE COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+              AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
+        """)
+        _crear_particiones_conteos(cur)
 
         conn.commit()
         print('init_db: tablas OK')
@@ -398,14 +2179,9 @@ BODEGAS_NOMBRES = {
 
 # ==================== RUTAS ESTATICAS ====================
 
-@app.route('/')
-def index():
+def _html_index(personas):
+    """index.html con las personas inyectadas (tambien lo usa el modo ASGI)"""
     import json as json_lib, base64
-    # Inyectar personas directamente en el HTML como JSON en data attribute (evita problemas de encoding en script)
-    try:
-        personas = _obtener_personas()
-    except Exception:
-        personas = _personas_cache['datos'] if _personas_cache['datos'] else []
     html_path = os.path.join(app.static_folder, 'index.html')
     with open(html_path, 'r', encoding='utf-8') as f:
         html = f.read()
@@ -417,6 +2193,18 @@ def index():
     html = html.replace('</head>', inject + '</head>')
     return html
 
+
+@app.route('/')
+def index():
+    # Inyectar personas directamente en el HTML como JSON en data attribute (evita problemas de encoding en script)
+    try:
+        personas = _obtener_personas()
+    except Exception:
+        personas = _personas_cache['datos'] if _personas_cache['datos'] else []
+    html_path = os.path.join(app.static_folder, 'index.html')
+    _respuesta_cacheada(('index', _personas_cache['timestamp'], os.stat(html_path).st_mtime_ns))
+    return _html_index(personas)
+
 @app.route('/establecer-clave')
 def pagina_establecer_clave():
     """Pagina publica donde el usuario establece su contrasena."""
@@ -582,6 +2370,73 @@ def api_personas():
     finally:
         if conn: release_db(conn)
 
+# Filas de conteo tal como las ve la tablet (row_version es la precondicion de las escrituras)
+_SQL_CONTEOS_BASE = """
+    SELECT c.id, c.row_version, c.codigo, c.nombre, c.unidad, c.cantidad, c.cantidad_contada, c.cantidad_contada_2,
+           c.observaciones,
+           COALESCE(c.motivo, '') as motivo,
+           COALESCE(c.corregido, FALSE) as corregido,
+           COALESCE(c.justificado, FALSE) as justificado,
+           COALESCE(c.cantidad_justificada, 0) as cantidad_justificada,
+           COALESCE(c.costo_unitario, 0) as costo_unitario,
+           c.contado_por,
+           c.contado2_por,
+           u1.nombre as contado_por_nombre,
+           u2.nombre as contado2_por_nombre,
+           c.contado_at,
+           c.contado2_at
+    FROM goti.inventario_ciego_conteos c
+    LEFT JOIN goti.usuarios u1 ON u1.username = c.contado_por
+    LEFT JOIN goti.usuarios u2 ON u2.username = c.contado2_por
+"""
+_SQL_CONTEOS_SLICE = _SQL_CONTEOS_BASE + " WHERE c.fecha = %s AND c.local = %s"
+
+
+class PrecondicionInvalida(ValueError):
+    pass
+
+
+def _precondicion_version(data):
+    """row_version esperado por el cliente (None = escritura sin precondicion)."""
+    valor = data.get('row_version')
+    if valor is None:
+        return None
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise PrecondicionInvalida('row_version invalido')
+
+
+def _conteos_actuales(cur, ids):
+    """{id: fila} con el estado actual de los conteos (cuerpo de las respuestas de conflicto)."""
+    if not ids:
+        return {}
+    cur.execute(_SQL_CONTEOS_BASE + " WHERE c.id = ANY(%s)", (list(ids),))
+    return {r['id']: r for r in cur.fetchall()}
+
+
+def _respuesta_conflicto(cur, id_producto):
+    """409 con la fila vigente si el conteo existe pero su row_version ya no coincide; 404 si no existe."""
+    actual = _conteos_actuales(cur, [id_producto]).get(id_producto)
+    if actual is None:
+        return jsonify({'error': 'Producto no encontrado'}), 404
+    return jsonify({'error': 'El conteo fue modificado por otro usuario', 'conflicto': True,
+                    'actual': actual}), 409
+
+
+def _leer_conteos_slice(conn, fecha, local, columnar=False):
+    """Productos del slice: lista de dicts, o tabla columnar (?format=columnar)"""
+    # Columnas observaciones/motivo/corregido/justificado: se crean en init_db
+    cur = _cursor_rapido(conn)
+    cur.execute(_SQL_CONTEOS_SLICE + " ORDER BY c.codigo", (fecha, local))
+    columnas = [d[0] for d in cur.description]
+    filas = cur.fetchall()
+    if columnar:
+        return _tabla_columnar(columnas, filas, ('unidad', 'motivo', 'contado_por', 'contado2_por',
+                                                 'contado_por_nombre', 'contado2_por_nombre'))
+    return [dict(zip(columnas, fila)) for fila in filas]
+
+
 @app.route('/api/inventario/consultar', methods=['GET'])
 def consultar_inventario():
     fecha = request.args.get('fecha')
@@ -593,50 +2448,22 @@ def consultar_inventario():
     conn = None
     try:
         conn = get_db()
-        cur = conn.cursor()
-
-        # Asegurar columnas: observaciones, motivo, corregido (auditoría) y justificado (no descontar)
-        cur.execute("""
-            ALTER TABLE goti.inventario_ciego_conteos
-            ADD COLUMN IF NOT EXISTS observaciones TEXT;
-            ALTER TABLE goti.inventario_ciego_conteos
-            ADD COLUMN IF NOT EXISTS motivo TEXT;
-            ALTER TABLE goti.inventario_ciego_conteos
-            ADD COLUMN IF NOT EXISTS corregido BOOLEAN DEFAULT FALSE;
-            ALTER TABLE goti.inventario_ciego_conteos
-            ADD COLUMN IF NOT EXISTS justificado BOOLEAN DEFAULT FALSE;
-            ALTER TABLE goti.inventario_ciego_conteos
-            ADD COLUMN IF NOT EXISTS cantidad_justificada NUMERIC(12,4) DEFAULT 0;
-        """)
-        conn.commit()
-
-        cur.execute("""
-            SELECT c.id, c.codigo, c.nombre, c.unidad, c.cantidad, c.cantidad_contada, c.cantidad_contada_2,
-                   c.observaciones,
-                   COALESCE(c.motivo, '') as motivo,
-                   COALESCE(c.corregido, FALSE) as corregido,
-                   COALESCE(c.justificado, FALSE) as justificado,
-                   COALESCE(c.cantidad_justificada, 0) as cantidad_justificada,
-                   COALESCE(c.costo_unitario, 0) as costo_unitario,
-                   c.contado_por,
-                   c.contado2_por,
-                   u1.nombre as contado_por_nombre,
-                   u2.nombre as contado2_por_nombre,
-                   c.contado_at,
-                   c.contado2_at
-            FROM goti.inventario_ciego_conteos c
-            LEFT JOIN goti.usuarios u1 ON u1.username = c.contado_por
-            LEFT JOIN goti.usuarios u2 ON u2.username = c.contado2_por
-            WHERE c.fecha = %s AND c.local = %s
-            ORDER BY c.codigo
-        """, (fecha, local))
-
-        productos = cur.fetchall()
+        # Personas vienen del cache en memoria: su timestamp tambien forma parte del ETag
+        version = _version_slice(conn.cursor(), fecha, local)
+        etag = _etag_version(version, int(_personas_cache['timestamp']), 'c' if _formato_columnar() else 'o')
+        no_modificado = _no_modificado(etag)
+        if no_modificado:
+            return no_modificado
 
         # Incluir personas del cache (nunca bloquea, solo datos en memoria)
         personas = _personas_cache['datos']
+        columnar = _formato_columnar()
+        productos = _leer_conteos_slice(conn, fecha, local, columnar)
 
-        return jsonify({'productos': productos, 'personas': personas})
+        if columnar:
+            return _con_etag(jsonify({'formato': 'columnar', 'productos': productos, 'personas': personas,
+                                      'version': version}), etag)
+        return _con_etag(jsonify({'productos': productos, 'personas': personas, 'version': version}), etag)
     except Exception as e:
         print(f"Error en /api/inventario/consultar: {e}")
         if conn:
@@ -649,6 +2476,44 @@ def consultar_inventario():
         if conn:
             release_db(conn)
 
+@app.route('/api/inventario/cambios', methods=['GET'])
+def inventario_cambios():
+    """Conteos de (fecha, local) cambiados despues de ?since=<version>.
+    recargar=True si se borraron filas desde esa version (el cliente debe pedir /consultar)."""
+    fecha = request.args.get('fecha')
+    local = request.args.get('local')
+    since = request.args.get('since', 0, type=int)
+    if not fecha or not local:
+        return jsonify({'error': 'Fecha y local son requeridos'}), 400
+
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        # Version antes que las filas: a lo sumo se reenvia una fila que el cliente ya tiene
+        cur.execute("""
+            SELECT version, ultimo_borrado FROM goti.versiones_datos
+            WHERE fecha = %s AND local = %s
+        """, (fecha, local))
+        fila = cur.fetchone()
+        version = fila['version'] if fila else 0
+        recargar = bool(fila) and fila['ultimo_borrado'] > since
+        if version <= since:
+            return jsonify({'version': version, 'cambios': [], 'recargar': recargar})
+
+        cur = _cursor_rapido(conn)
+        cur.execute(_SQL_CONTEOS_SLICE + " AND c.row_version > %s ORDER BY c.codigo", (fecha, local, since))
+        columnas = [d[0] for d in cur.description]
+        cambios = [dict(zip(columnas, f)) for f in cur.fetchall()]
+        return jsonify({'version': version, 'cambios': cambios, 'recargar': recargar})
+    except Exception as e:
+        print(f"Error en /api/inventario/cambios: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+    finally:
+        if conn:
+            release_db(conn)
+
+
 @app.route('/api/inventario/autofill-conteo2', methods=['POST'])
 def autofill_conteo2():
     """Auto-llena conteo 2 con conteo 1 para productos donde conteo1 == sistema"""
@@ -670,11 +2535,13 @@ def autofill_conteo2():
               AND cantidad_contada IS NOT NULL
               AND cantidad_contada_2 IS NULL
               AND cantidad_contada = cantidad
+            RETURNING id
         """, (fecha, local))
-        actualizados = cur.rowcount
+        ids = [r['id'] for r in cur.fetchall()]
         conn.commit()
 
-        return jsonify({'success': True, 'actualizados': actualizados})
+        # ids: el cliente copia conteo 1 a conteo 2 solo en las filas que cambio el servidor
+        return jsonify({'success': True, 'actualizados': len(ids), 'ids': ids})
     except Exception as e:
         print(f"Error en /api/inventario/autofill-conteo2: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
@@ -690,6 +2557,10 @@ def guardar_conteo():
     cantidad = data.get('cantidad_contada')
     conteo = data.get('conteo', 1)
     usuario = data.get('usuario', '')
+    try:
+        esperado = _precondicion_version(data)
+    except PrecondicionInvalida as e:
+        return jsonify({'error': str(e)}), 400
 
     conn = None
     try:
@@ -697,21 +2568,34 @@ def guardar_conteo():
         cur = conn.cursor()
 
         if conteo == 2:
-            cur.execute("""
-                UPDATE goti.inventario_ciego_conteos
-                SET cantidad_contada_2 = %s, contado2_por = %s, contado2_at = NOW()
-                WHERE id = %s
-            """, (cantidad, usuario or None, id_producto))
+            set_conteo = "cantidad_contada_2 = %s, contado2_por = %s, contado2_at = NOW()"
         else:
-            cur.execute("""
-                UPDATE goti.inventario_ciego_conteos
-                SET cantidad_contada = %s, contado_por = %s, contado_at = NOW()
-                WHERE id = %s
-            """, (cantidad, usuario or None, id_producto))
+            set_conteo = "cantidad_contada = %s, contado_por = %s, contado_at = NOW()"
+        cur.execute(f"""
+            WITH previo AS (
+                SELECT id, (cantidad_contada IS NOT NULL OR cantidad_contada_2 IS NOT NULL) AS contado
+                FROM goti.inventario_ciego_conteos
+                WHERE id = %s AND (%s::bigint IS NULL OR row_version = %s::bigint)
+                FOR UPDATE
+            )
+            UPDATE goti.inventario_ciego_conteos c
+            SET {set_conteo}
+            FROM previo
+            WHERE c.id = previo.id
+            RETURNING c.id, c.codigo, c.fecha, c.local, c.row_version, previo.contado AS antes,
+                      (c.cantidad_contada IS NOT NULL OR c.cantidad_contada_2 IS NOT NULL) AS ahora
+        """, (id_producto, esperado, esperado, cantidad, usuario or None))
+        fila = cur.fetchone()
+        if not fila and esperado is not None:
+            conn.rollback()
+            return _respuesta_conflicto(cur, id_producto)
+        # Solo cambia productos_contados de la semana si el producto paso de contado a no contado o viceversa
+        if fila:
+            _ajustar_contados_semana(cur, [fila])
 
         conn.commit()
 
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'row_version': fila['row_version'] if fila else None})
     except Exception as e:
         print(f"Error en /api/inventario/guardar-conteo: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
@@ -727,6 +2611,10 @@ def guardar_observacion():
     motivo = data.get('motivo', None)
     corregido = data.get('corregido', None)
     justificado = data.get('justificado', None)
+    try:
+        esperado = _precondicion_version(data)
+    except PrecondicionInvalida as e:
+        return jsonify({'error': str(e)}), 400
 
     conn = None
     try:
@@ -758,16 +2646,23 @@ def guardar_observacion():
             else:
                 sets.append("justificado = FALSE")
 
+        row_version = None
         if sets:
-            params.append(id_producto)
+            params.extend([id_producto, esperado, esperado])
             cur.execute(f"""
                 UPDATE goti.inventario_ciego_conteos
                 SET {', '.join(sets)}
-                WHERE id = %s
+                WHERE id = %s AND (%s::bigint IS NULL OR row_version = %s::bigint)
+                RETURNING row_version
             """, params)
+            fila = cur.fetchone()
+            if not fila and esperado is not None:
+                conn.rollback()
+                return _respuesta_conflicto(cur, id_producto)
+            row_version = fila['row_version'] if fila else None
         conn.commit()
 
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'row_version': row_version})
     except Exception as e:
         print(f"Error en /api/inventario/guardar-observacion: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
@@ -775,6 +2670,209 @@ def guardar_observacion():
         if conn:
             release_db(conn)
 
+SYNC_LOTE_MAX = 500
+_SYNC_CAMPOS_OBS = ('observaciones', 'motivo', 'corregido', 'justificado', 'cantidad_justificada')
+
+
+def _sync_aplicar_conteos(cur, conteo, ops):
+    """Aplica conteos offline con last-writer-wins sobre contado_at / contado2_at.
+    Si la operacion trae row_version, esa precondicion reemplaza a last-writer-wins.
+    ops: {id: op} (ya quedo el ultimo capturado por id).
+    Devuelve ({id: row_version nuevo} de los aplicados, slices que cambiaron de contado)."""
+    if conteo == 2:
+        cols = "cantidad_contada_2 = v.cantidad, contado2_por = NULLIF(v.usuario, ''), contado2_at = v.capturado"
+        col_at = "c.contado2_at"
+    else:
+        cols = "cantidad_contada = v.cantidad, contado_por = NULLIF(v.usuario, ''), contado_at = v.capturado"
+        col_at = "c.contado_at"
+    ids = list(ops)
+    # La hora de captura del cliente nunca queda en el futuro del servidor
+    cur.execute(f"""
+        WITH v AS (
+            SELECT x.id, x.cantidad, x.usuario, x.row_version,
+                   LEAST(x.capturado::timestamp, NOW()::timestamp) AS capturado
+            FROM unnest(%s::int[], %s::float8[], %s::text[], %s::timestamptz[], %s::bigint[])
+                 AS x(id, cantidad, usuario, capturado, row_version)
+        ),
+        previo AS (
+            SELECT c.id, (c.cantidad_contada IS NOT NULL OR c.cantidad_contada_2 IS NOT NULL) AS contado
+            FROM goti.inventario_ciego_conteos c JOIN v ON v.id = c.id
+            FOR UPDATE OF c
+        )
+        UPDATE goti.inventario_ciego_conteos c
+        SET {cols}
+        FROM v JOIN previo ON previo.id = v.id
+        WHERE c.id = v.id
+          AND CASE WHEN v.row_version IS NOT NULL THEN c.row_version = v.row_version
+                   ELSE {col_at} IS NULL OR {col_at} <= v.capturado END
+        RETURNING c.id, c.codigo, c.fecha, c.local, c.row_version, previo.contado AS antes,
+                  (c.cantidad_contada IS NOT NULL OR c.cantidad_contada_2 IS NOT NULL) AS ahora
+    """, (ids, [ops[i].get('cantidad_contada') for i in ids], [ops[i].get('usuario') or '' for i in ids],
+          [ops[i]['capturado_at'] for i in ids], [ops[i].get('row_version') for i in ids]))
+    filas = cur.fetchall()
+    return {r['id']: r['row_version'] for r in filas}, filas
+
+
+@app.route('/api/inventario/sincronizar', methods=['POST'])
+def sincronizar_conteos():
+    """Aplica un lote de la cola offline de la tablet (conteos y observaciones).
+    Cada operacion trae una clave de idempotencia: reenviar el mismo lote no repite cambios.
+    Body: {operaciones: [{clave, tipo: 'conteo'|'observacion', id, capturado_at, ...}]}
+    Un conteo puede traer row_version como precondicion en lugar de last-writer-wins.
+    Respuesta: {resultados: [{clave, resultado, row_version?, actual?}]} con resultado en
+    aplicado | obsoleto (hay un conteo mas nuevo) | conflicto (row_version no coincide, trae la fila
+    actual) | duplicado | no_encontrado | invalido"""
+    data = request.get_json(silent=True) or {}
+    operaciones = data.get('operaciones') or []
+    if len(operaciones) > SYNC_LOTE_MAX:
+        return jsonify({'error': f'Maximo {SYNC_LOTE_MAX} operaciones por lote'}), 400
+
+    resultados = {}
+    validas = []
+    for op in operaciones:
+        clave = str(op.get('clave') or '')[:64]
+        if not clave or clave in resultados:
+            continue
+        resultados[clave] = None
+        try:
+            op['id'] = int(op.get('id'))
+            if op.get('tipo') == 'conteo':
+                op['conteo'] = 2 if int(op.get('conteo') or 1) == 2 else 1
+                if op.get('cantidad_contada') is not None:
+                    op['cantidad_contada'] = float(op['cantidad_contada'])
+                if op.get('row_version') is not None:
+                    op['row_version'] = int(op['row_version'])
+                datetime.fromisoformat(str(op.get('capturado_at')).replace('Z', '+00:00'))
+            elif op.get('tipo') == 'observacion':
+                if op.get('cantidad_justificada') is not None:
+                    op['cantidad_justificada'] = float(op['cantidad_justificada'])
+            else:
+                raise ValueError('tipo')
+        except (TypeError, ValueError):
+            resultados[clave] = 'invalido'
+            continue
+        op['clave'] = clave
+        validas.append(op)
+
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        claves = [op['clave'] for op in validas]
+        # Reservar las claves: las ya vistas (o en proceso en otro request) quedan como duplicado
+        nuevas = set()
+        if claves:
+            cur.execute("""
+                INSERT INTO goti.sync_operaciones (clave, conteo_id)
+                SELECT * FROM unnest(%s::text[], %s::int[])
+                ON CONFLICT (clave) DO NOTHING
+                RETURNING clave
+            """, (claves, [op['id'] for op in validas]))
+            nuevas = {r['clave'] for r in cur.fetchall()}
+        pendientes = []
+        for op in validas:
+            if op['clave'] in nuevas:
+                pendientes.append(op)
+            else:
+                resultados[op['clave']] = 'duplicado'
+
+        ids = list({op['id'] for op in pendientes})
+        existentes = set()
+        if ids:
+            cur.execute("SELECT id FROM goti.inventario_ciego_conteos WHERE id = ANY(%s)", (ids,))
+            existentes = {r['id'] for r in cur.fetchall()}
+
+        # En orden de captura: por id gana el ultimo conteo y los campos de observacion se acumulan
+        pendientes.sort(key=lambda op: str(op.get('capturado_at') or ''))
+        conteos = {1: {}, 2: {}}
+        observaciones = {}
+        for op in pendientes:
+            if op['id'] not in existentes:
+                resultados[op['clave']] = 'no_encontrado'
+            elif op['tipo'] == 'conteo':
+                conteos[op['conteo']][op['id']] = op
+            else:
+                campos = observaciones.setdefault(op['id'], {})
+                for campo in _SYNC_CAMPOS_OBS:
+                    if op.get(campo) is not None:
+                        campos[campo] = op[campo]
+                # Igual que guardar-observacion: cantidad_justificada define justificado
+                if op.get('cantidad_justificada') is not None:
+                    campos['justificado'] = float(op['cantidad_justificada']) > 0
+
+        cambios_contados = []
+        versiones, conflictos = {}, set()
+        for conteo in (1, 2):
+            if not conteos[conteo]:
+                continue
+            aplicados, cambios = _sync_aplicar_conteos(cur, conteo, conteos[conteo])
+            cambios_contados.extend(cambios)
+            for op in pendientes:
+                if op['tipo'] == 'conteo' and op['conteo'] == conteo and op['id'] in conteos[conteo]:
+                    if op['id'] in aplicados:
+                        resultados[op['clave']] = 'aplicado'
+                        versiones[op['clave']] = aplicados[op['id']]
+                    elif conteos[conteo][op['id']].get('row_version') is not None:
+                        resultados[op['clave']] = 'conflicto'
+                        conflictos.add(op['id'])
+                    else:
+                        resultados[op['clave']] = 'obsoleto'
+
+        if observaciones:
+            ids_obs = list(observaciones)
+            cur.execute("""
+                UPDATE goti.inventario_ciego_conteos c
+                SET observaciones = COALESCE(v.observaciones, c.observaciones),
+                    motivo = COALESCE(v.motivo, c.motivo),
+                    corregido = COALESCE(v.corregido, c.corregido),
+                    justificado = COALESCE(v.justificado, c.justificado),
+                    cantidad_justificada = COALESCE(v.cantidad_justificada, c.cantidad_justificada)
+                FROM unnest(%s::int[], %s::text[], %s::text[], %s::boolean[], %s::boolean[], %s::float8[])
+                     AS v(id, observaciones, motivo, corregido, justificado, cantidad_justificada)
+                WHERE c.id = v.id
+            """, (ids_obs,
+                  [observaciones[i].get('observaciones') for i in ids_obs],
+                  [observaciones[i].get('motivo') for i in ids_obs],
+                  [None if observaciones[i].get('corregido') is None else bool(observaciones[i]['corregido'])
+                   for i in ids_obs],
+                  [None if observaciones[i].get('justificado') is None else bool(observaciones[i]['justificado'])
+                   for i in ids_obs],
+                  [None if observaciones[i].get('cantidad_justificada') is None
+                   else float(observaciones[i]['cantidad_justificada']) for i in ids_obs]))
+            for op in pendientes:
+                if op['tipo'] == 'observacion' and op['id'] in observaciones:
+                    resultados[op['clave']] = 'aplicado'
+
+        _ajustar_contados_semana(cur, cambios_contados)
+
+        if pendientes:
+            cur.execute("""
+                UPDATE goti.sync_operaciones s SET resultado = v.resultado
+                FROM unnest(%s::text[], %s::text[]) AS v(clave, resultado)
+                WHERE s.clave = v.clave
+            """, ([op['clave'] for op in pendientes], [resultados[op['clave']] for op in pendientes]))
+        conn.commit()
+
+        actuales = _conteos_actuales(cur, conflictos)
+        ids_por_clave = {op['clave']: op['id'] for op in pendientes}
+        salida = []
+        for c, r in resultados.items():
+            item = {'clave': c, 'resultado': r}
+            if c in versiones:
+                item['row_version'] = versiones[c]
+            elif r == 'conflicto':
+                item['actual'] = actuales.get(ids_por_clave[c])
+            salida.append(item)
+        return jsonify({'resultados': salida})
+    except Exception as e:
+        print(f"Error en /api/inventario/sincronizar: {e}")
+        if conn:
+            conn.rollback()
+        return jsonify({'error': 'Error interno del servidor'}), 500
+    finally:
+        if conn:
+            release_db(conn)
+
 # ==================== REPORTE MOTIVOS ====================
 
 @app.route('/api/reportes/motivos-lista', methods=['GET'])
@@ -797,112 +2895,115 @@ def reporte_motivos_lista():
         if conn: release_db(conn)
 
 
+def _calcular_motivos(conn, args):
+    fecha_desde = args.get('fecha_desde')
+    fecha_hasta = args.get('fecha_hasta')
+    bodegas = args.getlist('bodega')
+    bodegas = [b for b in bodegas if b]
+    producto = args.get('producto', '')
+    contador = args.get('contador', '').strip()
+    cur = conn.cursor()
+
+    # Asegurar columna motivo existe en conteos
+    cur.execute("""
+        ALTER TABLE goti.inventario_ciego_conteos
+        ADD COLUMN IF NOT EXISTS motivo TEXT
+    """)
+    conn.commit()
+
+    # Asegurar tabla manuales existe
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS goti.observaciones_manuales (
+            id SERIAL PRIMARY KEY,
+            fecha DATE NOT NULL,
+            local VARCHAR(100) NOT NULL,
+            codigo VARCHAR(50),
+            nombre VARCHAR(255) NOT NULL,
+            diferencia NUMERIC(12,3) DEFAULT 0,
+            motivo TEXT,
+            observaciones TEXT,
+            corregido BOOLEAN DEFAULT FALSE,
+            creado_por VARCHAR(100),
+            creado_at TIMESTAMP DEFAULT NOW()
+        )
+    """)
+    conn.commit()
+
+    # Motivos de conteos
+    query1 = """
+        SELECT motivo, COUNT(*) as cantidad
+        FROM goti.inventario_ciego_conteos
+        WHERE fecha >= %s AND fecha <= %s
+          AND motivo IS NOT NULL AND motivo != ''
+    """
+    params1 = [fecha_desde, fecha_hasta]
+    if producto:
+        query1 += " AND codigo = %s"
+        params1.append(producto)
+    if len(bodegas) == 1:
+        query1 += " AND local = %s"
+        params1.append(bodegas[0])
+    elif len(bodegas) > 1:
+        query1 += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
+        params1.extend(bodegas)
+    if contador:
+        query1 += " AND contado_por = %s"
+        params1.append(contador)
+    query1 += " GROUP BY motivo"
+
+    cur.execute(query1, params1)
+    motivos_conteo = cur.fetchall()
+
+    # Motivos de observaciones manuales
+    query2 = """
+        SELECT motivo, COUNT(*) as cantidad
+        FROM goti.observaciones_manuales
+        WHERE fecha >= %s AND fecha <= %s
+          AND motivo IS NOT NULL AND motivo != ''
+    """
+    params2 = [fecha_desde, fecha_hasta]
+    if producto:
+        query2 += " AND codigo = %s"
+        params2.append(producto)
+    if len(bodegas) == 1:
+        query2 += " AND local = %s"
+        params2.append(bodegas[0])
+    elif len(bodegas) > 1:
+        query2 += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
+        params2.extend(bodegas)
+    query2 += " GROUP BY motivo"
+
+    cur.execute(query2, params2)
+    motivos_manual = cur.fetchall()
+
+    # Combinar ambos
+    totales = {}
+    for m in motivos_conteo:
+        totales[m['motivo']] = totales.get(m['motivo'], 0) + m['cantidad']
+    for m in motivos_manual:
+        totales[m['motivo']] = totales.get(m['motivo'], 0) + m['cantidad']
+
+    resultado = [{'motivo': k, 'cantidad': v} for k, v in totales.items()]
+    resultado.sort(key=lambda x: x['cantidad'], reverse=True)
+    return resultado
+
+
 @app.route('/api/reportes/motivos', methods=['GET'])
 def reporte_motivos():
     fecha_desde = request.args.get('fecha_desde')
     fecha_hasta = request.args.get('fecha_hasta')
-    bodegas = request.args.getlist('bodega')
-    bodegas = [b for b in bodegas if b]
-    producto = request.args.get('producto', '')
-    contador = request.args.get('contador', '').strip()
 
     if not fecha_desde or not fecha_hasta:
         return jsonify({'error': 'fecha_desde y fecha_hasta requeridos'}), 400
 
-    conn = None
+    args = request.args
     try:
-        conn = get_db()
-        cur = conn.cursor()
-
-        # Asegurar columna motivo existe en conteos
-        cur.execute("""
-            ALTER TABLE goti.inventario_ciego_conteos
-            ADD COLUMN IF NOT EXISTS motivo TEXT
-        """)
-        conn.commit()
-
-        # Asegurar tabla manuales existe
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS goti.observaciones_manuales (
-                id SERIAL PRIMARY KEY,
-                fecha DATE NOT NULL,
-                local VARCHAR(100) NOT NULL,
-                codigo VARCHAR(50),
-                nombre VARCHAR(255) NOT NULL,
-                diferencia NUMERIC(12,3) DEFAULT 0,
-                motivo TEXT,
-                observaciones TEXT,
-                corregido BOOLEAN DEFAULT FALSE,
-                creado_por VARCHAR(100),
-                creado_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
-        conn.commit()
-
-        # Motivos de conteos
-        query1 = """
-            SELECT motivo, COUNT(*) as cantidad
-            FROM goti.inventario_ciego_conteos
-            WHERE fecha >= %s AND fecha <= %s
-              AND motivo IS NOT NULL AND motivo != ''
-        """
-        params1 = [fecha_desde, fecha_hasta]
-        if producto:
-            query1 += " AND codigo = %s"
-            params1.append(producto)
-        if len(bodegas) == 1:
-            query1 += " AND local = %s"
-            params1.append(bodegas[0])
-        elif len(bodegas) > 1:
-            query1 += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
-            params1.extend(bodegas)
-        if contador:
-            query1 += " AND contado_por = %s"
-            params1.append(contador)
-        query1 += " GROUP BY motivo"
-
-        cur.execute(query1, params1)
-        motivos_conteo = cur.fetchall()
-
-        # Motivos de observaciones manuales
-        query2 = """
-            SELECT motivo, COUNT(*) as cantidad
-            FROM goti.observaciones_manuales
-            WHERE fecha >= %s AND fecha <= %s
-              AND motivo IS NOT NULL AND motivo != ''
-        """
-        params2 = [fecha_desde, fecha_hasta]
-        if producto:
-            query2 += " AND codigo = %s"
-            params2.append(producto)
-        if len(bodegas) == 1:
-            query2 += " AND local = %s"
-            params2.append(bodegas[0])
-        elif len(bodegas) > 1:
-            query2 += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
-            params2.extend(bodegas)
-        query2 += " GROUP BY motivo"
-
-        cur.execute(query2, params2)
-        motivos_manual = cur.fetchall()
-
-        # Combinar ambos
-        totales = {}
-        for m in motivos_conteo:
-            totales[m['motivo']] = totales.get(m['motivo'], 0) + m['cantidad']
-        for m in motivos_manual:
-            totales[m['motivo']] = totales.get(m['motivo'], 0) + m['cantidad']
-
-        resultado = [{'motivo': k, 'cantidad': v} for k, v in totales.items()]
-        resultado.sort(key=lambda x: x['cantidad'], reverse=True)
-
-        return jsonify(resultado)
+        return _reporte_compartido(
+            lambda cur: _version_rango(cur, fecha_desde, fecha_hasta, args.getlist('bodega')),
+            lambda conn: _calcular_motivos(conn, args))
     except Exception as e:
         print(f"Error en /api/reportes/motivos: {e}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        if conn:
-            release_db(conn)
 
 @app.route('/api/reportes/diferencias-fecha', methods=['GET'])
 def reporte_diferencias_fecha():
@@ -1051,6 +3152,17 @@ def reporte_motivo_detalle():
 
 # ==================== OBSERVACIONES MANUALES ====================
 
+def _leer_obs_manuales(conn, fecha, local):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, codigo, nombre, diferencia, motivo, observaciones, corregido, COALESCE(justificado, FALSE) as justificado, creado_por
+        FROM goti.observaciones_manuales
+        WHERE fecha = %s AND local = %s
+        ORDER BY creado_at
+    """, (fecha, local))
+    return cur.fetchall()
+
+
 @app.route('/api/observaciones-manuales', methods=['GET'])
 def listar_obs_manuales():
     fecha = request.args.get('fecha')
@@ -1062,33 +3174,12 @@ def listar_obs_manuales():
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS goti.observaciones_manuales (
-                id SERIAL PRIMARY KEY,
-                fecha DATE NOT NULL,
-                local VARCHAR(100) NOT NULL,
-                codigo VARCHAR(50),
-                nombre VARCHAR(255) NOT NULL,
-                diferencia NUMERIC(12,3) DEFAULT 0,
-                motivo TEXT,
-                observaciones TEXT,
-                corregido BOOLEAN DEFAULT FALSE,
-                justificado BOOLEAN DEFAULT FALSE,
-                creado_por VARCHAR(100),
-                creado_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
-        # Asegurar columna justificado (migracion)
-        cur.execute("ALTER TABLE goti.observaciones_manuales ADD COLUMN IF NOT EXISTS justificado BOOLEAN DEFAULT FALSE")
-        conn.commit()
-
-        cur.execute("""
-            SELECT id, codigo, nombre, diferencia, motivo, observaciones, corregido, COALESCE(justificado, FALSE) as justificado, creado_por
-            FROM goti.observaciones_manuales
-            WHERE fecha = %s AND local = %s
-            ORDER BY creado_at
-        """, (fecha, local))
-        return jsonify(cur.fetchall())
+        # Tabla y columna justificado se aseguran en init_db
+        etag = _etag_slice(cur, fecha, local)
+        no_modificado = _no_modificado(etag)
+        if no_modificado:
+            return no_modificado
+        return _con_etag(jsonify(_leer_obs_manuales(conn, fecha, local)), etag)
     except Exception as e:
         print(f"Error en /api/observaciones-manuales GET: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1194,23 +3285,43 @@ def corregir_conteo():
 
     if id_producto is None:
         return jsonify({'error': 'id es requerido'}), 400
+    try:
+        esperado = _precondicion_version(data)
+    except PrecondicionInvalida as e:
+        return jsonify({'error': str(e)}), 400
 
     conn = None
     try:
         conn = get_db()
         cur = conn.cursor()
         cur.execute("""
-            UPDATE goti.inventario_ciego_conteos
-            SET cantidad = COALESCE(%s, cantidad),
+            WITH previo AS (
+                SELECT id, (cantidad_contada IS NOT NULL OR cantidad_contada_2 IS NOT NULL) AS contado
+                FROM goti.inventario_ciego_conteos
+                WHERE id = %s AND (%s::bigint IS NULL OR row_version = %s::bigint)
+                FOR UPDATE
+            )
+            UPDATE goti.inventario_ciego_conteos c
+            SET cantidad = COALESCE(%s, c.cantidad),
                 cantidad_contada = %s,
                 cantidad_contada_2 = %s,
                 modificado_por = %s,
                 modificado_at = CURRENT_TIMESTAMP,
                 corregido = TRUE
-            WHERE id = %s
-        """, (cantidad_sistema, cantidad_contada, cantidad_contada_2, usuario or None, id_producto))
+            FROM previo
+            WHERE c.id = previo.id
+            RETURNING c.id, c.codigo, c.fecha, c.local, c.row_version, previo.contado AS antes,
+                      (c.cantidad_contada IS NOT NULL OR c.cantidad_contada_2 IS NOT NULL) AS ahora
+        """, (id_producto, esperado, esperado, cantidad_sistema, cantidad_contada, cantidad_contada_2,
+              usuario or None))
+        fila = cur.fetchone()
+        if not fila and esperado is not None:
+            conn.rollback()
+            return _respuesta_conflicto(cur, id_producto)
+        if fila:
+            _ajustar_contados_semana(cur, [fila])
         conn.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'row_version': fila['row_version'] if fila else None})
     except Exception as e:
         print(f"Error en /api/admin/corregir-conteo: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
@@ -1510,8 +3621,8 @@ def historico_pivot():
     conn = None
     try:
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute("""
+        # Se ejecuta al final: con ?stream= sus filas se leen de un cursor de servidor
+        sql_conteos = """
             SELECT
                 c.id, c.codigo, c.nombre, c.unidad,
                 c.fecha,
@@ -1522,11 +3633,10 @@ def historico_pivot():
             FROM goti.inventario_ciego_conteos c
             WHERE c.fecha >= %s AND c.fecha <= %s AND c.local = %s
             ORDER BY c.codigo, c.fecha
-        """, (fecha_desde, fecha_hasta, local))
-        rows = cur.fetchall()
+        """
 
         # Obtener personas asignadas con cantidades y costos para el periodo/bodega
-        cur.execute("""
+        sql_asig = """
             SELECT c.codigo, a.persona,
                    SUM(ABS(a.cantidad)) AS cantidad_neta,
                    SUM(a.cantidad)      AS cantidad_ajustada,
@@ -1536,11 +3646,10 @@ def historico_pivot():
             WHERE c.fecha >= %s AND c.fecha <= %s AND c.local = %s
               AND a.persona IS NOT NULL AND a.persona <> ''
             GROUP BY c.codigo, a.persona
-        """, (fecha_desde, fecha_hasta, local))
-        asig_rows = cur.fetchall()
+        """
 
         # Obtener contadores (quién contó) por fecha
-        cur.execute("""
+        sql_cont = """
             SELECT c.fecha,
                    u.nombre as contador_nombre,
                    MIN(c.contado_at) as hora_inicio,
@@ -1566,11 +3675,26 @@ def historico_pivot():
             GROUP BY c.fecha, u.nombre
 
             ORDER BY fecha, tipo
-        """, (fecha_desde, fecha_hasta, local, fecha_desde, fecha_hasta, local))
-        cont_rows = cur.fetchall()
+        """
 
-        release_db(conn)
-        conn = None
+        columnar = _formato_columnar()
+        modo = None if columnar else _modo_stream()
+        consultas = {
+            'asig': (sql_asig, (fecha_desde, fecha_hasta, local)),
+            'cont': (sql_cont, (fecha_desde, fecha_hasta, local, fecha_desde, fecha_hasta, local)),
+        }
+        if not modo:
+            def leer_conteos(c):
+                cur_rapido = _cursor_rapido(c)
+                cur_rapido.execute(sql_conteos, (fecha_desde, fecha_hasta, local))
+                return cur_rapido.fetchall()
+            consultas['conteos'] = leer_conteos
+        res = consultas_paralelas(conn, consultas)
+        asig_rows, cont_rows = res['asig'], res['cont']
+        if not modo:
+            rows = res['conteos']
+            release_db(conn)
+            conn = None
 
         # Mapa codigo -> {persona: {cant_neta, desc_neto, cant_ajustada, desc_ajustado}}
         personas_por_codigo = {}
@@ -1588,28 +3712,35 @@ def historico_pivot():
                 'desc_ajustado':   round(abs(cant_ajust) * costo, 4)     # Valor Ajustado
             }
 
-        productos = {}
         fechas = set()
-        for r in rows:
-            codigo = r['codigo']
-            fecha = str(r['fecha'])
-            fechas.add(fecha)
-            if codigo not in productos:
-                personas_cod = personas_por_codigo.get(codigo, {})
-                productos[codigo] = {
-                    'codigo': codigo,
-                    'nombre': r['nombre'],
-                    'unidad': r['unidad'],
-                    'porFecha': {},
-                    'personas': sorted(personas_cod.keys()),
-                    'descuentosPorPersona': personas_cod
+
+        def agrupar(filas):
+            # Filas ordenadas por codigo: cada producto se cierra al cambiar de codigo
+            # Tuplas de _cursor_rapido en el orden de sql_conteos
+            actual = None
+            for _id, codigo, nombre, unidad, fecha, stock, contado, diferencia, costo in filas:
+                fecha = str(fecha)
+                fechas.add(fecha)
+                if actual is None or actual['codigo'] != codigo:
+                    if actual is not None:
+                        yield actual
+                    personas_cod = personas_por_codigo.get(codigo, {})
+                    actual = {
+                        'codigo': codigo,
+                        'nombre': nombre,
+                        'unidad': unidad,
+                        'porFecha': {},
+                        'personas': sorted(personas_cod.keys()),
+                        'descuentosPorPersona': personas_cod
+                    }
+                actual['porFecha'][fecha] = {
+                    'stock': stock or 0.0,
+                    'contado': contado,
+                    'diferencia': diferencia,
+                    'costo_unitario': costo or 0.0
                 }
-            productos[codigo]['porFecha'][fecha] = {
-                'stock': float(r['stock'] or 0),
-                'contado': float(r['contado']) if r['contado'] is not None else None,
-                'diferencia': float(r['diferencia']) if r['diferencia'] is not None else None,
-                'costo_unitario': float(r['costo_unitario'] or 0)
-            }
+            if actual is not None:
+                yield actual
 
         # Lista de todas las personas únicas del periodo
         todas_personas = sorted({p for ps in personas_por_codigo.values() for p in ps.keys()})
@@ -1628,9 +3759,42 @@ def historico_pivot():
                 'tipo': 'Conteo 1' if cr['tipo'] == 'conteo1' else 'Conteo 2'
             })
 
+        if modo:
+            resp = _respuesta_stream(conn, sql_conteos, (fecha_desde, fecha_hasta, local), modo,
+                                     agrupar, 'productos',
+                                     lambda: {'fechas': sorted(fechas), 'personas': todas_personas,
+                                              'contadores': contadores_por_fecha},
+                                     tuplas=True)
+            conn = None
+            return resp
+
+        if columnar:
+            # Tablas planas: productos, conteos por (codigo, fecha) y descuentos por (codigo, persona)
+            info_productos = {}
+            conteos = []
+            for _id, codigo, nombre, unidad, fecha, stock, contado, diferencia, costo in rows:
+                info_productos.setdefault(codigo, (codigo, nombre, unidad))
+                conteos.append((codigo, str(fecha), stock or 0.0, contado, diferencia, costo or 0.0))
+            descuentos = [(cod, persona, d['cant_neta'], d['desc_neto'], d['cant_ajustada'], d['desc_ajustado'])
+                          for cod, ps in personas_por_codigo.items() for persona, d in ps.items()]
+            return jsonify({
+                'formato': 'columnar',
+                'fechas': sorted({c[1] for c in conteos}),
+                'productos': _tabla_columnar(('codigo', 'nombre', 'unidad'),
+                                             list(info_productos.values()), ('unidad',)),
+                'conteos': _tabla_columnar(('codigo', 'fecha', 'stock', 'contado', 'diferencia', 'costo_unitario'),
+                                           conteos, ('codigo', 'fecha')),
+                'descuentos': _tabla_columnar(('codigo', 'persona', 'cant_neta', 'desc_neto',
+                                               'cant_ajustada', 'desc_ajustado'),
+                                              descuentos, ('codigo', 'persona')),
+                'personas': todas_personas,
+                'contadores': contadores_por_fecha
+            })
+
+        productos = list(agrupar(rows))
         return jsonify({
             'fechas': sorted(fechas),
-            'productos': list(productos.values()),
+            'productos': productos,
             'personas': todas_personas,
             'contadores': contadores_por_fecha
         })
@@ -1687,8 +3851,8 @@ def reporte_diferencias():
                 'nombre': p['nombre'],
                 'unidad': p['unidad'],
                 'sistema': float(p['sistema']) if p['sistema'] is not None else 0,
-                'conteo1': float(p['conteo1']) if p['conteo1'] is not None else None,
-                'conteo2': float(p['conteo2']) if p['conteo2'] is not None else None,
+                'conteo1': p['conteo1'],
+                'conteo2': p['conteo2'],
                 'diferencia': float(p['diferencia']) if p['diferencia'] is not None else 0,
                 'motivo': p['motivo'] or '',
                 'observaciones': p['observaciones'] or '',
@@ -1720,7 +3884,6 @@ def exportar_excel():
     conn = None
     try:
         conn = get_db()
-        cur = conn.cursor()
 
         query = """
             SELECT fecha, local, codigo, nombre, unidad,
@@ -1742,6 +3905,7 @@ def exportar_excel():
 
         query += " ORDER BY fecha, local, codigo"
 
+        cur = _cursor_rapido(conn)
         cur.execute(query, params)
         registros = cur.fetchall()
 
@@ -1767,7 +3931,7 @@ def exportar_excel():
         # Agrupar por fecha+local
         grupos = {}
         for r in registros:
-            key = (str(r['fecha']), r['local'])
+            key = (str(r[0]), r[1])
             if key not in grupos:
                 grupos[key] = []
             grupos[key].append(r)
@@ -1787,18 +3951,19 @@ def exportar_excel():
                 cell.border = thin_border
 
             # Datos
-            for row_idx, item in enumerate(items, 2):
+            for row_idx, (_f, _l, codigo, nombre, unidad, sistema, conteo1, conteo2,
+                          diferencia, motivo, observaciones, corregido) in enumerate(items, 2):
                 vals = [
-                    item['codigo'],
-                    item['nombre'],
-                    item['unidad'],
-                    float(item['sistema']) if item['sistema'] is not None else 0,
-                    float(item['conteo1']) if item['conteo1'] is not None else '',
-                    float(item['conteo2']) if item['conteo2'] is not None else '',
-                    float(item['diferencia']) if item['diferencia'] is not None else '',
-                    item.get('motivo') or '',
-                    item['observaciones'] or '',
-                    'Sí' if item.get('corregido') else 'No'
+                    codigo,
+                    nombre,
+                    unidad,
+                    sistema if sistema is not None else 0,
+                    conteo1 if conteo1 is not None else '',
+                    conteo2 if conteo2 is not None else '',
+                    diferencia if diferencia is not None else '',
+                    motivo or '',
+                    observaciones or '',
+                    'Sí' if corregido else 'No'
                 ]
                 for col_idx, val in enumerate(vals, 1):
                     cell = ws.cell(row=row_idx, column=col_idx, value=val)
@@ -1849,6 +4014,9 @@ def exportar_excel():
 def reporte_tendencias():
     bodega = request.args.get('bodega')
     limite = request.args.get('limite', 20, type=int)
+    # Opcionales: con rango solo se leen las particiones de esos meses
+    fecha_desde = request.args.get('fecha_desde')
+    fecha_hasta = request.args.get('fecha_hasta')
 
     conn = None
     try:
@@ -1868,6 +4036,12 @@ def reporte_tendencias():
         """
         params = []
 
+        if fecha_desde:
+            query += " AND fecha >= %s"
+            params.append(fecha_desde)
+        if fecha_hasta:
+            query += " AND fecha <= %s"
+            params.append(fecha_hasta)
         if bodega:
             query += " AND local = %s"
             params.append(bodega)
@@ -1929,293 +4103,310 @@ def productos_disponibles():
             release_db(conn)
 
 
-@app.route('/api/reportes/dashboard', methods=['GET'])
-def reporte_dashboard():
-    fecha_desde = request.args.get('fecha_desde')
-    fecha_hasta = request.args.get('fecha_hasta')
-    bodegas = request.args.getlist('bodega')
+def _consultas_dashboard(args):
+    """Consultas independientes de /api/reportes/dashboard (las usa tambien el modo ASGI)"""
+    fecha_desde = args.get('fecha_desde')
+    fecha_hasta = args.get('fecha_hasta')
+    bodegas = args.getlist('bodega')
     bodegas = [b for b in bodegas if b]  # filtrar vacíos
-    producto = request.args.get('producto', '').strip()
-    contador = request.args.get('contador', '').strip()
-    excluir_justificados = request.args.get('excluir_justificados', '0') == '1'
-
-    if not fecha_desde or not fecha_hasta:
-        return jsonify({'error': 'fecha_desde y fecha_hasta son requeridos'}), 400
-
-    conn = None
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-
-        # Filtros comunes
-        filtro_extra = ""
-        params = [fecha_desde, fecha_hasta]
-        if len(bodegas) == 1:
-            filtro_extra += " AND local = %s"
-            params.append(bodegas[0])
-        elif len(bodegas) > 1:
-            filtro_extra += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
-            params.extend(bodegas)
-        if producto:
-            filtro_extra += " AND codigo = %s"
-            params.append(producto)
-        if contador:
-            filtro_extra += " AND (contado_por = %s OR contado2_por = %s)"
-            params.extend([contador, contador])
-        if excluir_justificados:
-            filtro_extra += " AND (justificado IS NULL OR justificado = FALSE)"
-
-        # Resumen por bodega
-        query = """
-            SELECT
-                local,
-                COUNT(*) as total_productos,
-                COUNT(cantidad_contada) as total_contados,
-                COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                    AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
-                    THEN 1 END) as total_con_diferencia,
-                COALESCE(ROUND(AVG(ABS(
-                    CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                         AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
-                    THEN COALESCE(cantidad_contada_2, cantidad_contada) - cantidad END
-                ))::numeric, 3), 0) as promedio_diferencia_abs,
-                COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                    AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad < 0
-                    THEN 1 END) as total_faltantes,
-                COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                    AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad > 0
-                    THEN 1 END) as total_sobrantes,
-                COALESCE(SUM(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                    AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad < 0
-                    THEN ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad) * COALESCE(costo_unitario, 0) END), 0) as valor_faltantes,
-                COALESCE(SUM(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                    AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad > 0
-                    THEN ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad) * COALESCE(costo_unitario, 0) END), 0) as valor_sobrantes
+    producto = args.get('producto', '').strip()
+    contador = args.get('contador', '').strip()
+    excluir_justificados = args.get('excluir_justificados', '0') == '1'
+
+    # Filtros comunes
+    filtro_extra = ""
+    params = [fecha_desde, fecha_hasta]
+    if len(bodegas) == 1:
+        filtro_extra += " AND local = %s"
+        params.append(bodegas[0])
+    elif len(bodegas) > 1:
+        filtro_extra += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
+        params.extend(bodegas)
+    if producto:
+        filtro_extra += " AND codigo = %s"
+        params.append(producto)
+    if contador:
+        filtro_extra += " AND (contado_por = %s OR contado2_por = %s)"
+        params.extend([contador, contador])
+    if excluir_justificados:
+        filtro_extra += " AND (justificado IS NULL OR justificado = FALSE)"
+
+    # Resumen por bodega
+    query = """
+        SELECT
+            local,
+            COUNT(*) as total_productos,
+            COUNT(cantidad_contada) as total_contados,
+            COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
+                THEN 1 END) as total_con_diferencia,
+            COALESCE(ROUND(AVG(ABS(
+                CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                     AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
+                THEN COALESCE(cantidad_contada_2, cantidad_contada) - cantidad END
+            ))::numeric, 3), 0) as promedio_diferencia_abs,
+            COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad < 0
+                THEN 1 END) as total_faltantes,
+            COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad > 0
+                THEN 1 END) as total_sobrantes,
+            COALESCE(SUM(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad < 0
+                THEN ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad) * COALESCE(costo_unitario, 0) END), 0) as valor_faltantes,
+            COALESCE(SUM(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad > 0
+                THEN ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad) * COALESCE(costo_unitario, 0) END), 0) as valor_sobrantes
+        FROM goti.inventario_ciego_conteos
+        WHERE fecha >= %s AND fecha <= %s
+    """ + filtro_extra + " GROUP BY local ORDER BY local"
+
+    # Top 10 productos con mayor descuadre en valor (agrupados por producto)
+    query_top = """
+        SELECT codigo, nombre, unidad,
+               SUM(ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad)) as diferencia_total,
+               AVG(COALESCE(costo_unitario, 0)) as costo_unitario,
+               SUM(ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad) * COALESCE(costo_unitario, 0)) as valor_descuadre
+        FROM goti.inventario_ciego_conteos
+        WHERE fecha >= %s AND fecha <= %s
+          AND COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+          AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
+    """ + filtro_extra
+    query_top += " GROUP BY codigo, nombre, unidad ORDER BY valor_descuadre DESC LIMIT 10"
+
+    # Promedio diario de exactitud (items contados sin error / items contados)
+    query_prom = """
+        SELECT AVG(exactitud_dia) as promedio_exactitud,
+               AVG(cumplimiento_dia) as promedio_cumplimiento,
+               COUNT(*) as total_dias
+        FROM (
+            SELECT fecha,
+                   CASE WHEN COUNT(cantidad_contada) > 0
+                        THEN (COUNT(cantidad_contada) - COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                            AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0 THEN 1 END))::float
+                            / COUNT(cantidad_contada) * 100
+                        ELSE 0 END as exactitud_dia,
+                   CASE WHEN COUNT(*) > 0
+                        THEN COUNT(cantidad_contada)::float / COUNT(*) * 100
+                        ELSE 0 END as cumplimiento_dia
             FROM goti.inventario_ciego_conteos
             WHERE fecha >= %s AND fecha <= %s
-        """ + filtro_extra + " GROUP BY local ORDER BY local"
-        cur.execute(query, params)
+    """ + filtro_extra + """
+            GROUP BY fecha
+        ) dias
+    """
 
-        resultados = cur.fetchall()
+    # Actividad de contadores en el periodo
+    query_cont = """
+        SELECT
+            u.nombre as contador,
+            c.contado_por as username,
+            COUNT(DISTINCT c.fecha) as dias_contados,
+            COUNT(*) as total_items,
+            COUNT(DISTINCT c.local) as bodegas_cubiertas,
+            MAX(c.contado_at) as ultima_actividad
+        FROM goti.inventario_ciego_conteos c
+        JOIN goti.usuarios u ON u.username = c.contado_por
+        WHERE c.fecha >= %s AND c.fecha <= %s
+          AND c.contado_por IS NOT NULL
+    """ + filtro_extra + """
+        GROUP BY u.nombre, c.contado_por
+        ORDER BY total_items DESC
+    """
 
-        bodegas_data = []
-        for r in resultados:
-            bodegas_data.append({
-                'local': r['local'],
-                'local_nombre': BODEGAS_NOMBRES.get(r['local'], r['local']),
-                'total_productos': r['total_productos'],
-                'total_contados': r['total_contados'],
-                'total_con_diferencia': r['total_con_diferencia'],
-                'promedio_diferencia_abs': float(r['promedio_diferencia_abs']),
-                'total_faltantes': r['total_faltantes'],
-                'total_sobrantes': r['total_sobrantes'],
-                'valor_faltantes': float(r['valor_faltantes']),
-                'valor_sobrantes': float(r['valor_sobrantes'])
-            })
+    return {
+        'bodegas': (query, params),
+        'top': (query_top, params),
+        'promedios': (query_prom, params),
+        'contadores': (query_cont, params),
+    }
 
-        # Top 10 productos con mayor descuadre en valor (agrupados por producto)
-        query_top = """
-            SELECT codigo, nombre, unidad,
-                   SUM(ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad)) as diferencia_total,
-                   AVG(COALESCE(costo_unitario, 0)) as costo_unitario,
-                   SUM(ABS(COALESCE(cantidad_contada_2, cantidad_contada) - cantidad) * COALESCE(costo_unitario, 0)) as valor_descuadre
-            FROM goti.inventario_ciego_conteos
-            WHERE fecha >= %s AND fecha <= %s
-              AND COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-              AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
-        """ + filtro_extra
-        params_top = list(params)
-        query_top += " GROUP BY codigo, nombre, unidad ORDER BY valor_descuadre DESC LIMIT 10"
-        cur.execute(query_top, params_top)
-        top_descuadre = []
-        for r in cur.fetchall():
-            top_descuadre.append({
-                'codigo': r['codigo'],
-                'nombre': r['nombre'],
-                'unidad': r['unidad'],
-                'diferencia': float(r['diferencia_total']),
-                'costo_unitario': float(r['costo_unitario']),
-                'valor_descuadre': float(r['valor_descuadre'])
-            })
 
-        # % cumplimiento por bodega (contados / total)
-        cumplimiento = []
-        for b in bodegas_data:
-            pct = round(b['total_contados'] / b['total_productos'] * 100, 1) if b['total_productos'] > 0 else 0
-            cumplimiento.append({
-                'local': b['local'],
-                'local_nombre': b['local_nombre'],
-                'porcentaje': pct,
-                'exactos': b['total_contados'] - b['total_con_diferencia'],
-                'con_diferencia': b['total_con_diferencia']
-            })
+def _armar_dashboard(res):
+    bodegas_data = []
+    for r in res['bodegas']:
+        bodegas_data.append({
+            'local': r['local'],
+            'local_nombre': BODEGAS_NOMBRES.get(r['local'], r['local']),
+            'total_productos': r['total_productos'],
+            'total_contados': r['total_contados'],
+            'total_con_diferencia': r['total_con_diferencia'],
+            'promedio_diferencia_abs': float(r['promedio_diferencia_abs']),
+            'total_faltantes': r['total_faltantes'],
+            'total_sobrantes': r['total_sobrantes'],
+            'valor_faltantes': float(r['valor_faltantes']),
+            'valor_sobrantes': float(r['valor_sobrantes'])
+        })
 
-        # Promedio diario de exactitud (items contados sin error / items contados)
-        query_prom = """
-            SELECT AVG(exactitud_dia) as promedio_exactitud,
-                   AVG(cumplimiento_dia) as promedio_cumplimiento,
-                   COUNT(*) as total_dias
-            FROM (
-                SELECT fecha,
-                       CASE WHEN COUNT(cantidad_contada) > 0
-                            THEN (COUNT(cantidad_contada) - COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                                AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0 THEN 1 END))::float
-                                / COUNT(cantidad_contada) * 100
-                            ELSE 0 END as exactitud_dia,
-                       CASE WHEN COUNT(*) > 0
-                            THEN COUNT(cantidad_contada)::float / COUNT(*) * 100
-                            ELSE 0 END as cumplimiento_dia
-                FROM goti.inventario_ciego_conteos
-                WHERE fecha >= %s AND fecha <= %s
-        """ + filtro_extra + """
-                GROUP BY fecha
-            ) dias
-        """
-        cur.execute(query_prom, params)
-        prom = cur.fetchone()
-        promedios = {
-            'exactitud_promedio': round(float(prom['promedio_exactitud'] or 0), 1),
-            'cumplimiento_promedio': round(float(prom['promedio_cumplimiento'] or 0), 1),
-            'total_dias': prom['total_dias'] or 0
-        }
+    top_descuadre = []
+    for r in res['top']:
+        top_descuadre.append({
+            'codigo': r['codigo'],
+            'nombre': r['nombre'],
+            'unidad': r['unidad'],
+            'diferencia': float(r['diferencia_total']),
+            'costo_unitario': float(r['costo_unitario']),
+            'valor_descuadre': float(r['valor_descuadre'])
+        })
 
-        # Actividad de contadores en el periodo
-        query_cont = """
-            SELECT
-                u.nombre as contador,
-                c.contado_por as username,
-                COUNT(DISTINCT c.fecha) as dias_contados,
-                COUNT(*) as total_items,
-                COUNT(DISTINCT c.local) as bodegas_cubiertas,
-                MAX(c.contado_at) as ultima_actividad
-            FROM goti.inventario_ciego_conteos c
-            JOIN goti.usuarios u ON u.username = c.contado_por
-            WHERE c.fecha >= %s AND c.fecha <= %s
-              AND c.contado_por IS NOT NULL
-        """ + filtro_extra + """
-            GROUP BY u.nombre, c.contado_por
-            ORDER BY total_items DESC
-        """
-        cur.execute(query_cont, params)
-        contadores_data = []
-        for r in cur.fetchall():
-            ua = r['ultima_actividad']
-            contadores_data.append({
-                'nombre': r['contador'],
-                'username': r['username'],
-                'dias_contados': r['dias_contados'],
-                'total_items': r['total_items'],
-                'bodegas_cubiertas': r['bodegas_cubiertas'],
-                'ultima_actividad': ua.strftime('%d/%m %H:%M') if ua else ''
-            })
+    # % cumplimiento por bodega (contados / total)
+    cumplimiento = []
+    for b in bodegas_data:
+        pct = round(b['total_contados'] / b['total_productos'] * 100, 1) if b['total_productos'] > 0 else 0
+        cumplimiento.append({
+            'local': b['local'],
+            'local_nombre': b['local_nombre'],
+            'porcentaje': pct,
+            'exactos': b['total_contados'] - b['total_con_diferencia'],
+            'con_diferencia': b['total_con_diferencia']
+        })
 
-        return jsonify({
-            'bodegas': bodegas_data,
-            'top_descuadre': top_descuadre,
-            'cumplimiento': cumplimiento,
-            'promedios': promedios,
-            'contadores': contadores_data
+    prom = res['promedios'][0]
+    promedios = {
+        'exactitud_promedio': round(float(prom['promedio_exactitud'] or 0), 1),
+        'cumplimiento_promedio': round(float(prom['promedio_cumplimiento'] or 0), 1),
+        'total_dias': prom['total_dias'] or 0
+    }
+
+    contadores_data = []
+    for r in res['contadores']:
+        ua = r['ultima_actividad']
+        contadores_data.append({
+            'nombre': r['contador'],
+            'username': r['username'],
+            'dias_contados': r['dias_contados'],
+            'total_items': r['total_items'],
+            'bodegas_cubiertas': r['bodegas_cubiertas'],
+            'ultima_actividad': ua.strftime('%d/%m %H:%M') if ua else ''
         })
-    except Exception as e:
-        print(f"Error en /api/reportes/dashboard: {e}")
-        return jsonify({'error': 'Error interno del servidor'}), 500
-    finally:
-        if conn:
-            release_db(conn)
 
+    return {
+        'bodegas': bodegas_data,
+        'top_descuadre': top_descuadre,
+        'cumplimiento': cumplimiento,
+        'promedios': promedios,
+        'contadores': contadores_data
+    }
 
-@app.route('/api/reportes/tendencias-temporal', methods=['GET'])
-def reporte_tendencias_temporal():
-    bodegas = request.args.getlist('bodega')
-    bodegas = [b for b in bodegas if b]
-    dias = request.args.get('dias', 30, type=int)
+
+@app.route('/api/reportes/dashboard', methods=['GET'])
+def reporte_dashboard():
     fecha_desde = request.args.get('fecha_desde')
     fecha_hasta = request.args.get('fecha_hasta')
-    motivo = request.args.get('motivo', '')
-    producto = request.args.get('producto', '')
-    contador = request.args.get('contador', '').strip()
-    excluir_justificados = request.args.get('excluir_justificados', '0') == '1'
+    if not fecha_desde or not fecha_hasta:
+        return jsonify({'error': 'fecha_desde y fecha_hasta son requeridos'}), 400
 
-    conn = None
+    args = request.args
     try:
-        conn = get_db()
-        cur = conn.cursor()
-
-        if fecha_desde and fecha_hasta:
-            where_fecha = "fecha >= %s AND fecha <= %s"
-            params = [fecha_desde, fecha_hasta]
-        else:
-            where_fecha = "fecha >= CURRENT_DATE - %s"
-            params = [dias]
-
-        motivo_filter = ""
-        if motivo:
-            motivo_filter = " AND motivo = %s"
-            params.append(motivo)
-
-        if producto:
-            motivo_filter += " AND codigo = %s"
-            params.append(producto)
-
-        if contador:
-            motivo_filter += " AND (contado_por = %s OR contado2_por = %s)"
-            params.extend([contador, contador])
+        # Las cuatro consultas son independientes: corren en paralelo
+        return _reporte_compartido(
+            lambda cur: _version_rango(cur, fecha_desde, fecha_hasta, args.getlist('bodega')),
+            lambda conn: _armar_dashboard(consultas_paralelas(conn, _consultas_dashboard(args))))
+    except Exception as e:
+        print(f"Error en /api/reportes/dashboard: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
 
-        if excluir_justificados:
-            motivo_filter += " AND (justificado IS NULL OR justificado = FALSE)"
 
-        query = f"""
-            SELECT
-                fecha,
-                local,
-                COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-                    AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
-                    THEN 1 END) as total_con_diferencia
-            FROM goti.inventario_ciego_conteos
-            WHERE {where_fecha}{motivo_filter}
-        """
+def _calcular_tendencias_temporal(cur, args):
+    bodegas = args.getlist('bodega')
+    bodegas = [b for b in bodegas if b]
+    dias = args.get('dias', 30, type=int)
+    fecha_desde = args.get('fecha_desde')
+    fecha_hasta = args.get('fecha_hasta')
+    motivo = args.get('motivo', '')
+    producto = args.get('producto', '')
+    contador = args.get('contador', '').strip()
+    excluir_justificados = args.get('excluir_justificados', '0') == '1'
+
+    if fecha_desde and fecha_hasta:
+        where_fecha = "fecha >= %s AND fecha <= %s"
+        params = [fecha_desde, fecha_hasta]
+    else:
+        where_fecha = "fecha >= CURRENT_DATE - %s"
+        params = [dias]
+
+    motivo_filter = ""
+    if motivo:
+        motivo_filter = " AND motivo = %s"
+        params.append(motivo)
+
+    if producto:
+        motivo_filter += " AND codigo = %s"
+        params.append(producto)
+
+    if contador:
+        motivo_filter += " AND (contado_por = %s OR contado2_por = %s)"
+        params.extend([contador, contador])
+
+    if excluir_justificados:
+        motivo_filter += " AND (justificado IS NULL OR justificado = FALSE)"
+
+    query = f"""
+        SELECT
+            fecha,
+            local,
+            COUNT(CASE WHEN COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+                AND COALESCE(cantidad_contada_2, cantidad_contada) - cantidad != 0
+                THEN 1 END) as total_con_diferencia
+        FROM goti.inventario_ciego_conteos
+        WHERE {where_fecha}{motivo_filter}
+    """
 
-        if len(bodegas) == 1:
-            query += " AND local = %s"
-            params.append(bodegas[0])
-        elif len(bodegas) > 1:
-            query += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
-            params.extend(bodegas)
+    if len(bodegas) == 1:
+        query += " AND local = %s"
+        params.append(bodegas[0])
+    elif len(bodegas) > 1:
+        query += " AND local IN (" + ",".join(["%s"] * len(bodegas)) + ")"
+        params.extend(bodegas)
+
+    query += " GROUP BY fecha, local ORDER BY fecha, local"
+
+    cur.execute(query, params)
+    resultados = cur.fetchall()
+
+    # Agrupar por fecha y series por bodega
+    fechas_set = set()
+    series_dict = {}
+    for r in resultados:
+        fecha_str = str(r['fecha'])
+        local = r['local']
+        fechas_set.add(fecha_str)
+        if local not in series_dict:
+            series_dict[local] = {}
+        series_dict[local][fecha_str] = r['total_con_diferencia']
+
+    fechas = sorted(fechas_set)
+    series = {}
+    for local, valores in series_dict.items():
+        series[local] = {
+            'nombre': BODEGAS_NOMBRES.get(local, local),
+            'datos': [valores.get(f, 0) for f in fechas]
+        }
 
-        query += " GROUP BY fecha, local ORDER BY fecha, local"
+    return {
+        'fechas': fechas,
+        'series': series
+    }
 
-        cur.execute(query, params)
-        resultados = cur.fetchall()
 
-        # Agrupar por fecha y series por bodega
-        fechas_set = set()
-        series_dict = {}
-        for r in resultados:
-            fecha_str = str(r['fecha'])
-            local = r['local']
-            fechas_set.add(fecha_str)
-            if local not in series_dict:
-                series_dict[local] = {}
-            series_dict[local][fecha_str] = r['total_con_diferencia']
-
-        fechas = sorted(fechas_set)
-        series = {}
-        for local, valores in series_dict.items():
-            series[local] = {
-                'nombre': BODEGAS_NOMBRES.get(local, local),
-                'datos': [valores.get(f, 0) for f in fechas]
-            }
+@app.route('/api/reportes/tendencias-temporal', methods=['GET'])
+def reporte_tendencias_temporal():
+    fecha_desde = request.args.get('fecha_desde')
+    fecha_hasta = request.args.get('fecha_hasta')
+    if not (fecha_desde and fecha_hasta):
+        fecha_desde = (date.today() - timedelta(days=request.args.get('dias', 30, type=int))).isoformat()
+        fecha_hasta = None
 
-        return jsonify({
-            'fechas': fechas,
-            'series': series
-        })
+    args = request.args
+    try:
+        # Sin rango explicito la ventana se mueve con el dia: la fecha entra en la version
+        return _reporte_compartido(
+            lambda cur: (_version_rango(cur, fecha_desde, fecha_hasta, args.getlist('bodega')),
+                         date.today().isoformat()),
+            lambda conn: _calcular_tendencias_temporal(conn.cursor(), args))
     except Exception as e:
         print(f"Error en /api/reportes/tendencias-temporal: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
-    finally:
-        if conn:
-            release_db(conn)
 
 
 # ============================================================
@@ -2235,44 +4426,59 @@ CATALOGO_TABLE = 'tbl8hyvwwfSnrspAt'
 CATALOGO_VIEW = 'viwxcPxcde6c3JhbE'  # "Matriz Sis Inventarios (No tocar)"
 _catalogo_cache = {'datos': [], 'ts': 0}
 
+def _url_catalogo(offset=None):
+    url = f'https://api.airtable.com/v0/{CATALOGO_BASE}/{CATALOGO_TABLE}?view={CATALOGO_VIEW}&pageSize=100'
+    if offset:
+        url += f'&offset={offset}'
+    return url
+
+
+def _guardar_catalogo(records):
+    """Registros de Airtable -> cache del catalogo [{codigo, nombre, unidad}]"""
+    import time
+    all_records = []
+    for rec in records:
+        f = rec['fields']
+        codigo = f.get('Código', '').strip()
+        nombre = f.get('Nombre Producto', f.get('Nombre Copia', '')).strip()
+        unidad = f.get('Unidad Contifico', '').strip()
+        if codigo and nombre:
+            all_records.append({'codigo': codigo, 'nombre': nombre, 'unidad': unidad})
+    _catalogo_cache['datos'] = all_records
+    _catalogo_cache['ts'] = time.time()
+    return all_records
+
+
 def _cargar_catalogo_airtable():
-    import time, urllib.request, json as json_lib
+    import urllib.request, json as json_lib
     token = _get_airtable_token()
-    all_records = []
+    records = []
     offset = None
     while True:
-        url = f'https://api.airtable.com/v0/{CATALOGO_BASE}/{CATALOGO_TABLE}?view={CATALOGO_VIEW}&pageSize=100'
-        if offset:
-            url += f'&offset={offset}'
-        req = urllib.request.Request(url, headers={'Authorization': f'Bearer {token}'})
+        req = urllib.request.Request(_url_catalogo(offset), headers={'Authorization': f'Bearer {token}'})
         with urllib.request.urlopen(req, timeout=30) as r:
             data = json_lib.loads(r.read())
-        for rec in data['records']:
-            f = rec['fields']
-            codigo = f.get('Código', '').strip()
-            nombre = f.get('Nombre Producto', f.get('Nombre Copia', '')).strip()
-            unidad = f.get('Unidad Contifico', '').strip()
-            if codigo and nombre:
-                all_records.append({'codigo': codigo, 'nombre': nombre, 'unidad': unidad})
+        records.extend(data['records'])
         offset = data.get('offset')
         if not offset:
             break
-    _catalogo_cache['datos'] = all_records
-    _catalogo_cache['ts'] = time.time()
-    return all_records
+    return _guardar_catalogo(records)
 
 @app.route('/api/catalogo-productos', methods=['GET'])
 def get_catalogo_productos():
     import time, urllib.request, json as json_lib
     # Cache de 1 hora
     if time.time() - _catalogo_cache['ts'] < 3600 and _catalogo_cache['datos']:
+        _respuesta_cacheada(('catalogo', _catalogo_cache['ts']))
         return jsonify(_catalogo_cache['datos'])
     try:
         datos = _cargar_catalogo_airtable()
+        _respuesta_cacheada(('catalogo', _catalogo_cache['ts']))
         return jsonify(datos)
     except Exception as e:
         # Si falla pero hay cache viejo, devolver igual
         if _catalogo_cache['datos']:
+            _respuesta_cacheada(('catalogo', _catalogo_cache['ts']))
             return jsonify(_catalogo_cache['datos'])
         return jsonify({'error': str(e)}), 500
 
@@ -2356,6 +4562,23 @@ def cruce_ejecuciones():
             release_db(conn)
 
 
+def _fila_cruce_detalle(r):
+    return {
+        'id': r['id'],
+        'codigo': r['codigo'],
+        'nombre': r['nombre'],
+        'categoria': r['categoria'],
+        'unidad': r['unidad'],
+        'cantidad_toma': r['cantidad_toma'],
+        'cantidad_sistema': r['cantidad_sistema'],
+        'diferencia': r['diferencia'],
+        'costo_unitario': float(r['costo_unitario']) if r['costo_unitario'] is not None else 0,
+        'valor_diferencia': float(r['valor_diferencia']) if r['valor_diferencia'] is not None else 0,
+        'tipo_abc': r['tipo_abc'],
+        'origen': r['origen'],
+    }
+
+
 @app.route('/api/cruce/detalle', methods=['GET'])
 def cruce_detalle():
     """Detalle producto por producto de un cruce"""
@@ -2371,26 +4594,29 @@ def cruce_detalle():
                  WHERE ejecucion_id = %s"""
         if solo_dif:
             sql += " AND diferencia != 0"
+
+        limite, cursor, con_total = _parametros_pagina()
+        if limite:
+            resp = _respuesta_pagina(conn, sql, (ejec_id,),
+                                     [('ABS(COALESCE(q.valor_diferencia, 0))', 'DESC'), ('q.id', 'ASC')],
+                                     limite, cursor, con_total, 'detalle', _fila_cruce_detalle)
+            conn = None
+            return resp
+
         sql += " ORDER BY ABS(valor_diferencia) DESC"
+        modo = _modo_stream()
+        if modo:
+            resp = _respuesta_stream(conn, sql, (ejec_id,), modo,
+                                     lambda filas: (_fila_cruce_detalle(r) for r in filas))
+            conn = None
+            return resp
+
         cur.execute(sql, (ejec_id,))
         rows = cur.fetchall()
-        result = []
-        for r in rows:
-            result.append({
-                'id': r['id'],
-                'codigo': r['codigo'],
-                'nombre': r['nombre'],
-                'categoria': r['categoria'],
-                'unidad': r['unidad'],
-                'cantidad_toma': float(r['cantidad_toma']) if r['cantidad_toma'] is not None else None,
-                'cantidad_sistema': float(r['cantidad_sistema']) if r['cantidad_sistema'] is not None else None,
-                'diferencia': float(r['diferencia']) if r['diferencia'] is not None else None,
-                'costo_unitario': float(r['costo_unitario']) if r['costo_unitario'] is not None else 0,
-                'valor_diferencia': float(r['valor_diferencia']) if r['valor_diferencia'] is not None else 0,
-                'tipo_abc': r['tipo_abc'],
-                'origen': r['origen'],
-            })
+        result = [_fila_cruce_detalle(r) for r in rows]
         return jsonify(result)
+    except CursorInvalido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error en /api/cruce/detalle: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
@@ -2399,51 +4625,59 @@ def cruce_detalle():
             release_db(conn)
 
 
+def _calcular_cruce_resumen(cur):
+    """KPIs por bodega de su ultima ejecucion completada"""
+    cur.execute("""
+        WITH ultimas AS (
+            SELECT DISTINCT ON (bodega) id, bodega, fecha_toma,
+                   total_productos_toma, total_con_diferencia
+            FROM goti.cruce_operativo_ejecuciones
+            WHERE estado = 'completado'
+            ORDER BY bodega, fecha_toma DESC
+        )
+        SELECT u.id, u.bodega, u.fecha_toma, u.total_productos_toma, u.total_con_diferencia,
+               COALESCE(SUM(d.valor_diferencia) FILTER (WHERE d.diferencia != 0), 0) as valor_total,
+               COUNT(*) FILTER (WHERE d.diferencia < 0) as faltantes,
+               COUNT(*) FILTER (WHERE d.diferencia > 0) as sobrantes
+        FROM ultimas u
+        LEFT JOIN goti.cruce_operativo_detalle d ON d.ejecucion_id = u.id
+        GROUP BY u.id, u.bodega, u.fecha_toma, u.total_productos_toma, u.total_con_diferencia
+        ORDER BY u.bodega
+    """)
+    rows = cur.fetchall()
+
+    resumen = []
+    for r in rows:
+        resumen.append({
+            'bodega': r['bodega'],
+            'bodega_nombre': BODEGAS_OPERATIVAS.get(r['bodega'], r['bodega']),
+            'fecha_toma': r['fecha_toma'].isoformat() if r['fecha_toma'] else None,
+            'total_productos_toma': r['total_productos_toma'],
+            'total_con_diferencia': r['total_con_diferencia'],
+            'valor_total_diferencias': float(r['valor_total']),
+            'faltantes': r['faltantes'],
+            'sobrantes': r['sobrantes'],
+        })
+    return resumen
+
+
 @app.route('/api/cruce/resumen', methods=['GET'])
 def cruce_resumen():
     """KPIs: ultima ejecucion por bodega, totales, valor diferencias"""
-    conn = None
-    try:
-        conn = get_db()
-        cur = conn.cursor()
+    def version(cur):
+        # Ejecuciones completadas (cada cruce nuevo cambia cantidad y suma de ids)
         cur.execute("""
-            WITH ultimas AS (
-                SELECT DISTINCT ON (bodega) id, bodega, fecha_toma,
-                       total_productos_toma, total_con_diferencia
-                FROM goti.cruce_operativo_ejecuciones
-                WHERE estado = 'completado'
-                ORDER BY bodega, fecha_toma DESC
-            )
-            SELECT u.id, u.bodega, u.fecha_toma, u.total_productos_toma, u.total_con_diferencia,
-                   COALESCE(SUM(d.valor_diferencia) FILTER (WHERE d.diferencia != 0), 0) as valor_total,
-                   COUNT(*) FILTER (WHERE d.diferencia < 0) as faltantes,
-                   COUNT(*) FILTER (WHERE d.diferencia > 0) as sobrantes
-            FROM ultimas u
-            LEFT JOIN goti.cruce_operativo_detalle d ON d.ejecucion_id = u.id
-            GROUP BY u.id, u.bodega, u.fecha_toma, u.total_productos_toma, u.total_con_diferencia
-            ORDER BY u.bodega
+            SELECT COUNT(*) AS n, COALESCE(SUM(id), 0) AS ids
+            FROM goti.cruce_operativo_ejecuciones WHERE estado = 'completado'
         """)
-        rows = cur.fetchall()
-
-        resumen = []
-        for r in rows:
-            resumen.append({
-                'bodega': r['bodega'],
-                'bodega_nombre': BODEGAS_OPERATIVAS.get(r['bodega'], r['bodega']),
-                'fecha_toma': r['fecha_toma'].isoformat() if r['fecha_toma'] else None,
-                'total_productos_toma': r['total_productos_toma'],
-                'total_con_diferencia': r['total_con_diferencia'],
-                'valor_total_diferencias': float(r['valor_total']),
-                'faltantes': r['faltantes'],
-                'sobrantes': r['sobrantes'],
-            })
-        return jsonify(resumen)
+        v = cur.fetchone()
+        return (v['n'], v['ids'])
+    try:
+        return _reporte_compartido(version, lambda conn: _calcular_cruce_resumen(conn.cursor()),
+                                   ttl=REPORTES_TTL)
     except Exception as e:
         print(f"Error en /api/cruce/resumen: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
-    finally:
-        if conn:
-            release_db(conn)
 
 
 @app.route('/api/cruce/exportar-excel', methods=['GET'])
@@ -2462,10 +4696,15 @@ def cruce_exportar_excel():
         if not ejec:
             return jsonify({'error': 'Ejecucion no encontrada'}), 404
 
-        # Detalle
-        cur.execute("""SELECT * FROM goti.cruce_operativo_detalle
-                       WHERE ejecucion_id = %s ORDER BY ABS(valor_diferencia) DESC""", (ejec_id,))
-        rows = cur.fetchall()
+        # Detalle (tuplas en el orden de columnas del Excel)
+        cur_rapido = _cursor_rapido(conn)
+        cur_rapido.execute("""SELECT codigo, nombre, categoria, tipo_abc, unidad,
+                                     COALESCE(cantidad_toma, 0), COALESCE(cantidad_sistema, 0),
+                                     COALESCE(diferencia, 0), COALESCE(costo_unitario, 0),
+                                     COALESCE(valor_diferencia, 0), origen
+                              FROM goti.cruce_operativo_detalle
+                              WHERE ejecucion_id = %s ORDER BY ABS(valor_diferencia) DESC""", (ejec_id,))
+        rows = cur_rapido.fetchall()
 
         wb = Workbook()
         ws = wb.active
@@ -2493,14 +4732,7 @@ def cruce_exportar_excel():
             cell.alignment = Alignment(horizontal='center')
             cell.border = thin_border
 
-        for i, r in enumerate(rows, 2):
-            vals = [r['codigo'], r['nombre'], r['categoria'], r['tipo_abc'], r['unidad'],
-                    float(r['cantidad_toma']) if r['cantidad_toma'] is not None else 0,
-                    float(r['cantidad_sistema']) if r['cantidad_sistema'] is not None else 0,
-                    float(r['diferencia']) if r['diferencia'] is not None else 0,
-                    float(r['costo_unitario']) if r['costo_unitario'] is not None else 0,
-                    float(r['valor_diferencia']) if r['valor_diferencia'] is not None else 0,
-                    r['origen']]
+        for i, vals in enumerate(rows, 2):
             for col, v in enumerate(vals, 1):
                 cell = ws.cell(row=i, column=col, value=v)
                 cell.border = thin_border
@@ -2610,6 +4842,7 @@ def borrar_datos():
             WHERE fecha = %s AND local = %s
         """, (fecha, local))
         conteos_borrados = cur.rowcount
+        _refrescar_stats_semanas(cur, local=local, fecha=fecha)
         conn.commit()
 
         return jsonify({
@@ -2637,18 +4870,42 @@ def actualizar_costos():
         # Modo 1: costos pre-calculados {nombre: costo}
         costos_directos = data.get('costos', {})
         if costos_directos:
+            nombres = list(costos_directos)
+            costos = [float(c) for c in costos_directos.values()]
             conn_inv = get_db()
             cur_inv = conn_inv.cursor()
             total = 0
-            for nombre, costo in costos_directos.items():
+            try:
                 cur_inv.execute("""
-                    UPDATE goti.inventario_ciego_conteos
-                    SET costo_unitario = %s
-                    WHERE nombre = %s AND (costo_unitario IS NULL OR costo_unitario = 0)
-                """, (float(costo), nombre))
-                total += cur_inv.rowcount
-            conn_inv.commit()
-            release_db(conn_inv)
+                    SELECT DISTINCT fecha, local FROM goti.inventario_ciego_conteos
+                    WHERE nombre = ANY(%s) AND (costo_unitario IS NULL OR costo_unitario = 0)
+                    ORDER BY fecha, local
+                """, (nombres,))
+                slices = [(r['fecha'], r['local']) for r in cur_inv.fetchall()]
+                conn_inv.commit()
+                # Una transaccion por (fecha, local): cada una toma el lock de un solo slice de
+                # versiones_datos. Las filas se bloquean antes que el slice (el UPDATE dispara
+                # tocar_version), el mismo orden que guardar_conteo: fila y despues slice
+                for fecha, local in slices:
+                    cur_inv.execute("""
+                        SELECT id FROM goti.inventario_ciego_conteos
+                        WHERE fecha = %s AND local = %s AND nombre = ANY(%s)
+                          AND (costo_unitario IS NULL OR costo_unitario = 0)
+                        ORDER BY id
+                        FOR UPDATE
+                    """, (fecha, local, nombres))
+                    ids = [r['id'] for r in cur_inv.fetchall()]
+                    if ids:
+                        cur_inv.execute("""
+                            UPDATE goti.inventario_ciego_conteos c
+                            SET costo_unitario = v.costo
+                            FROM unnest(%s::text[], %s::numeric[]) AS v(nombre, costo)
+                            WHERE c.id = ANY(%s) AND c.nombre = v.nombre
+                        """, (nombres, costos, ids))
+                        total += cur_inv.rowcount
+                    conn_inv.commit()
+            finally:
+                release_db(conn_inv)
             return jsonify({
                 'productos_recibidos': len(costos_directos),
                 'registros_actualizados': total
@@ -2722,30 +4979,40 @@ def obtener_personas_cedulas():
         print(f"Error cargando cedulas: {e}")
         return jsonify({})
 
+def _url_personas(offset=None):
+    url = f'https://api.airtable.com/v0/{AIRTABLE_BASE}/{AIRTABLE_TABLE}?pageSize=100'
+    url += '&fields%5B%5D=nombre&fields%5B%5D=estado'
+    if offset:
+        url += f'&offset={offset}'
+    return url
+
+
+def _guardar_personas(records):
+    """Registros de Airtable -> cache de personas (nombres ordenados, sin repetir)"""
+    todos = []
+    for r in records:
+        nombre = r.get('fields', {}).get('nombre', '')
+        if nombre:
+            todos.append(nombre)
+    resultado = sorted(set(todos))
+    _personas_cache['datos'] = resultado
+    _personas_cache['timestamp'] = _time.time()
+    return resultado
+
+
 def _cargar_personas_airtable():
     """Carga personas desde Airtable y actualiza cache del servidor"""
     import urllib.request, json as json_lib
-    todos = []
+    records = []
     offset = None
     while True:
-        url = f'https://api.airtable.com/v0/{AIRTABLE_BASE}/{AIRTABLE_TABLE}?pageSize=100'
-        url += '&fields%5B%5D=nombre&fields%5B%5D=estado'
-        if offset:
-            url += f'&offset={offset}'
-        req = urllib.request.Request(url, headers={'Authorization': f'Bearer {_get_airtable_token()}'})
+        req = urllib.request.Request(_url_personas(offset), headers={'Authorization': f'Bearer {_get_airtable_token()}'})
         data = json_lib.loads(urllib.request.urlopen(req, timeout=10).read())
-        for r in data.get('records', []):
-            f = r.get('fields', {})
-            nombre = f.get('nombre', '')
-            if nombre:
-                todos.append(nombre)
+        records.extend(data.get('records', []))
         offset = data.get('offset')
         if not offset:
             break
-    resultado = sorted(set(todos))
-    _personas_cache['datos'] = resultado
-    _personas_cache['timestamp'] = _time.time()
-    return resultado
+    return _guardar_personas(records)
 
 
 def _obtener_personas():
@@ -2804,37 +5071,52 @@ def get_personas():
         return jsonify({'error': str(e)}), 500
 
 
+def _leer_asignaciones(conn, fecha, local):
+    """{conteo_id (str): [{id, persona, cantidad}]} del slice"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT a.id, a.conteo_id, a.persona, a.cantidad
+        FROM goti.asignacion_diferencias a
+        JOIN goti.inventario_ciego_conteos c ON a.conteo_id = c.id
+        WHERE c.fecha = %s AND c.local = %s
+        ORDER BY a.conteo_id, a.id
+    """, (fecha, local))
+    result = {}
+    for r in cur.fetchall():
+        cid = str(r['conteo_id'])
+        if cid not in result:
+            result[cid] = []
+        result[cid].append({
+            'id': r['id'],
+            'persona': r['persona'],
+            'cantidad': float(r['cantidad'])
+        })
+    return result
+
+
 @app.route('/api/inventario/asignaciones', methods=['GET'])
 def get_asignaciones():
     fecha = request.args.get('fecha')
     local = request.args.get('local')
     if not fecha or not local:
         return jsonify({'error': 'fecha y local son requeridos'}), 400
+    conn = None
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("""
-            SELECT a.id, a.conteo_id, a.persona, a.cantidad
-            FROM goti.asignacion_diferencias a
-            JOIN goti.inventario_ciego_conteos c ON a.conteo_id = c.id
-            WHERE c.fecha = %s AND c.local = %s
-            ORDER BY a.conteo_id, a.id
-        """, (fecha, local))
-        rows = cur.fetchall()
+        etag = _etag_slice(cur, fecha, local)
+        no_modificado = _no_modificado(etag)
+        if no_modificado:
+            return no_modificado
+        result = _leer_asignaciones(conn, fecha, local)
         release_db(conn)
-        result = {}
-        for r in rows:
-            cid = str(r['conteo_id'])
-            if cid not in result:
-                result[cid] = []
-            result[cid].append({
-                'id': r['id'],
-                'persona': r['persona'],
-                'cantidad': float(r['cantidad'])
-            })
-        return jsonify({'asignaciones': result})
+        conn = None
+        return _con_etag(jsonify({'asignaciones': result}), etag)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        if conn:
+            release_db(conn)
 
 
 @app.route('/api/inventario/guardar-asignaciones', methods=['POST'])
@@ -2887,6 +5169,38 @@ def guardar_asignaciones():
 # MÓDULO: Asignación por Sección (prototipo)
 # ============================================================
 
+def _leer_secciones(conn, fecha, local):
+    cur = conn.cursor()
+    # Secciones con productos y personas anidados (una sola consulta)
+    cur.execute("""
+        SELECT s.id, s.nombre, s.total_valor,
+               COALESCE((
+                   SELECT json_agg(json_build_object(
+                       'conteo_id', p.conteo_id, 'codigo', p.codigo, 'nombre', p.nombre,
+                       'diferencia', COALESCE(p.diferencia, 0)::float8,
+                       'costo_unitario', COALESCE(p.costo_unitario, 0)::float8,
+                       'cantidad_asignada', COALESCE(p.cantidad_asignada, 0)::float8,
+                       'valor', COALESCE(p.valor, 0)::float8
+                   ) ORDER BY p.id)
+                   FROM goti.asig_seccion_productos p WHERE p.seccion_id = s.id
+               ), '[]'::json) AS productos,
+               COALESCE((
+                   SELECT json_agg(json_build_object(
+                       'persona', pe.persona, 'monto', COALESCE(pe.monto, 0)::float8
+                   ) ORDER BY pe.id)
+                   FROM goti.asig_seccion_personas pe WHERE pe.seccion_id = s.id
+               ), '[]'::json) AS personas
+        FROM goti.asignacion_seccion s
+        WHERE s.fecha = %s AND s.local = %s
+        ORDER BY s.created_at
+    """, (fecha, local))
+    result = [{'id': r['id'], 'nombre': r['nombre'] or '',
+               'total_valor': float(r['total_valor'] or 0),
+               'productos': r['productos'], 'personas': r['personas']}
+              for r in cur.fetchall()]
+    return result
+
+
 @app.route('/api/conteo/secciones', methods=['GET'])
 def listar_secciones_conteo():
     fecha = request.args.get('fecha')
@@ -2897,39 +5211,69 @@ def listar_secciones_conteo():
     try:
         conn = get_db()
         cur = conn.cursor()
-        cur.execute("""
-            SELECT id, nombre, total_valor
-            FROM goti.asignacion_seccion
-            WHERE fecha = %s AND local = %s
-            ORDER BY created_at
-        """, (fecha, local))
-        secciones = cur.fetchall()
-        result = []
-        for s in secciones:
-            cur.execute("""
-                SELECT conteo_id, codigo, nombre, diferencia, costo_unitario, cantidad_asignada, valor
-                FROM goti.asig_seccion_productos
-                WHERE seccion_id = %s ORDER BY id
-            """, (s['id'],))
-            productos = [{'conteo_id': r['conteo_id'], 'codigo': r['codigo'],
-                          'nombre': r['nombre'], 'diferencia': float(r['diferencia'] or 0),
-                          'costo_unitario': float(r['costo_unitario'] or 0),
-                          'cantidad_asignada': float(r['cantidad_asignada'] or 0),
-                          'valor': float(r['valor'] or 0)} for r in cur.fetchall()]
-            cur.execute("""
-                SELECT persona, monto
-                FROM goti.asig_seccion_personas
-                WHERE seccion_id = %s ORDER BY id
-            """, (s['id'],))
-            personas = [{'persona': r['persona'], 'monto': float(r['monto'] or 0)} for r in cur.fetchall()]
-            result.append({'id': s['id'], 'nombre': s['nombre'] or '',
-                           'total_valor': float(s['total_valor'] or 0),
-                           'productos': productos, 'personas': personas})
-        return jsonify(result)
+        etag = _etag_slice(cur, fecha, local)
+        no_modificado = _no_modificado(etag)
+        if no_modificado:
+            return no_modificado
+        return _con_etag(jsonify(_leer_secciones(conn, fecha, local)), etag)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        if conn: release_db(conn)
+
+
+# ==================== SESION DE CONTEO (una sola llamada) ====================
+# Al abrir un local/fecha la tablet pedia consultar, observaciones-manuales, asignaciones y
+# secciones por separado. /api/conteo/sesion lo devuelve todo desde un mismo snapshot
+# (REPEATABLE READ) con un solo ETag. Con SESION_PARALELA=1 (o ?paralelo=1) las partes
+# corren en paralelo con consultas_paralelas, en conexiones que importan ese snapshot.
+SESION_PARALELA = os.environ.get('SESION_PARALELA', '') == '1'
+_SESION_PARTES = (
+    ('observaciones_manuales', _leer_obs_manuales),
+    ('asignaciones', _leer_asignaciones),
+    ('secciones', _leer_secciones),
+)
+
+
+@app.route('/api/conteo/sesion', methods=['GET'])
+def sesion_conteo():
+    """Todo lo que la tablet necesita al abrir (fecha, local):
+    {version, productos, personas, observaciones_manuales, asignaciones, secciones}.
+    Acepta ?format=columnar para productos, igual que /api/inventario/consultar."""
+    fecha = request.args.get('fecha')
+    local = request.args.get('local')
+    if not fecha or not local:
+        return jsonify({'error': 'Fecha y local son requeridos'}), 400
+    paralelo = request.args.get('paralelo', '1' if SESION_PARALELA else '') == '1'
+    columnar = _formato_columnar()
+
+    conn = None
+    try:
+        conn = get_db()
+        cur = conn.cursor()
+        # Snapshot unico: la version y todas las partes corresponden al mismo instante
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        version = _version_slice(cur, fecha, local)
+        etag = _etag_version(version, int(_personas_cache['timestamp']), 's', 'c' if columnar else 'o')
+        no_modificado = _no_modificado(etag)
+        if no_modificado:
+            return no_modificado
+
+        datos = {'version': version, 'personas': _personas_cache['datos']}
+        if columnar:
+            datos['formato'] = 'columnar'
+        consultas = {'productos': lambda c: _leer_conteos_slice(c, fecha, local, columnar)}
+        for clave, leer in _SESION_PARTES:
+            consultas[clave] = lambda c, leer=leer: leer(c, fecha, local)
+        datos.update(consultas_paralelas(conn, consultas, len(_SESION_PARTES) if paralelo else 0,
+                                         snapshot=True))
+        return _con_etag(jsonify(datos), etag)
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        print(f"Error en /api/conteo/sesion: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
     finally:
-        if conn: release_db(conn)
+        if conn:
+            release_db(conn)
 
 
 @app.route('/api/conteo/secciones/guardar', methods=['POST'])
@@ -2947,34 +5291,28 @@ def guardar_seccion_conteo():
     try:
         conn = get_db()
         cur = conn.cursor()
+        # Si un conteo_id viene repetido gana el ultimo (igual que el guardado por producto)
+        cantidades = {}
         for p in productos:
-            conteo_id = p['conteo_id']
-            cantidad_por_persona = float(p.get('cantidad_asignada', 0)) / n_personas
-            # Borrar asignaciones previas para este conteo
-            cur.execute("""
-                DELETE FROM goti.asignacion_diferencias
-                WHERE conteo_id = %s
-            """, (conteo_id,))
-            # Obtener info del producto para guardar datos auto-contenidos
-            cur.execute("""
-                SELECT codigo, nombre, unidad, local, fecha
-                FROM goti.inventario_ciego_conteos WHERE id = %s
-            """, (conteo_id,))
-            info = cur.fetchone()
-            for nombre_persona in personas:
-                if info:
-                    cur.execute("""
-                        INSERT INTO goti.asignacion_diferencias
-                            (conteo_id, persona, cantidad, codigo, nombre, unidad, local, fecha)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (conteo_id, nombre_persona.strip(), cantidad_por_persona,
-                          info['codigo'], info['nombre'], info['unidad'],
-                          info['local'], info['fecha']))
-                else:
-                    cur.execute("""
-                        INSERT INTO goti.asignacion_diferencias (conteo_id, persona, cantidad)
-                        VALUES (%s, %s, %s)
-                    """, (conteo_id, nombre_persona.strip(), cantidad_por_persona))
+            cantidades[int(p['conteo_id'])] = float(p.get('cantidad_asignada', 0)) / n_personas
+        conteo_ids = list(cantidades)
+        # Borrar asignaciones previas de todos los conteos de una vez
+        cur.execute("""
+            DELETE FROM goti.asignacion_diferencias
+            WHERE conteo_id = ANY(%s)
+        """, (conteo_ids,))
+        # productos x personas, con la info del producto tomada por join (datos auto-contenidos)
+        cur.execute("""
+            INSERT INTO goti.asignacion_diferencias
+                (conteo_id, persona, cantidad, codigo, nombre, unidad, local, fecha)
+            SELECT x.conteo_id, pe.persona, x.cantidad,
+                   c.codigo, c.nombre, c.unidad, c.local, c.fecha
+            FROM unnest(%s::int[], %s::float8[]) WITH ORDINALITY AS x(conteo_id, cantidad, orden)
+            CROSS JOIN unnest(%s::text[]) WITH ORDINALITY AS pe(persona, orden)
+            LEFT JOIN goti.inventario_ciego_conteos c ON c.id = x.conteo_id
+            ORDER BY x.orden, pe.orden
+        """, (conteo_ids, [cantidades[c] for c in conteo_ids],
+              [nombre_persona.strip() for nombre_persona in personas]))
         conn.commit()
         return jsonify({'success': True, 'productos': len(productos), 'personas': n_personas})
     except Exception as e:
@@ -3183,53 +5521,60 @@ def listar_bajas():
         if local:
             filtros.append("b.local = %s"); params.append(local)
         where = ("WHERE " + " AND ".join(filtros)) if filtros else ""
-        # Traer grupos con sus productos y asignaciones
+        # Grupos con sus productos y asignaciones anidados en una sola consulta
         cur.execute(f"""
-            SELECT b.baja_grupo,
-                   MIN(b.fecha) AS fecha,
-                   MIN(b.local) AS local,
-                   MIN(b.motivo) AS motivo,
-                   MIN(b.documento) AS documento,
-                   MIN(b.codigo_baja) AS codigo_baja,
-                   SUM(b.costo_total) AS total_costo,
-                   MIN(b.created_at) AS created_at
-            FROM goti.bajas_directas b
-            {where}
-            GROUP BY b.baja_grupo
-            ORDER BY MIN(b.created_at) DESC
+            WITH grupos AS (
+                SELECT b.baja_grupo,
+                       MIN(b.fecha) AS fecha,
+                       MIN(b.local) AS local,
+                       MIN(b.motivo) AS motivo,
+                       MIN(b.documento) AS documento,
+                       MIN(b.codigo_baja) AS codigo_baja,
+                       SUM(b.costo_total) AS total_costo,
+                       MIN(b.created_at) AS created_at
+                FROM goti.bajas_directas b
+                {where}
+                GROUP BY b.baja_grupo
+            ),
+            items AS (
+                SELECT d.baja_grupo,
+                       json_agg(json_build_object(
+                           'id', d.id, 'codigo', d.codigo, 'nombre', d.nombre, 'unidad', d.unidad,
+                           'cantidad', d.cantidad::float8,
+                           'costo_unitario', COALESCE(d.costo_unitario, 0)::float8,
+                           'costo_total', COALESCE(d.costo_total, 0)::float8
+                       ) ORDER BY d.id) AS items
+                FROM goti.bajas_directas d
+                JOIN grupos g ON g.baja_grupo = d.baja_grupo
+                GROUP BY d.baja_grupo
+            ),
+            asigs AS (
+                SELECT a.baja_grupo,
+                       json_agg(json_build_object(
+                           'id', a.id, 'persona', a.persona, 'monto', a.monto::float8
+                       ) ORDER BY a.id) AS asignaciones
+                FROM goti.bajas_asignaciones a
+                JOIN grupos g ON g.baja_grupo = a.baja_grupo
+                GROUP BY a.baja_grupo
+            )
+            SELECT g.*, i.items, a.asignaciones
+            FROM grupos g
+            LEFT JOIN items i ON i.baja_grupo = g.baja_grupo
+            LEFT JOIN asigs a ON a.baja_grupo = g.baja_grupo
+            ORDER BY g.created_at DESC
         """, params)
-        grupos = cur.fetchall()
-        result = []
-        for g in grupos:
-            grp = g['baja_grupo']
-            # Productos del grupo
-            cur.execute("""
-                SELECT id, codigo, nombre, unidad, cantidad, costo_unitario, costo_total
-                FROM goti.bajas_directas
-                WHERE baja_grupo = %s ORDER BY id
-            """, (grp,))
-            items = [{'id': r['id'], 'codigo': r['codigo'], 'nombre': r['nombre'],
-                      'unidad': r['unidad'], 'cantidad': float(r['cantidad']),
-                      'costo_unitario': float(r['costo_unitario'] or 0),
-                      'costo_total': float(r['costo_total'] or 0)} for r in cur.fetchall()]
-            # Asignaciones del grupo
-            cur.execute("""
-                SELECT id, persona, monto FROM goti.bajas_asignaciones
-                WHERE baja_grupo = %s ORDER BY id
-            """, (grp,))
-            asigs = [{'id': r['id'], 'persona': r['persona'], 'monto': float(r['monto'])} for r in cur.fetchall()]
-            result.append({
-                'baja_grupo': grp,
-                'fecha': str(g['fecha']),
-                'local': g['local'],
-                'motivo': g['motivo'] or '',
-                'documento': g['documento'] or '',
-                'codigo_baja': g['codigo_baja'] or '',
-                'total_costo': float(g['total_costo'] or 0),
-                'created_at': str(g['created_at']),
-                'items': items,
-                'asignaciones': asigs
-            })
+        result = [{
+            'baja_grupo': g['baja_grupo'],
+            'fecha': str(g['fecha']),
+            'local': g['local'],
+            'motivo': g['motivo'] or '',
+            'documento': g['documento'] or '',
+            'codigo_baja': g['codigo_baja'] or '',
+            'total_costo': float(g['total_costo'] or 0),
+            'created_at': str(g['created_at']),
+            'items': g['items'] or [],
+            'asignaciones': g['asignaciones'] or []
+        } for g in cur.fetchall()]
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -3328,6 +5673,7 @@ try:
     init_db()
 except Exception as _e:
     print(f'Startup init_db error: {_e}')
+threading.Thread(target=_mantener_particiones, daemon=True).start()
 
 # ==================== PANEL DE CONTROL ====================
 
@@ -3354,7 +5700,29 @@ def panel_consultar():
         if bodega:
             query += ' AND local = %s'
             params.append(bodega)
+
+        limite, cursor, con_total = _parametros_pagina()
+        if limite:
+            resp = _respuesta_pagina(conn, query, params,
+                                     [('q.local', 'ASC'), ("COALESCE(q.nombre, '')", 'ASC'), ('q.codigo', 'ASC')],
+                                     limite, cursor, con_total, 'data', campo_cantidad='total')
+            conn = None
+            return resp
+
         query += ' ORDER BY local, nombre'
+        modo = _modo_stream()
+        if modo:
+            enviadas = [0]
+
+            def contar(filas):
+                for r in filas:
+                    enviadas[0] += 1
+                    yield r
+
+            resp = _respuesta_stream(conn, query, params, modo, contar, 'data',
+                                     lambda: {'total': enviadas[0]})
+            conn = None
+            return resp
 
         cur.execute(query, params)
         rows = cur.fetchall()
@@ -3363,6 +5731,8 @@ def panel_consultar():
             'total': len(rows),
             'data': rows
         })
+    except CursorInvalido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -3478,20 +5848,16 @@ def listar_semanas():
         conn = get_db()
         cur = conn.cursor()
 
+        # Totales desde semanas_stats (mantenida en escrituras): un solo scan por (local, fecha_inicio).
+        # total_diferencia_valorizada sale del snapshot, que solo existe para semanas cerradas;
+        # la semana abierta (una por local) se valoriza en vivo abajo
         query = """
             SELECT s.*,
-                (SELECT COUNT(DISTINCT c.codigo)
-                 FROM goti.inventario_ciego_conteos c
-                 WHERE c.local = s.local
-                   AND c.fecha BETWEEN s.fecha_inicio AND s.fecha_fin
-                   AND (c.cantidad_contada IS NOT NULL OR c.cantidad_contada_2 IS NOT NULL)
-                ) as total_productos,
-                COALESCE((SELECT SUM(ap.monto)
-                 FROM goti.asignacion_semanal a
-                 JOIN goti.asignacion_semanal_personas ap ON ap.asignacion_semanal_id = a.id
-                 WHERE a.semana_id = s.id
-                ), 0) as total_asignado
+                   COALESCE(st.productos_contados, 0) as total_productos,
+                   COALESCE(st.total_asignado, 0) as total_asignado,
+                   st.total_diferencia_valorizada
             FROM goti.semanas_inventario s
+            LEFT JOIN goti.semanas_stats st ON st.semana_id = s.id
             WHERE s.local = %s
         """
         params = [local]
@@ -3503,12 +5869,19 @@ def listar_semanas():
             query += ' AND s.fecha_fin <= %s'
             params.append(fecha_hasta)
 
-        query += ' ORDER BY s.fecha_inicio DESC'
-        cur.execute(query, params)
-        semanas = cur.fetchall()
+        # fecha_inicio es unica por local: sirve sola como clave del keyset
+        limite, cursor, con_total = _parametros_pagina()
+        if limite:
+            pagina = _leer_pagina(conn, query, params, [('q.fecha_inicio', 'DESC')], limite, cursor, con_total)
+            semanas = pagina['filas']
+        else:
+            cur.execute(query + ' ORDER BY s.fecha_inicio DESC', params)
+            semanas = cur.fetchall()
 
         # Convert dates to strings
         for s in semanas:
+            if s['estado'] == 'abierta':
+                s['total_diferencia_valorizada'] = _valorizado_en_vivo(cur, s)
             s['fecha_inicio'] = str(s['fecha_inicio'])
             s['fecha_fin'] = str(s['fecha_fin'])
             if s.get('cerrada_at'):
@@ -3516,7 +5889,11 @@ def listar_semanas():
             if s.get('created_at'):
                 s['created_at'] = str(s['created_at'])
 
+        if limite:
+            return jsonify(_cuerpo_pagina(pagina, 'semanas'))
         return jsonify(semanas)
+    except CursorInvalido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -3585,6 +5962,7 @@ def crear_semana():
             RETURNING *
         """, (dt_inicio, dt_fin, local))
         nueva = cur.fetchone()
+        _refrescar_stats_semanas(cur, semana_id=nueva['id'])
         conn.commit()
 
         nueva['fecha_inicio'] = str(nueva['fecha_inicio'])
@@ -3602,6 +5980,103 @@ def crear_semana():
             release_db(conn)
 
 
+# Costo que se cobra incluye 20% por costos indirectos (no visible al usuario)
+FACTOR_COSTO_INDIRECTO = 1.20
+
+# Neteo semanal por producto. Params: (local, fecha_inicio, fecha_fin)
+# Resta cantidad_justificada de cada dia (justificacion parcial)
+# dif_neta = dif_dia + cantidad_justificada (dif es negativa, justif reduce el faltante)
+_SQL_NETEO_SEMANAL = """
+    WITH diferencias_diarias AS (
+        SELECT
+            codigo, nombre, unidad, fecha,
+            cantidad as stock_sistema,
+            COALESCE(cantidad_contada_2, cantidad_contada) as contado,
+            COALESCE(cantidad_contada_2, cantidad_contada) - cantidad as dif_dia,
+            COALESCE(costo_unitario, 0) as costo_unitario,
+            COALESCE(corregido, FALSE) as corregido,
+            COALESCE(justificado, FALSE) as justificado,
+            COALESCE(cantidad_justificada, 0) as cant_justif
+        FROM goti.inventario_ciego_conteos
+        WHERE local = %s AND fecha BETWEEN %s AND %s
+          AND COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
+    )
+    SELECT
+        codigo,
+        -- Una fila por codigo (unica en el snapshot): si el producto cambio de nombre o unidad
+        -- durante la semana se muestra el del ultimo dia
+        (array_agg(nombre ORDER BY fecha DESC))[1] as nombre,
+        (array_agg(unidad ORDER BY fecha DESC))[1] as unidad,
+        SUM(
+            CASE
+                WHEN dif_dia < 0 THEN LEAST(dif_dia + cant_justif, 0)
+                WHEN dif_dia > 0 THEN GREATEST(dif_dia - cant_justif, 0)
+                ELSE 0
+            END
+        ) as diferencia,
+        AVG(costo_unitario) as costo_unitario,
+        COUNT(*) as dias_contados,
+        BOOL_AND(justificado) as justificado,
+        SUM(cant_justif) as total_justificado,
+        BOOL_OR(corregido) as tiene_correccion,
+        json_agg(json_build_object(
+            'fecha', fecha,
+            'stock', stock_sistema,
+            'contado', contado,
+            'dif', dif_dia,
+            'corregido', corregido,
+            'justificado', justificado,
+            'cant_justif', cant_justif
+        ) ORDER BY fecha) as detalle_diario
+    FROM diferencias_diarias
+    GROUP BY codigo
+    HAVING SUM(CASE WHEN dif_dia < 0 THEN LEAST(dif_dia + cant_justif, 0) WHEN dif_dia > 0 THEN GREATEST(dif_dia - cant_justif, 0) ELSE 0 END) != 0
+    ORDER BY nombre
+"""
+
+
+def _materializar_snapshot_semana(cur, semana):
+    """Congela el neteo de la semana en semana_snapshot / semana_snapshot_productos"""
+    cur.execute("DELETE FROM goti.semana_snapshot_productos WHERE semana_id = %s", (semana['id'],))
+    cur.execute(f"""
+        INSERT INTO goti.semana_snapshot_productos
+            (semana_id, codigo, nombre, unidad, diferencia, costo_unitario, dias_contados,
+             justificado, total_justificado, tiene_correccion, detalle_diario)
+        SELECT %s, n.codigo, n.nombre, n.unidad, n.diferencia, n.costo_unitario, n.dias_contados,
+               n.justificado, n.total_justificado, n.tiene_correccion, n.detalle_diario
+        FROM ({_SQL_NETEO_SEMANAL}) n
+        ORDER BY n.nombre
+    """, (semana['id'], semana['local'], semana['fecha_inicio'], semana['fecha_fin']))
+    cur.execute("""
+        INSERT INTO goti.semana_snapshot (semana_id, productos, total_diferencia, total_valorizado, generado_at)
+        SELECT %s, COUNT(*), COALESCE(SUM(diferencia), 0),
+               ROUND(COALESCE(SUM(ABS(diferencia) * costo_unitario) FILTER (WHERE NOT justificado), 0) * %s, 2),
+               NOW()
+        FROM goti.semana_snapshot_productos
+        WHERE semana_id = %s
+        ON CONFLICT (semana_id) DO UPDATE SET
+            productos = EXCLUDED.productos,
+            total_diferencia = EXCLUDED.total_diferencia,
+            total_valorizado = EXCLUDED.total_valorizado,
+            generado_at = EXCLUDED.generado_at
+    """, (semana['id'], FACTOR_COSTO_INDIRECTO, semana['id']))
+
+
+def _valorizado_en_vivo(cur, semana):
+    """total_valorizado de una semana abierta (sin snapshot), con el mismo neteo y formula del cierre"""
+    cur.execute(f"""
+        SELECT ROUND(COALESCE(SUM(ABS(n.diferencia) * n.costo_unitario) FILTER (WHERE NOT n.justificado), 0) * %s, 2)
+               AS total
+        FROM ({_SQL_NETEO_SEMANAL}) n
+    """, (FACTOR_COSTO_INDIRECTO, semana['local'], semana['fecha_inicio'], semana['fecha_fin']))
+    return cur.fetchone()['total']
+
+
+def _invalidar_snapshot_semana(cur, semana_id):
+    cur.execute("DELETE FROM goti.semana_snapshot_productos WHERE semana_id = %s", (semana_id,))
+    cur.execute("DELETE FROM goti.semana_snapshot WHERE semana_id = %s", (semana_id,))
+
+
 @app.route('/api/semanas/<int:semana_id>/diferencias', methods=['GET'])
 def diferencias_semana(semana_id):
     """Obtiene diferencias semanales de productos para una semana"""
@@ -3622,58 +6097,36 @@ def diferencias_semana(semana_id):
         fecha_fin = semana['fecha_fin']
         local = semana['local']
 
-        # Netear diferencias diarias por producto en la semana
-        # Resta cantidad_justificada de cada dia (justificacion parcial)
-        # dif_neta = dif_dia + cantidad_justificada (dif es negativa, justif reduce el faltante)
-        cur.execute("""
-            WITH diferencias_diarias AS (
-                SELECT
-                    codigo, nombre, unidad, fecha,
-                    cantidad as stock_sistema,
-                    COALESCE(cantidad_contada_2, cantidad_contada) as contado,
-                    COALESCE(cantidad_contada_2, cantidad_contada) - cantidad as dif_dia,
-                    COALESCE(costo_unitario, 0) as costo_unitario,
-                    COALESCE(corregido, FALSE) as corregido,
-                    COALESCE(justificado, FALSE) as justificado,
-                    COALESCE(cantidad_justificada, 0) as cant_justif
-                FROM goti.inventario_ciego_conteos
-                WHERE local = %s AND fecha BETWEEN %s AND %s
-                  AND COALESCE(cantidad_contada_2, cantidad_contada) IS NOT NULL
-            )
-            SELECT
-                codigo,
-                nombre,
-                unidad,
-                SUM(
-                    CASE
-                        WHEN dif_dia < 0 THEN LEAST(dif_dia + cant_justif, 0)
-                        WHEN dif_dia > 0 THEN GREATEST(dif_dia - cant_justif, 0)
-                        ELSE 0
-                    END
-                ) as diferencia,
-                AVG(costo_unitario) as costo_unitario,
-                COUNT(*) as dias_contados,
-                BOOL_AND(justificado) as justificado,
-                SUM(cant_justif) as total_justificado,
-                BOOL_OR(corregido) as tiene_correccion,
-                json_agg(json_build_object(
-                    'fecha', fecha,
-                    'stock', stock_sistema,
-                    'contado', contado,
-                    'dif', dif_dia,
-                    'corregido', corregido,
-                    'justificado', justificado,
-                    'cant_justif', cant_justif
-                ) ORDER BY fecha) as detalle_diario
-            FROM diferencias_diarias
-            GROUP BY codigo, nombre, unidad
-            HAVING SUM(CASE WHEN dif_dia < 0 THEN LEAST(dif_dia + cant_justif, 0) WHEN dif_dia > 0 THEN GREATEST(dif_dia - cant_justif, 0) ELSE 0 END) != 0
-            ORDER BY nombre
-        """, (local, fecha_inicio, fecha_fin))
+        # Semanas cerradas: leer el neteo congelado (se materializa si la semana
+        # se cerro antes de existir el snapshot). Abiertas: neteo en vivo.
+        if semana['estado'] == 'cerrada':
+            cur.execute("SELECT generado_at FROM goti.semana_snapshot WHERE semana_id = %s", (semana_id,))
+            snapshot = cur.fetchone()
+            if snapshot is None:
+                # Dos primeras lecturas a la vez: una materializa, la otra espera y relee
+                cur.execute("SELECT id FROM goti.semanas_inventario WHERE id = %s FOR UPDATE", (semana_id,))
+                cur.execute("SELECT generado_at FROM goti.semana_snapshot WHERE semana_id = %s", (semana_id,))
+                snapshot = cur.fetchone()
+            if snapshot is None:
+                _materializar_snapshot_semana(cur, semana)
+                _refrescar_stats_semanas(cur, semana_id=semana_id)
+                conn.commit()
+                cur.execute("SELECT generado_at FROM goti.semana_snapshot WHERE semana_id = %s", (semana_id,))
+                snapshot = cur.fetchone()
+            # Cerrada = snapshot y asignaciones congelados: el cuerpo comprimido se reutiliza
+            _respuesta_cacheada(('diferencias', semana_id, snapshot['generado_at']))
+            cur.execute("""
+                SELECT codigo, nombre, unidad, diferencia, costo_unitario, dias_contados,
+                       justificado, total_justificado, tiene_correccion, detalle_diario
+                FROM goti.semana_snapshot_productos
+                WHERE semana_id = %s
+                ORDER BY nombre, id
+            """, (semana_id,))
+        else:
+            cur.execute(_SQL_NETEO_SEMANAL, (local, fecha_inicio, fecha_fin))
         diferencias = cur.fetchall()
 
         # Serializar datos — costo incluye 20% por costos indirectos (no visible al usuario)
-        FACTOR_COSTO_INDIRECTO = 1.20
         for d in diferencias:
             d['diferencia'] = float(d['diferencia']) if d['diferencia'] else 0
             costo_base = float(d['costo_unitario']) if d['costo_unitario'] else 0
@@ -3766,11 +6219,46 @@ def diferencias_semana(semana_id):
             release_db(conn)
 
 
+def _asignar_semana_sin_upsert(cur, semana_id, local, productos):
+    """Guardado sin indices unicos: borra e inserta los productos enviados.
+    El lock de la semana serializa guardados concurrentes (sin el no hay unicidad)."""
+    cur.execute("SELECT id FROM goti.semanas_inventario WHERE id = %s FOR UPDATE", (semana_id,))
+    cur.execute("""
+        WITH borradas AS (
+            DELETE FROM goti.asignacion_semanal
+            WHERE semana_id = %s AND codigo = ANY(%s)
+            RETURNING id
+        )
+        DELETE FROM goti.asignacion_semanal_personas
+        WHERE asignacion_semanal_id IN (SELECT id FROM borradas)
+    """, (semana_id, list(productos)))
+    ids = {}
+    for r in execute_values(cur, """
+            INSERT INTO goti.asignacion_semanal
+                (semana_id, codigo, nombre, unidad, local, diferencia_semanal, costo_unitario)
+            VALUES %s RETURNING id, codigo
+        """, [(semana_id, codigo, asig.get('nombre'), asig.get('unidad'), local,
+               asig.get('diferencia_semanal', 0), asig.get('costo_unitario', 0))
+              for codigo, (asig, _) in productos.items()],
+            page_size=len(productos), fetch=True):
+        ids[r['codigo']] = r['id']
+    filas_personas = [(ids[codigo], nombre, cantidad, monto)
+                      for codigo, (_, personas) in productos.items()
+                      for nombre, (cantidad, monto) in personas.items()]
+    if filas_personas:
+        execute_values(cur, """
+            INSERT INTO goti.asignacion_semanal_personas
+                (asignacion_semanal_id, persona, cantidad, monto)
+            VALUES %s
+        """, filas_personas, page_size=len(filas_personas))
+
+
 @app.route('/api/semanas/<int:semana_id>/asignar', methods=['POST'])
 def asignar_semana(semana_id):
     """Guarda asignaciones semanales de diferencias"""
     data = request.get_json()
     asignaciones = data.get('asignaciones', [])
+    parcial = data.get('parcial') is True  # True: solo actualiza los productos enviados
 
     conn = None
     try:
@@ -3787,52 +6275,102 @@ def asignar_semana(semana_id):
         if semana['estado'] != 'abierta':
             return jsonify({'error': 'La semana esta cerrada, no se pueden modificar asignaciones'}), 400
 
-        # Borrar asignaciones previas de esta semana
-        cur.execute("""
-            DELETE FROM goti.asignacion_semanal_personas
-            WHERE asignacion_semanal_id IN (
-                SELECT id FROM goti.asignacion_semanal WHERE semana_id = %s
-            )
-        """, (semana_id,))
-        cur.execute("""
-            DELETE FROM goti.asignacion_semanal WHERE semana_id = %s
-        """, (semana_id,))
-
-        # Insertar nuevas asignaciones
-        total_insertadas = 0
+        # Consolidar payload: un registro por codigo (gana el ultimo) y personas sumadas por nombre
+        productos = {}
         for asig in asignaciones:
+            codigo = asig.get('codigo')
+            if not codigo:
+                continue
+            costo = asig.get('costo_unitario', 0)  # ya viene con 20% desde frontend
+            personas = {}
+            for persona in asig.get('personas', []):
+                nombre = persona.get('persona')
+                if not nombre:
+                    continue
+                cantidad = persona.get('cantidad', 0)
+                monto = float(cantidad) * float(costo) if cantidad and costo else 0
+                previo = personas.get(nombre, (0, 0))
+                personas[nombre] = (previo[0] + float(cantidad or 0), previo[1] + round(monto, 2))
+            productos[codigo] = (asig, personas)
+
+        # Guardado completo: quitar los productos que ya no vienen (parcial=true solo toca los enviados)
+        eliminados = 0
+        if not parcial:
             cur.execute("""
+                WITH borradas AS (
+                    DELETE FROM goti.asignacion_semanal
+                    WHERE semana_id = %s AND codigo <> ALL(%s)
+                    RETURNING id
+                ), personas_borradas AS (
+                    DELETE FROM goti.asignacion_semanal_personas
+                    WHERE asignacion_semanal_id IN (SELECT id FROM borradas)
+                )
+                SELECT COUNT(*) AS n FROM borradas
+            """, (semana_id, list(productos)))
+            eliminados = cur.fetchone()['n']
+
+        if productos and not _asig_semanal_unica:
+            _asignar_semana_sin_upsert(cur, semana_id, semana['local'], productos)
+        elif productos:
+            # Upsert de productos: solo se reescriben las filas que cambiaron
+            execute_values(cur, """
                 INSERT INTO goti.asignacion_semanal
                     (semana_id, codigo, nombre, unidad, local, diferencia_semanal, costo_unitario)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (
-                semana_id,
-                asig.get('codigo'),
-                asig.get('nombre'),
-                asig.get('unidad'),
-                semana['local'],
-                asig.get('diferencia_semanal', 0),
-                asig.get('costo_unitario', 0)
-            ))
-            asig_id = cur.fetchone()['id']
+                VALUES %s
+                ON CONFLICT (semana_id, codigo) DO UPDATE SET
+                    nombre = EXCLUDED.nombre,
+                    unidad = EXCLUDED.unidad,
+                    local = EXCLUDED.local,
+                    diferencia_semanal = EXCLUDED.diferencia_semanal,
+                    costo_unitario = EXCLUDED.costo_unitario
+                WHERE (goti.asignacion_semanal.nombre, goti.asignacion_semanal.unidad,
+                       goti.asignacion_semanal.local, goti.asignacion_semanal.diferencia_semanal,
+                       goti.asignacion_semanal.costo_unitario)
+                      IS DISTINCT FROM
+                      (EXCLUDED.nombre, EXCLUDED.unidad, EXCLUDED.local,
+                       EXCLUDED.diferencia_semanal, EXCLUDED.costo_unitario)
+            """, [(semana_id, codigo, asig.get('nombre'), asig.get('unidad'), semana['local'],
+                   asig.get('diferencia_semanal', 0), asig.get('costo_unitario', 0))
+                  for codigo, (asig, _) in productos.items()],
+                page_size=len(productos))
 
-            for persona in asig.get('personas', []):
-                cantidad = persona.get('cantidad', 0)
-                costo = asig.get('costo_unitario', 0)  # ya viene con 20% desde frontend
-                monto = float(cantidad) * float(costo) if cantidad and costo else 0
-                cur.execute("""
+            cur.execute("""
+                SELECT id, codigo FROM goti.asignacion_semanal
+                WHERE semana_id = %s AND codigo = ANY(%s)
+            """, (semana_id, list(productos)))
+            ids = {r['codigo']: r['id'] for r in cur.fetchall()}
+
+            filas_personas = [(ids[codigo], nombre, cantidad, monto)
+                              for codigo, (_, personas) in productos.items()
+                              for nombre, (cantidad, monto) in personas.items()]
+            # Quitar personas que ya no estan asignadas a esos productos
+            cur.execute("""
+                DELETE FROM goti.asignacion_semanal_personas ap
+                WHERE ap.asignacion_semanal_id = ANY(%s)
+                  AND NOT EXISTS (
+                      SELECT 1 FROM unnest(%s::int[], %s::text[]) AS n(asig_id, persona)
+                      WHERE n.asig_id = ap.asignacion_semanal_id AND n.persona = ap.persona
+                  )
+            """, (list(ids.values()), [f[0] for f in filas_personas], [f[1] for f in filas_personas]))
+            if filas_personas:
+                execute_values(cur, """
                     INSERT INTO goti.asignacion_semanal_personas
                         (asignacion_semanal_id, persona, cantidad, monto)
-                    VALUES (%s, %s, %s, %s)
-                """, (asig_id, persona.get('persona'), cantidad, round(monto, 2)))
-
-            total_insertadas += 1
-
+                    VALUES %s
+                    ON CONFLICT (asignacion_semanal_id, persona) DO UPDATE SET
+                        cantidad = EXCLUDED.cantidad,
+                        monto = EXCLUDED.monto
+                    WHERE (goti.asignacion_semanal_personas.cantidad, goti.asignacion_semanal_personas.monto)
+                          IS DISTINCT FROM (EXCLUDED.cantidad, EXCLUDED.monto)
+                """, filas_personas, page_size=len(filas_personas))
+
+        total_insertadas = len(productos)
+        _refrescar_stats_semanas(cur, semana_id=semana_id)
         conn.commit()
         return jsonify({
             'ok': True,
-            'message': f'{total_insertadas} asignaciones guardadas para semana {semana_id}'
+            'message': f'{total_insertadas} asignaciones guardadas para semana {semana_id}',
+            'eliminadas': eliminados
         })
     except Exception as e:
         if conn:
@@ -3855,7 +6393,7 @@ def cerrar_semana(semana_id):
         cur = conn.cursor()
 
         cur.execute("""
-            SELECT estado FROM goti.semanas_inventario WHERE id = %s
+            SELECT * FROM goti.semanas_inventario WHERE id = %s
         """, (semana_id,))
         semana = cur.fetchone()
         if not semana:
@@ -3863,6 +6401,11 @@ def cerrar_semana(semana_id):
         if semana['estado'] != 'abierta':
             return jsonify({'error': 'La semana ya esta cerrada'}), 400
 
+        # Congelar el neteo de la semana en la misma transaccion del cierre
+        _materializar_snapshot_semana(cur, semana)
+        _refrescar_stats_semanas(cur, semana_id=semana_id)
+        _ledger_registrar_cargos(cur, semana_id)
+
         cur.execute("""
             UPDATE goti.semanas_inventario
             SET estado = 'cerrada', cerrada_por = %s, cerrada_at = NOW()
@@ -3914,6 +6457,9 @@ def eliminar_semana(semana_id):
         """, (semana_id,))
         # Eliminar asignaciones
         cur.execute("DELETE FROM goti.asignacion_semanal WHERE semana_id = %s", (semana_id,))
+        _invalidar_snapshot_semana(cur, semana_id)
+        cur.execute("DELETE FROM goti.semanas_stats WHERE semana_id = %s", (semana_id,))
+        _ledger_reversar_semana(cur, semana_id)
         # Eliminar semana
         cur.execute("DELETE FROM goti.semanas_inventario WHERE id = %s", (semana_id,))
         conn.commit()
@@ -3949,6 +6495,9 @@ def reabrir_semana(semana_id):
             RETURNING *
         """, (semana_id,))
         updated = cur.fetchone()
+        _invalidar_snapshot_semana(cur, semana_id)
+        _ledger_reversar_semana(cur, semana_id)
+        _refrescar_stats_semanas(cur, semana_id=semana_id)
         conn.commit()
 
         updated['fecha_inicio'] = str(updated['fecha_inicio'])
@@ -4012,26 +6561,25 @@ def resumen_persona_semanal():
         conn = get_db()
         cur = conn.cursor()
 
+        # Cargos vigentes del ledger (solo semanas cerradas)
         query = """
-            SELECT ap.persona,
-                   SUM(ap.cantidad) as total_cantidad,
-                   SUM(ap.monto) as total_monto,
-                   COUNT(DISTINCT a.semana_id) as semanas_count
-            FROM goti.asignacion_semanal_personas ap
-            JOIN goti.asignacion_semanal a ON a.id = ap.asignacion_semanal_id
-            JOIN goti.semanas_inventario s ON s.id = a.semana_id
-            WHERE s.local = %s AND s.estado = 'cerrada'
+            SELECT v.persona,
+                   SUM(v.cantidad) as total_cantidad,
+                   SUM(v.monto) as total_monto,
+                   COUNT(DISTINCT v.semana_id) as semanas_count
+            FROM goti.descuentos_vigentes v
+            WHERE v.local = %s
         """
         params = [local]
 
         if fecha_desde:
-            query += ' AND s.fecha_inicio >= %s'
+            query += ' AND v.fecha_inicio >= %s'
             params.append(fecha_desde)
         if fecha_hasta:
-            query += ' AND s.fecha_fin <= %s'
+            query += ' AND v.fecha_fin <= %s'
             params.append(fecha_hasta)
 
-        query += ' GROUP BY ap.persona ORDER BY total_monto DESC'
+        query += ' GROUP BY v.persona ORDER BY total_monto DESC'
         cur.execute(query, params)
         resumen = cur.fetchall()
 
@@ -4321,7 +6869,7 @@ def cruce_op_estado(ejec_id):
             'total_productos_contifico': r['total_productos_contifico'],
             'total_cruzados': r['total_cruzados'],
             'total_con_diferencia': r['total_con_diferencia'],
-            'valor_total_dif': float(r['valor_total_dif']) if r['valor_total_dif'] is not None else None,
+            'valor_total_dif': r['valor_total_dif'],
         })
     except Exception as e:
         print(f"Error en /api/cruce-op/estado: {e}")
@@ -4834,19 +7382,34 @@ _tiendas_cache_ts = 0
 def _at_headers():
     return {'Authorization': f'Bearer {AIRTABLE_DEPOSITOS_TOKEN}'}
 
-def _cargar_tiendas():
-    global _tiendas_cache, _tiendas_cache_ts
+_DEPOSITOS_URL = f'https://api.airtable.com/v0/{AIRTABLE_DEPOSITOS_BASE}/{AIRTABLE_DEPOSITOS_TABLE}'
+_TIENDAS_URL = f'https://api.airtable.com/v0/{AIRTABLE_DEPOSITOS_BASE}/{AIRTABLE_TIENDAS_TABLE}'
+_TIENDAS_PARAMS = {'fields[]': ['Código', 'Marca']}
+TIENDAS_CACHE_TTL = 600
+DEPOSITOS_LISTAR_MAX = 500
+
+
+def _tiendas_vigentes():
+    import time as _t
+    return bool(_tiendas_cache) and (_t.time() - _tiendas_cache_ts) < TIENDAS_CACHE_TTL
+
+
+def _guardar_tiendas(records):
+    global _tiendas_cache_ts
     import time as _t
-    if _tiendas_cache and (_t.time() - _tiendas_cache_ts) < 600:
+    for rec in records:
+        _tiendas_cache[rec['id']] = rec['fields'].get('Código', rec['id'])
+    _tiendas_cache_ts = _t.time()
+
+
+def _cargar_tiendas():
+    if _tiendas_vigentes():
         return _tiendas_cache
     try:
         import requests as req
-        r = req.get(f'https://api.airtable.com/v0/{AIRTABLE_DEPOSITOS_BASE}/{AIRTABLE_TIENDAS_TABLE}',
-            headers=_at_headers(), params={'fields[]': ['Código', 'Marca']}, timeout=15)
+        r = req.get(_TIENDAS_URL, headers=_at_headers(), params=_TIENDAS_PARAMS, timeout=15)
         if r.status_code == 200:
-            for rec in r.json().get('records', []):
-                _tiendas_cache[rec['id']] = rec['fields'].get('Código', rec['id'])
-            _tiendas_cache_ts = _t.time()
+            _guardar_tiendas(r.json().get('records', []))
     except Exception as e:
         print(f'Error cargando tiendas: {e}')
     return _tiendas_cache
@@ -4859,117 +7422,167 @@ def _resolver_local(local_ids):
     return ', '.join(nombres)
 
 
+def _filtros_fecha_depositos(args):
+    filtros = []
+    if args.get('fecha_desde'):
+        filtros.append(f"IS_AFTER({{Fecha}}, '{args.get('fecha_desde')}')")
+    if args.get('fecha_hasta'):
+        filtros.append(f"IS_BEFORE({{Fecha}}, DATEADD('{args.get('fecha_hasta')}', 1, 'day'))")
+    return filtros
+
+
+def _params_depositos_listar(args):
+    """Parametros de Airtable para /api/depositos/listar (tambien los usa el modo ASGI)"""
+    estado = args.get('estado', '')
+    cuadre = args.get('cuadre', '')
+    # Construir formula de filtro
+    filtros = _filtros_fecha_depositos(args)
+    if estado:
+        filtros.append(f"{{Estado}} = '{estado}'")
+    if cuadre:
+        filtros.append(f"{{Estado De Cuadre}} = '{cuadre}'")
+
+    params = {
+        'pageSize': 100,
+        'sort[0][field]': 'Fecha',
+        'sort[0][direction]': 'desc',
+        'fields[]': ['Fecha', 'Local', 'Responsable De Caja', 'Monto Contado',
+                     'Monto A Recibir', 'Diferencia Contado Vs. Recibido',
+                     'Secuencia De Caja', 'Número De Depósitos', 'Estado',
+                     'Estado De Cuadre', 'Observación', 'Evidencia', 'Evidencia Del Déposito',
+                     'Fecha Creación', 'Correo (from Responsable De Caja)'],
+    }
+    if filtros:
+        params['filterByFormula'] = 'AND(' + ','.join(filtros) + ')'
+    return params
+
+
+def _armar_depositos(all_records):
+    """Registros de Airtable -> {depositos, total} con los locales resueltos"""
+    resultado = []
+    for rec in all_records:
+        f = rec['fields']
+        evidencias = []
+        for att in (f.get('Evidencia', []) + f.get('Evidencia Del Déposito', [])):
+            if isinstance(att, dict):
+                thumb = att.get('thumbnails', {}).get('large', {}).get('url', '')
+                evidencias.append({'url': att.get('url', ''), 'thumb': thumb, 'filename': att.get('filename', '')})
+
+        resultado.append({
+            'id': rec['id'],
+            'fecha': f.get('Fecha'),
+            'local': _resolver_local(f.get('Local', [])),
+            'monto_contado': f.get('Monto Contado', 0),
+            'monto_recibir': f.get('Monto A Recibir', 0),
+            'diferencia': f.get('Diferencia Contado Vs. Recibido', 0),
+            'secuencia': f.get('Secuencia De Caja'),
+            'num_depositos': f.get('Número De Depósitos'),
+            'estado': f.get('Estado', ''),
+            'cuadre': f.get('Estado De Cuadre', ''),
+            'observacion': f.get('Observación', ''),
+            'evidencias': evidencias,
+            'fecha_creacion': f.get('Fecha Creación'),
+            'responsable_email': (f.get('Correo (from Responsable De Caja)', [None]) or [None])[0],
+        })
+    return {'depositos': resultado, 'total': len(resultado)}
+
+
 @app.route('/api/depositos/listar', methods=['GET'])
 def depositos_listar():
     """Lista depositos desde AirTable con filtros."""
     import requests as req
-    fecha_desde = request.args.get('fecha_desde')
-    fecha_hasta = request.args.get('fecha_hasta')
-    estado = request.args.get('estado', '')
-    cuadre = request.args.get('cuadre', '')
-
     try:
-        # Construir formula de filtro
-        filtros = []
-        if fecha_desde:
-            filtros.append(f"IS_AFTER({{Fecha}}, '{fecha_desde}')")
-        if fecha_hasta:
-            filtros.append(f"IS_BEFORE({{Fecha}}, DATEADD('{fecha_hasta}', 1, 'day'))")
-        if estado:
-            filtros.append(f"{{Estado}} = '{estado}'")
-        if cuadre:
-            filtros.append(f"{{Estado De Cuadre}} = '{cuadre}'")
-
-        params = {
-            'pageSize': 100,
-            'sort[0][field]': 'Fecha',
-            'sort[0][direction]': 'desc',
-            'fields[]': ['Fecha', 'Local', 'Responsable De Caja', 'Monto Contado',
-                         'Monto A Recibir', 'Diferencia Contado Vs. Recibido',
-                         'Secuencia De Caja', 'Número De Depósitos', 'Estado',
-                         'Estado De Cuadre', 'Observación', 'Evidencia', 'Evidencia Del Déposito',
-                         'Fecha Creación', 'Correo (from Responsable De Caja)'],
-        }
-        if filtros:
-            params['filterByFormula'] = 'AND(' + ','.join(filtros) + ')'
-
+        params = _params_depositos_listar(request.args)
         all_records = []
         offset = None
         while True:
             if offset:
                 params['offset'] = offset
-            r = req.get(f'https://api.airtable.com/v0/{AIRTABLE_DEPOSITOS_BASE}/{AIRTABLE_DEPOSITOS_TABLE}',
-                headers=_at_headers(), params=params, timeout=20)
+            r = req.get(_DEPOSITOS_URL, headers=_at_headers(), params=params, timeout=20)
             if r.status_code != 200:
                 return jsonify({'error': f'AirTable error: {r.status_code}'}), 500
             data = r.json()
             all_records.extend(data.get('records', []))
             offset = data.get('offset')
-            if not offset or len(all_records) >= 500:
+            if not offset or len(all_records) >= DEPOSITOS_LISTAR_MAX:
                 break
 
-        # Resolver locales
-        resultado = []
-        for rec in all_records:
-            f = rec['fields']
-            evidencias = []
-            for att in (f.get('Evidencia', []) + f.get('Evidencia Del Déposito', [])):
-                if isinstance(att, dict):
-                    thumb = att.get('thumbnails', {}).get('large', {}).get('url', '')
-                    evidencias.append({'url': att.get('url', ''), 'thumb': thumb, 'filename': att.get('filename', '')})
-
-            resultado.append({
-                'id': rec['id'],
-                'fecha': f.get('Fecha'),
-                'local': _resolver_local(f.get('Local', [])),
-                'monto_contado': f.get('Monto Contado', 0),
-                'monto_recibir': f.get('Monto A Recibir', 0),
-                'diferencia': f.get('Diferencia Contado Vs. Recibido', 0),
-                'secuencia': f.get('Secuencia De Caja'),
-                'num_depositos': f.get('Número De Depósitos'),
-                'estado': f.get('Estado', ''),
-                'cuadre': f.get('Estado De Cuadre', ''),
-                'observacion': f.get('Observación', ''),
-                'evidencias': evidencias,
-                'fecha_creacion': f.get('Fecha Creación'),
-                'responsable_email': (f.get('Correo (from Responsable De Caja)', [None]) or [None])[0],
-            })
-
-        return jsonify({'depositos': resultado, 'total': len(resultado)})
+        return jsonify(_armar_depositos(all_records))
     except Exception as e:
         print(f'Error en depositos_listar: {e}')
         return jsonify({'error': str(e)[:200]}), 500
 
 
+def _params_depositos_resumen(args):
+    filtros = _filtros_fecha_depositos(args)
+    params = {
+        'pageSize': 100,
+        'fields[]': ['Fecha', 'Local', 'Monto Contado', 'Monto A Recibir',
+                     'Diferencia Contado Vs. Recibido', 'Estado', 'Estado De Cuadre'],
+    }
+    if filtros:
+        params['filterByFormula'] = 'AND(' + ','.join(filtros) + ')'
+    return params
+
+
+def _armar_resumen_depositos(all_records):
+    total_depositado = 0
+    total_recibido = 0
+    total_diferencia = 0
+    descuadres = 0
+    cuadran = 0
+    por_local = {}
+    pendientes = 0
+
+    for rec in all_records:
+        f = rec['fields']
+        monto = f.get('Monto Contado', 0) or 0
+        recibido = f.get('Monto A Recibir', 0) or 0
+        dif = f.get('Diferencia Contado Vs. Recibido', 0) or 0
+        total_depositado += monto
+        total_recibido += recibido
+        total_diferencia += abs(dif)
+
+        if f.get('Estado De Cuadre') == 'Descuadra':
+            descuadres += 1
+        elif f.get('Estado De Cuadre') == 'Cuadra':
+            cuadran += 1
+
+        if f.get('Estado') not in ('Aprobado por Contabilidad',):
+            pendientes += 1
+
+        local = _resolver_local(f.get('Local', []))
+        if local not in por_local:
+            por_local[local] = {'monto': 0, 'depositos': 0, 'descuadres': 0}
+        por_local[local]['monto'] += monto
+        por_local[local]['depositos'] += 1
+        if f.get('Estado De Cuadre') == 'Descuadra':
+            por_local[local]['descuadres'] += 1
+
+    return {
+        'total_depositos': len(all_records),
+        'total_depositado': round(total_depositado, 2),
+        'total_recibido': round(total_recibido, 2),
+        'total_diferencia': round(total_diferencia, 2),
+        'cuadran': cuadran,
+        'descuadres': descuadres,
+        'pendientes': pendientes,
+        'por_local': por_local,
+    }
+
+
 @app.route('/api/depositos/resumen', methods=['GET'])
 def depositos_resumen():
     """Resumen/KPIs de depositos."""
     import requests as req
-    fecha_desde = request.args.get('fecha_desde')
-    fecha_hasta = request.args.get('fecha_hasta')
-
     try:
-        filtros = []
-        if fecha_desde:
-            filtros.append(f"IS_AFTER({{Fecha}}, '{fecha_desde}')")
-        if fecha_hasta:
-            filtros.append(f"IS_BEFORE({{Fecha}}, DATEADD('{fecha_hasta}', 1, 'day'))")
-
-        params = {
-            'pageSize': 100,
-            'fields[]': ['Fecha', 'Local', 'Monto Contado', 'Monto A Recibir',
-                         'Diferencia Contado Vs. Recibido', 'Estado', 'Estado De Cuadre'],
-        }
-        if filtros:
-            params['filterByFormula'] = 'AND(' + ','.join(filtros) + ')'
-
+        params = _params_depositos_resumen(request.args)
         all_records = []
         offset = None
         while True:
             if offset:
                 params['offset'] = offset
-            r = req.get(f'https://api.airtable.com/v0/{AIRTABLE_DEPOSITOS_BASE}/{AIRTABLE_DEPOSITOS_TABLE}',
-                headers=_at_headers(), params=params, timeout=20)
+            r = req.get(_DEPOSITOS_URL, headers=_at_headers(), params=params, timeout=20)
             if r.status_code != 200:
                 break
             data = r.json()
@@ -4978,49 +7591,7 @@ def depositos_resumen():
             if not offset:
                 break
 
-        total_depositado = 0
-        total_recibido = 0
-        total_diferencia = 0
-        descuadres = 0
-        cuadran = 0
-        por_local = {}
-        pendientes = 0
-
-        for rec in all_records:
-            f = rec['fields']
-            monto = f.get('Monto Contado', 0) or 0
-            recibido = f.get('Monto A Recibir', 0) or 0
-            dif = f.get('Diferencia Contado Vs. Recibido', 0) or 0
-            total_depositado += monto
-            total_recibido += recibido
-            total_diferencia += abs(dif)
-
-            if f.get('Estado De Cuadre') == 'Descuadra':
-                descuadres += 1
-            elif f.get('Estado De Cuadre') == 'Cuadra':
-                cuadran += 1
-
-            if f.get('Estado') not in ('Aprobado por Contabilidad',):
-                pendientes += 1
-
-            local = _resolver_local(f.get('Local', []))
-            if local not in por_local:
-                por_local[local] = {'monto': 0, 'depositos': 0, 'descuadres': 0}
-            por_local[local]['monto'] += monto
-            por_local[local]['depositos'] += 1
-            if f.get('Estado De Cuadre') == 'Descuadra':
-                por_local[local]['descuadres'] += 1
-
-        return jsonify({
-            'total_depositos': len(all_records),
-            'total_depositado': round(total_depositado, 2),
-            'total_recibido': round(total_recibido, 2),
-            'total_diferencia': round(total_diferencia, 2),
-            'cuadran': cuadran,
-            'descuadres': descuadres,
-            'pendientes': pendientes,
-            'por_local': por_local,
-        })
+        return jsonify(_armar_resumen_depositos(all_records))
     except Exception as e:
         print(f'Error en depositos_resumen: {e}')
         return jsonify({'error': str(e)[:200]}), 500
@@ -5552,70 +8123,60 @@ def descuentos_reporte():
     fecha_desde = request.args.get('fecha_desde')
     fecha_hasta = request.args.get('fecha_hasta')
     local = request.args.get('local', '')
+    persona = request.args.get('persona', '')
     solo_cerradas = request.args.get('solo_cerradas', '1')
     conn = None
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        params = []
-        where = ""
-        if fecha_desde:
-            where += " AND s.fecha_inicio >= %s"; params.append(fecha_desde)
-        if fecha_hasta:
-            where += " AND s.fecha_fin <= %s"; params.append(fecha_hasta)
-        if local:
-            where += " AND s.local = %s"; params.append(local)
-        if solo_cerradas == '1':
-            where += " AND s.estado = 'cerrada'"
-
-        # Detalle por persona, semana, local y producto
-        cur.execute(f"""
-            SELECT ap.persona,
-                   s.fecha_inicio, s.fecha_fin, s.local,
-                   a.codigo, a.nombre, a.unidad,
-                   ap.cantidad, ap.monto,
-                   a.costo_unitario, a.diferencia_semanal
-            FROM goti.asignacion_semanal_personas ap
-            JOIN goti.asignacion_semanal a ON a.id = ap.asignacion_semanal_id
-            JOIN goti.semanas_inventario s ON s.id = a.semana_id
-            WHERE 1=1 {where}
-            ORDER BY ap.persona, s.fecha_inicio, s.local, a.nombre
-        """, params)
-        detalle = [dict(r) for r in cur.fetchall()]
-
-        # Resumen por persona
-        cur.execute(f"""
-            SELECT ap.persona,
-                   COUNT(DISTINCT s.id) as semanas,
-                   COUNT(DISTINCT s.local) as locales,
-                   COALESCE(SUM(ap.monto), 0) as total_monto
-            FROM goti.asignacion_semanal_personas ap
-            JOIN goti.asignacion_semanal a ON a.id = ap.asignacion_semanal_id
-            JOIN goti.semanas_inventario s ON s.id = a.semana_id
-            WHERE 1=1 {where}
-            GROUP BY ap.persona
-            ORDER BY total_monto DESC
-        """, params)
-        resumen = [dict(r) for r in cur.fetchall()]
-
-        # Semanas incluidas
-        cur.execute(f"""
-            SELECT DISTINCT s.fecha_inicio, s.fecha_fin, s.local, s.estado
-            FROM goti.semanas_inventario s
-            JOIN goti.asignacion_semanal a ON a.semana_id = s.id
-            JOIN goti.asignacion_semanal_personas ap ON ap.asignacion_semanal_id = a.id
-            WHERE 1=1 {where}
-            ORDER BY s.fecha_inicio, s.local
-        """, params)
-        semanas = [dict(r) for r in cur.fetchall()]
+        # Detalle por persona, semana, local y producto; resumen y semanas se derivan de el
+        sql, params = _sql_descuentos(fecha_desde, fecha_hasta, local, solo_cerradas == '1', persona)
+        por_persona = {}
+        semanas_set = {}
+
+        def acumular(filas):
+            for r in filas:
+                r = dict(r)
+                p = por_persona.setdefault(r['persona'], {'persona': r['persona'], 'semanas': set(),
+                                                          'locales': set(), 'total_monto': 0})
+                p['semanas'].add((r['fecha_inicio'], r['local']))
+                p['locales'].add(r['local'])
+                p['total_monto'] += r['monto'] or 0
+                semanas_set[(r['fecha_inicio'], r['local'])] = {
+                    'fecha_inicio': r['fecha_inicio'], 'fecha_fin': r['fecha_fin'],
+                    'local': r['local'], 'estado': r.pop('estado')}
+                yield r
+
+        def totales():
+            resumen = [{'persona': p['persona'], 'semanas': len(p['semanas']),
+                        'locales': len(p['locales']), 'total_monto': p['total_monto']}
+                       for p in por_persona.values()]
+            resumen.sort(key=lambda x: x['total_monto'], reverse=True)
+            return {
+                'resumen': resumen,
+                'semanas': [semanas_set[k] for k in sorted(semanas_set)],
+                'total_personas': len(resumen),
+                'total_descuento': sum(float(r['total_monto']) for r in resumen)
+            }
 
-        return jsonify({
-            'resumen': resumen,
-            'detalle': detalle,
-            'semanas': semanas,
-            'total_personas': len(resumen),
-            'total_descuento': sum(float(r['total_monto']) for r in resumen)
-        })
+        modo = _modo_stream()
+        if modo:
+            # El detalle sale en streaming; resumen y semanas se escriben al final del objeto
+            conn = get_db()
+            resp = _respuesta_stream(conn, sql, params, modo, acumular, 'detalle', totales)
+            conn = None
+            return resp
+
+        def calcular(conn):
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            detalle = list(acumular(cur.fetchall()))
+            cuerpo = totales()
+            cuerpo['detalle'] = detalle
+            return cuerpo
+        # Ledger, asignaciones semanales y semanas no tienen trigger de version (en los dos modos):
+        # la version de conteos no ve un asignar/cerrar/reabrir, asi que solo unos segundos en memoria
+        return _reporte_compartido(
+            lambda cur: _version_rango(cur, fecha_desde or None, fecha_hasta or None, [local]),
+            calcular, ttl=REPORTES_TTL)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -5632,42 +8193,16 @@ def descuentos_exportar_excel():
     try:
         conn = get_db()
         cur = conn.cursor()
-        params = []
-        where = ""
-        if fecha_desde:
-            where += " AND s.fecha_inicio >= %s"; params.append(fecha_desde)
-        if fecha_hasta:
-            where += " AND s.fecha_fin <= %s"; params.append(fecha_hasta)
-        if local:
-            where += " AND s.local = %s"; params.append(local)
-        if solo_cerradas == '1':
-            where += " AND s.estado = 'cerrada'"
+        detalle = _consultar_descuentos(cur, fecha_desde, fecha_hasta, local, solo_cerradas == '1')
 
         # Resumen por persona
-        cur.execute(f"""
-            SELECT ap.persona,
-                   COUNT(DISTINCT s.id) as semanas,
-                   COALESCE(SUM(ap.monto), 0) as total_monto
-            FROM goti.asignacion_semanal_personas ap
-            JOIN goti.asignacion_semanal a ON a.id = ap.asignacion_semanal_id
-            JOIN goti.semanas_inventario s ON s.id = a.semana_id
-            WHERE 1=1 {where}
-            GROUP BY ap.persona
-            ORDER BY ap.persona
-        """, params)
-        resumen = cur.fetchall()
-
-        # Detalle
-        cur.execute(f"""
-            SELECT ap.persona, s.fecha_inicio, s.fecha_fin, s.local,
-                   a.codigo, a.nombre, ap.cantidad, ap.monto, a.costo_unitario
-            FROM goti.asignacion_semanal_personas ap
-            JOIN goti.asignacion_semanal a ON a.id = ap.asignacion_semanal_id
-            JOIN goti.semanas_inventario s ON s.id = a.semana_id
-            WHERE 1=1 {where}
-            ORDER BY ap.persona, s.fecha_inicio, s.local
-        """, params)
-        detalle = cur.fetchall()
+        por_persona = {}
+        for r in detalle:
+            p = por_persona.setdefault(r['persona'], {'persona': r['persona'], 'semanas': set(), 'total_monto': 0})
+            p['semanas'].add((r['fecha_inicio'], r['local']))
+            p['total_monto'] += r['monto'] or 0
+        resumen = [{'persona': k, 'semanas': len(v['semanas']), 'total_monto': v['total_monto']}
+                   for k, v in sorted(por_persona.items())]
 
         wb = Workbook()
         # Hoja 1: Resumen por persona
@@ -5747,10 +8282,19 @@ def cuadres_listar():
             sql += " AND fecha <= %s"; params.append(fecha_hasta)
         if local:
             sql += " AND local = %s"; params.append(local)
+        limite, cursor, con_total = _parametros_pagina()
+        if limite:
+            resp = _respuesta_pagina(conn, sql, params,
+                                     [('q.fecha', 'DESC', True), ('q.local', 'ASC', True), ('q.id', 'ASC')],
+                                     limite, cursor, con_total, 'cuadres')
+            conn = None
+            return resp
         sql += " ORDER BY fecha DESC, local"
         cur.execute(sql, params)
         rows = cur.fetchall()
         return jsonify({'cuadres': [dict(r) for r in rows]})
+    except CursorInvalido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -5818,38 +8362,51 @@ def cuadres_eliminar(cuadre_id):
     finally:
         if conn: release_db(conn)
 
-@app.route('/api/cuadres/resumen', methods=['GET'])
-def cuadres_resumen():
-    fecha_desde = request.args.get('fecha_desde')
-    fecha_hasta = request.args.get('fecha_hasta')
-    conn = None
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        params = []
-        where = ""
-        if fecha_desde:
-            where += " AND fecha >= %s"; params.append(fecha_desde)
-        if fecha_hasta:
-            where += " AND fecha <= %s"; params.append(fecha_hasta)
-        cur.execute(f"""
+def _armar_resumen(res):
+    """Resumen de consultas_paralelas: la fila de 'resumen' mas las demas consultas como listas"""
+    resumen = dict(res['resumen'][0])
+    for nombre, filas in res.items():
+        if nombre != 'resumen':
+            resumen[nombre] = [dict(r) for r in filas]
+    return resumen
+
+
+def _consultas_resumen_cuadres(args):
+    """Consultas de /api/cuadres/resumen (las usa tambien el modo ASGI)"""
+    fecha_desde = args.get('fecha_desde')
+    fecha_hasta = args.get('fecha_hasta')
+    params = []
+    where = ""
+    if fecha_desde:
+        where += " AND fecha >= %s"; params.append(fecha_desde)
+    if fecha_hasta:
+        where += " AND fecha <= %s"; params.append(fecha_hasta)
+    return {
+        'resumen': (f"""
             SELECT COUNT(*) as total,
                    COALESCE(SUM(ABS(diferencia)),0) as total_diferencia,
                    COALESCE(AVG(diferencia),0) as avg_diferencia,
                    COALESCE(SUM(venta_sistema),0) as total_ventas,
                    COUNT(CASE WHEN ABS(diferencia) > 1 THEN 1 END) as con_descuadre
             FROM goti.cuadres_caja WHERE 1=1 {where}
-        """, params)
-        resumen = dict(cur.fetchone())
-        cur.execute(f"""
+        """, params),
+        'por_local': (f"""
             SELECT local, COUNT(*) as cuadres, COALESCE(SUM(diferencia),0) as diferencia_total,
                    COALESCE(SUM(ABS(diferencia)),0) as diferencia_abs,
                    COALESCE(AVG(diferencia),0) as diferencia_avg
             FROM goti.cuadres_caja WHERE 1=1 {where}
             GROUP BY local ORDER BY diferencia_abs DESC
-        """, params)
-        resumen['por_local'] = [dict(r) for r in cur.fetchall()]
-        return jsonify(resumen)
+        """, params),
+    }
+
+
+@app.route('/api/cuadres/resumen', methods=['GET'])
+def cuadres_resumen():
+    conn = None
+    try:
+        conn = get_db()
+        res = consultas_paralelas(conn, _consultas_resumen_cuadres(request.args))
+        return jsonify(_armar_resumen(res))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -5878,10 +8435,20 @@ def delivery_listar():
             sql += " AND local = %s"; params.append(local)
         if plataforma:
             sql += " AND plataforma = %s"; params.append(plataforma)
+        limite, cursor, con_total = _parametros_pagina()
+        if limite:
+            resp = _respuesta_pagina(conn, sql, params,
+                                     [('q.fecha', 'DESC', True), ('q.local', 'ASC', True),
+                                      ('q.plataforma', 'ASC', True), ('q.id', 'ASC')],
+                                     limite, cursor, con_total, 'liquidaciones')
+            conn = None
+            return resp
         sql += " ORDER BY fecha DESC, local, plataforma"
         cur.execute(sql, params)
         rows = cur.fetchall()
         return jsonify({'liquidaciones': [dict(r) for r in rows]})
+    except CursorInvalido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -5942,21 +8509,18 @@ def delivery_eliminar(liq_id):
     finally:
         if conn: release_db(conn)
 
-@app.route('/api/delivery/resumen', methods=['GET'])
-def delivery_resumen():
-    fecha_desde = request.args.get('fecha_desde')
-    fecha_hasta = request.args.get('fecha_hasta')
-    conn = None
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        params = []
-        where = ""
-        if fecha_desde:
-            where += " AND fecha >= %s"; params.append(fecha_desde)
-        if fecha_hasta:
-            where += " AND fecha <= %s"; params.append(fecha_hasta)
-        cur.execute(f"""
+def _consultas_resumen_delivery(args):
+    """Consultas de /api/delivery/resumen"""
+    fecha_desde = args.get('fecha_desde')
+    fecha_hasta = args.get('fecha_hasta')
+    params = []
+    where = ""
+    if fecha_desde:
+        where += " AND fecha >= %s"; params.append(fecha_desde)
+    if fecha_hasta:
+        where += " AND fecha <= %s"; params.append(fecha_hasta)
+    return {
+        'resumen': (f"""
             SELECT COUNT(*) as total, COALESCE(SUM(venta_bruta),0) as total_ventas,
                    COALESCE(SUM(comision_monto),0) as total_comisiones,
                    COALESCE(SUM(neto_recibir),0) as total_neto,
@@ -5964,9 +8528,8 @@ def delivery_resumen():
                    COALESCE(SUM(ABS(diferencia)),0) as total_diferencia,
                    COALESCE(SUM(total_pedidos),0) as total_pedidos
             FROM goti.delivery_liquidaciones WHERE 1=1 {where}
-        """, params)
-        resumen = dict(cur.fetchone())
-        cur.execute(f"""
+        """, params),
+        'por_plataforma': (f"""
             SELECT plataforma, COUNT(*) as liquidaciones, COALESCE(SUM(venta_bruta),0) as ventas,
                    COALESCE(SUM(comision_monto),0) as comisiones,
                    COALESCE(AVG(comision_pct),0) as comision_pct_avg,
@@ -5974,16 +8537,23 @@ def delivery_resumen():
                    COALESCE(SUM(total_pedidos),0) as pedidos
             FROM goti.delivery_liquidaciones WHERE 1=1 {where}
             GROUP BY plataforma ORDER BY ventas DESC
-        """, params)
-        resumen['por_plataforma'] = [dict(r) for r in cur.fetchall()]
-        cur.execute(f"""
+        """, params),
+        'por_local': (f"""
             SELECT local, COUNT(*) as liquidaciones, COALESCE(SUM(venta_bruta),0) as ventas,
                    COALESCE(SUM(ABS(diferencia)),0) as diferencia_abs
             FROM goti.delivery_liquidaciones WHERE 1=1 {where}
             GROUP BY local ORDER BY ventas DESC
-        """, params)
-        resumen['por_local'] = [dict(r) for r in cur.fetchall()]
-        return jsonify(resumen)
+        """, params),
+    }
+
+
+@app.route('/api/delivery/resumen', methods=['GET'])
+def delivery_resumen():
+    conn = None
+    try:
+        conn = get_db()
+        res = consultas_paralelas(conn, _consultas_resumen_delivery(request.args))
+        return jsonify(_armar_resumen(res))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -6018,10 +8588,19 @@ def facturas_listar():
             sql += " AND estado_pago = %s"; params.append(estado_pago)
         if proveedor:
             sql += " AND proveedor ILIKE %s"; params.append(f'%{proveedor}%')
+        limite, cursor, con_total = _parametros_pagina()
+        if limite:
+            resp = _respuesta_pagina(conn, sql, params,
+                                     [('q.fecha_emision', 'DESC', True), ('q.local', 'ASC', True), ('q.id', 'ASC')],
+                                     limite, cursor, con_total, 'facturas')
+            conn = None
+            return resp
         sql += " ORDER BY fecha_emision DESC, local"
         cur.execute(sql, params)
         rows = cur.fetchall()
         return jsonify({'facturas': [dict(r) for r in rows]})
+    except CursorInvalido as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -6097,42 +8676,45 @@ def facturas_eliminar(factura_id):
     finally:
         if conn: release_db(conn)
 
-@app.route('/api/facturas/resumen', methods=['GET'])
-def facturas_resumen():
-    fecha_desde = request.args.get('fecha_desde')
-    fecha_hasta = request.args.get('fecha_hasta')
-    conn = None
-    try:
-        conn = get_db()
-        cur = conn.cursor()
-        params = []
-        where = ""
-        if fecha_desde:
-            where += " AND fecha_emision >= %s"; params.append(fecha_desde)
-        if fecha_hasta:
-            where += " AND fecha_emision <= %s"; params.append(fecha_hasta)
-        cur.execute(f"""
+def _consultas_resumen_facturas(args):
+    """Consultas de /api/facturas/resumen"""
+    fecha_desde = args.get('fecha_desde')
+    fecha_hasta = args.get('fecha_hasta')
+    params = []
+    where = ""
+    if fecha_desde:
+        where += " AND fecha_emision >= %s"; params.append(fecha_desde)
+    if fecha_hasta:
+        where += " AND fecha_emision <= %s"; params.append(fecha_hasta)
+    return {
+        'resumen': (f"""
             SELECT COUNT(*) as total, COALESCE(SUM(total),0) as total_facturado,
                    COALESCE(SUM(iva),0) as total_iva,
                    COUNT(CASE WHEN estado_pago = 'Pendiente' THEN 1 END) as pendientes,
                    COALESCE(SUM(CASE WHEN estado_pago = 'Pendiente' THEN total ELSE 0 END),0) as monto_pendiente
             FROM goti.facturas_registro WHERE 1=1 {where}
-        """, params)
-        resumen = dict(cur.fetchone())
-        cur.execute(f"""
+        """, params),
+        'por_categoria': (f"""
             SELECT categoria, COUNT(*) as facturas, COALESCE(SUM(total),0) as monto
             FROM goti.facturas_registro WHERE 1=1 {where}
             GROUP BY categoria ORDER BY monto DESC
-        """, params)
-        resumen['por_categoria'] = [dict(r) for r in cur.fetchall()]
-        cur.execute(f"""
+        """, params),
+        'por_local': (f"""
             SELECT local, COUNT(*) as facturas, COALESCE(SUM(total),0) as monto,
                    COUNT(CASE WHEN estado_pago = 'Pendiente' THEN 1 END) as pendientes
             FROM goti.facturas_registro WHERE 1=1 {where}
             GROUP BY local ORDER BY monto DESC
-        """, params)
-        resumen['por_local'] = [dict(r) for r in cur.fetchall()]
-        return jsonify(resumen)
+        """, params),
+    }
+
+
+@app.route('/api/facturas/resumen', methods=['GET'])
+def facturas_resumen():
+    conn = None
+    try:
+        conn = get_db()
+        res = consultas_paralelas(conn, _consultas_resumen_facturas(request.args))
+        return jsonify(_armar_resumen(res))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -6374,6 +8956,231 @@ def carga_inicial_productos():
         if conn: release_db(conn)
 
 
+# ============================================================
+# MODULO: Perfilador por request (solo admin)
+# ============================================================
+# Activar en cualquier request con header "X-Perfil: <clave>" o "?_perfil=<clave>".
+# Sin PERFIL_CLAVE en el entorno el perfilador queda deshabilitado.
+# Modos (?_perfil_modo=):
+#   muestreo  (default) -> .folded con stacks colapsados (flamegraph.pl / speedscope)
+#   cprofile            -> .prof determinista (snakeviz / python -m pstats)
+# Cada perfil guarda un .json con ruta, params, duracion y tiempo por categoria
+# (sql, excel, json, app, otros). Listar/descargar en /api/admin/perfiles?key=<clave>.
+import sys
+import cProfile, pstats
+import uuid
+import json as _json
+
+PERFIL_CLAVE = os.environ.get('PERFIL_CLAVE', '')
+PERFILES_DIR = os.environ.get('PERFILES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perfiles'))
+PERFIL_INTERVALO = float(os.environ.get('PERFIL_INTERVALO', '0.005'))  # segundos entre muestras
+
+_APP_FILE = os.path.abspath(__file__)
+# Metodos del cursor auditado: una muestra parada en ellos esta dentro de psycopg2 (codigo C)
+_CODIGOS_SQL = {f.__code__ for f in (_AuditoriaSQL.execute, _AuditoriaSQL.executemany,
+                                     _AuditoriaSQL.fetchall, _AuditoriaSQL.fetchmany)}
+
+
+def _categoria_archivo(filename):
+    """Clasifica un archivo fuente de libreria en sql / excel / json (None si no aplica)"""
+    if 'psycopg2' in filename:
+        return 'sql'
+    if 'openpyxl' in filename or 'et_xmlfile' in filename:
+        return 'excel'
+    if f'{os.sep}json{os.sep}' in filename or filename.endswith(f'{os.sep}json.py'):
+        return 'json'
+    return None
+
+
+def _categoria_pila(frame):
+    """Categoria de una muestra: la decide el frame mas interno de app.py. Es 'sql' / 'excel' / 'json'
+    si por debajo de el corre esa libreria (o si es un metodo del cursor auditado), si no 'app'.
+    Sin frames de app.py (werkzeug, threads del pool) la muestra va a la libreria o a 'otros'."""
+    libreria = None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename == _APP_FILE:
+            if libreria:
+                return libreria
+            return 'sql' if code in _CODIGOS_SQL else 'app'
+        libreria = libreria or _categoria_archivo(code.co_filename)
+        frame = frame.f_back
+    return libreria or 'otros'
+
+
+class _Muestreador(threading.Thread):
+    """Toma muestras periodicas del stack del thread que atiende el request"""
+
+    def __init__(self, thread_id, intervalo):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.intervalo = intervalo
+        self.pilas = {}
+        self.categorias = {}
+        self._fin = threading.Event()
+
+    def run(self):
+        while not self._fin.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            categoria = _categoria_pila(frame)
+            pila = []
+            while frame is not None:
+                code = frame.f_code
+                pila.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            clave = ';'.join(reversed(pila))
+            self.pilas[clave] = self.pilas.get(clave, 0) + 1
+            self.categorias[categoria] = self.categorias.get(categoria, 0) + 1
+
+    def detener(self):
+        self._fin.set()
+        self.join(timeout=1)
+
+
+def _clave_perfil_valida(clave):
+    # Sin PERFIL_CLAVE configurada ninguna clave sirve
+    return bool(PERFIL_CLAVE) and bool(clave) and secrets.compare_digest(clave.encode(), PERFIL_CLAVE.encode())
+
+
+def _perfil_solicitado():
+    # asgi.py manda a Flask todo request con X-Perfil / _perfil
+    return _clave_perfil_valida(request.headers.get('X-Perfil') or request.args.get('_perfil'))
+
+
+@app.before_request
+def _iniciar_perfil():
+    if not _perfil_solicitado():
+        return
+    modo = request.args.get('_perfil_modo', 'muestreo')
+    if modo == 'cprofile':
+        perfilador = cProfile.Profile()
+        perfilador.enable()
+    else:
+        modo = 'muestreo'
+        perfilador = _Muestreador(threading.get_ident(), PERFIL_INTERVALO)
+        perfilador.start()
+    g._perfil = {'modo': modo, 'perfilador': perfilador, 'inicio': _time.perf_counter()}
+
+
+def _detener_perfil():
+    """Detiene el perfilador activo (si hay) y devuelve sus datos"""
+    perfil = g.pop('_perfil', None)
+    if perfil is None:
+        return None
+    perfil['duracion'] = _time.perf_counter() - perfil['inicio']
+    if perfil['modo'] == 'cprofile':
+        perfil['perfilador'].disable()
+    else:
+        perfil['perfilador'].detener()
+    return perfil
+
+
+def _guardar_perfil(perfil, status):
+    """Escribe el perfil y su metadata en PERFILES_DIR. Devuelve el id."""
+    os.makedirs(PERFILES_DIR, exist_ok=True)
+    endpoint = request.endpoint or 'sin_endpoint'
+    perfil_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{endpoint}_{uuid.uuid4().hex[:6]}"
+    params = {k: v for k, v in request.args.items() if not k.startswith('_perfil')}
+
+    if perfil['modo'] == 'cprofile':
+        archivo = perfil_id + '.prof'
+        stats = pstats.Stats(perfil['perfilador'])
+        stats.dump_stats(os.path.join(PERFILES_DIR, archivo))
+        # tottime agrupado por categoria de archivo fuente
+        categorias = {}
+        for (filename, _linea, funcion), (_cc, _nc, tottime, _ct, _callers) in stats.stats.items():
+            if filename == '~':
+                # funciones C: "<method 'execute' of 'psycopg2.extensions.cursor' objects>", _json, etc.
+                categoria = 'sql' if 'psycopg2' in funcion else 'json' if 'json' in funcion else None
+            elif filename == _APP_FILE:
+                categoria = 'app'
+            else:
+                categoria = _categoria_archivo(filename)
+            categoria = categoria or 'otros'
+            categorias[categoria] = categorias.get(categoria, 0) + tottime
+        categorias = {k: round(v * 1000, 2) for k, v in categorias.items()}
+        unidad = 'ms'
+    else:
+        archivo = perfil_id + '.folded'
+        muestreador = perfil['perfilador']
+        with open(os.path.join(PERFILES_DIR, archivo), 'w') as f:
+            for pila, n in muestreador.pilas.items():
+                f.write(f"{pila} {n}\n")
+        categorias = dict(muestreador.categorias)
+        unidad = 'muestras'
+
+    meta = {
+        'id': perfil_id,
+        'archivo': archivo,
+        'modo': perfil['modo'],
+        'metodo': request.method,
+        'ruta': request.path,
+        'endpoint': endpoint,
+        'params': params,
+        'status': status,
+        'duracion_ms': round(perfil['duracion'] * 1000, 2),
+        'categorias': categorias,
+        'unidad_categorias': unidad,
+        'creado': datetime.now().isoformat(timespec='seconds'),
+    }
+    with open(os.path.join(PERFILES_DIR, perfil_id + '.json'), 'w') as f:
+        _json.dump(meta, f, ensure_ascii=False, indent=1)
+    return perfil_id
+
+
+@app.after_request
+def _finalizar_perfil(response):
+    perfil = _detener_perfil()
+    if perfil is not None:
+        try:
+            response.headers['X-Perfil-Id'] = _guardar_perfil(perfil, response.status_code)
+        except Exception as e:
+            print(f"Error guardando perfil: {e}")
+    return response
+
+
+@app.teardown_request
+def _limpiar_perfil(exc):
+    # Si el handler lanzo excepcion after_request no corre: no dejar el muestreador vivo
+    _detener_perfil()
+
+
+@app.route('/api/admin/perfiles', methods=['GET'])
+def listar_perfiles():
+    """Lista los perfiles guardados (mas recientes primero)"""
+    if not _clave_perfil_valida(request.args.get('key', '')):
+        return jsonify({'error': 'no autorizado'}), 403
+    perfiles = []
+    if os.path.isdir(PERFILES_DIR):
+        for nombre in os.listdir(PERFILES_DIR):
+            if not nombre.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(PERFILES_DIR, nombre)) as f:
+                    perfiles.append(_json.load(f))
+            except Exception as e:
+                print(f"Error leyendo perfil {nombre}: {e}")
+    perfiles.sort(key=lambda p: p.get('id', ''), reverse=True)
+    endpoint = request.args.get('endpoint')
+    if endpoint:
+        perfiles = [p for p in perfiles if p.get('endpoint') == endpoint]
+    return jsonify(perfiles)
+
+
+@app.route('/api/admin/perfiles/<perfil_id>', methods=['GET'])
+def descargar_perfil(perfil_id):
+    """Descarga el archivo del perfil (.folded o .prof); ?meta=1 devuelve el .json"""
+    if not _clave_perfil_valida(request.args.get('key', '')):
+        return jsonify({'error': 'no autorizado'}), 403
+    for ext in (['.json'] if request.args.get('meta') == '1' else ['.folded', '.prof']):
+        nombre = perfil_id + ext
+        if os.path.isfile(os.path.join(PERFILES_DIR, nombre)):
+            return send_from_directory(PERFILES_DIR, nombre, as_attachment=True)
+    return jsonify({'error': 'perfil no encontrado'}), 404
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port, debug=False)
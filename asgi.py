@@ -0,0 +1,215 @@
+"""Modo ASGI: los endpoints que solo esperan a Airtable corren en asyncio (httpx); todo lo
+demas sigue siendo la app Flask de app.py, servida en un pool de threads por a2wsgi.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Un deposito que tarda 20s en Airtable ya no ocupa un thread: cientos de esos requests
+pueden estar en vuelo sin dejar sin workers a los guardados de conteo.
+Sin httpx instalado se sirve solo la app Flask (mismo comportamiento que WSGI).
+
+Solo son async rutas que no tocan la BD (Flask tampoco las pasa por admision ni cache):
+dashboard y resumenes siguen en Flask con admision por clases, cache de reportes y auditoria
+SQL. Las async replican cabeceras de cache, CORS y compresion (mismo parseo de
+Accept-Encoding que app.py); un request con perfilador pedido va siempre a Flask.
+"""
+import asyncio
+import os
+from urllib.parse import parse_qsl
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.datastructures import MultiDict
+
+import app as wsgi
+
+try:
+    import httpx
+except ImportError as e:
+    print(f"Modo ASGI sin endpoints async ({e}): se sirve solo la app Flask")
+    httpx = None
+
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '16'))
+AIRTABLE_TIMEOUT = float(os.environ.get('AIRTABLE_TIMEOUT', '20'))
+
+_flask = WSGIMiddleware(wsgi.app, workers=ASGI_WSGI_THREADS)
+_estado = {'http': None}
+_personas_lock = asyncio.Lock()
+
+
+class ErrorAirtable(Exception):
+    pass
+
+
+# ==================== RESPUESTAS ====================
+
+def _cabeceras(content_type, largo, extra=()):
+    # Mismas cabeceras de cache que add_no_cache_headers en app.py
+    return [(b'content-type', content_type.encode()), (b'content-length', str(largo).encode()),
+            (b'cache-control', b'no-cache, no-store, must-revalidate'),
+            (b'pragma', b'no-cache'), (b'expires', b'0'), (b'vary', b'Accept-Encoding, Origin')] + list(extra)
+
+
+async def _responder(send, scope, cuerpo, status=200, content_type='application/json'):
+    if not isinstance(cuerpo, (bytes, str)):
+        cuerpo = wsgi.app.json.dumps(cuerpo)
+    if isinstance(cuerpo, str):
+        cuerpo = cuerpo.encode('utf-8')
+    cabeceras = {k.lower(): v.decode('latin-1') for k, v in scope['headers']}
+    extra = []
+    # Como flask_cors con CORS_ORIGENES: el origen permitido se devuelve tal cual
+    origen = cabeceras.get(b'origin')
+    if origen in wsgi.CORS_ORIGENES:
+        extra.append((b'access-control-allow-origin', origen.encode('latin-1')))
+    encoding = None
+    if status == 200 and len(cuerpo) >= wsgi.COMPRESION_MIN_BYTES:
+        encoding = wsgi._elegir_encoding(cabecera=cabeceras.get(b'accept-encoding', ''))
+    if encoding:
+        cuerpo = wsgi._comprimir(cuerpo, encoding)
+        extra.append((b'content-encoding', encoding.encode()))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': _cabeceras(content_type, len(cuerpo), extra)})
+    await send({'type': 'http.response.body', 'body': cuerpo})
+
+
+# ==================== AIRTABLE (httpx) ====================
+
+async def _airtable_paginas(url, headers, params=None, limite=None, parcial=False):
+    """Todos los registros de una vista paginada de Airtable (offset).
+    parcial=True: si una pagina falla se devuelve lo leido hasta ahi (como depositos/resumen)"""
+    params = dict(params or {})
+    registros = []
+    while True:
+        r = await _estado['http'].get(url, headers=headers, params=params)
+        if r.status_code != 200:
+            if parcial:
+                return registros
+            raise ErrorAirtable(f'AirTable error: {r.status_code}')
+        data = r.json()
+        registros.extend(data.get('records', []))
+        params['offset'] = data.get('offset')
+        if not params['offset'] or (limite and len(registros) >= limite):
+            return registros
+
+
+async def _personas():
+    """Igual que _obtener_personas: cache de 5 min; una sola recarga en vuelo a la vez"""
+    cache = wsgi._personas_cache
+    if cache['datos'] and wsgi._time.time() - cache['timestamp'] < wsgi.PERSONAS_CACHE_TTL:
+        return cache['datos']
+    async with _personas_lock:
+        if cache['datos'] and wsgi._time.time() - cache['timestamp'] < wsgi.PERSONAS_CACHE_TTL:
+            return cache['datos']
+        try:
+            registros = await _airtable_paginas(
+                wsgi._url_personas(), {'Authorization': f'Bearer {wsgi._get_airtable_token()}'})
+            return wsgi._guardar_personas(registros)
+        except Exception as e:
+            print(f'Error cargando personas de Airtable: {e}')
+            return cache['datos'] if cache['datos'] else []
+
+
+async def _tiendas():
+    if wsgi._tiendas_vigentes():
+        return
+    try:
+        r = await _estado['http'].get(wsgi._TIENDAS_URL, headers=wsgi._at_headers(), params=wsgi._TIENDAS_PARAMS)
+        if r.status_code == 200:
+            wsgi._guardar_tiendas(r.json().get('records', []))
+    except Exception as e:
+        print(f'Error cargando tiendas: {e}')
+
+
+async def _armar_con_tiendas(armar, registros):
+    await _tiendas()
+    if wsgi._tiendas_vigentes():
+        return armar(registros)
+    # Sin tiendas en cache _resolver_local haria HTTP sincrono: fuera del event loop
+    return await asyncio.to_thread(armar, registros)
+
+
+# ==================== ENDPOINTS ====================
+
+async def index(scope, args):
+    return 200, wsgi._html_index(await _personas()), 'text/html; charset=utf-8'
+
+
+async def catalogo_productos(scope, args):
+    cache = wsgi._catalogo_cache
+    if wsgi._time.time() - cache['ts'] < 3600 and cache['datos']:
+        return 200, cache['datos'], 'application/json'
+    try:
+        registros = await _airtable_paginas(
+            wsgi._url_catalogo(), {'Authorization': f'Bearer {wsgi._get_airtable_token()}'})
+        return 200, wsgi._guardar_catalogo(registros), 'application/json'
+    except Exception as e:
+        if cache['datos']:
+            return 200, cache['datos'], 'application/json'
+        return 500, {'error': str(e)}, 'application/json'
+
+
+async def depositos_listar(scope, args):
+    try:
+        registros = await _airtable_paginas(wsgi._DEPOSITOS_URL, wsgi._at_headers(),
+                                            wsgi._params_depositos_listar(args), wsgi.DEPOSITOS_LISTAR_MAX)
+        return 200, await _armar_con_tiendas(wsgi._armar_depositos, registros), 'application/json'
+    except ErrorAirtable as e:
+        return 500, {'error': str(e)}, 'application/json'
+    except Exception as e:
+        print(f'Error en depositos_listar: {e}')
+        return 500, {'error': str(e)[:200]}, 'application/json'
+
+
+async def depositos_resumen(scope, args):
+    try:
+        registros = await _airtable_paginas(wsgi._DEPOSITOS_URL, wsgi._at_headers(),
+                                            wsgi._params_depositos_resumen(args), parcial=True)
+        return 200, await _armar_con_tiendas(wsgi._armar_resumen_depositos, registros), 'application/json'
+    except Exception as e:
+        print(f'Error en depositos_resumen: {e}')
+        return 500, {'error': str(e)[:200]}, 'application/json'
+
+
+RUTAS_ASYNC = {
+    '/': index,
+    '/api/catalogo-productos': catalogo_productos,
+    '/api/depositos/listar': depositos_listar,
+    '/api/depositos/resumen': depositos_resumen,
+}
+
+
+# ==================== APP ASGI ====================
+
+async def _lifespan(receive, send):
+    while True:
+        mensaje = await receive()
+        if mensaje['type'] == 'lifespan.startup':
+            if httpx is not None:
+                try:
+                    _estado['http'] = httpx.AsyncClient(timeout=AIRTABLE_TIMEOUT)
+                except Exception as e:
+                    # Sin cliente async todo sigue por Flask
+                    print(f"Modo ASGI sin endpoints async: {e}")
+                    _estado['http'] = None
+            await send({'type': 'lifespan.startup.complete'})
+        elif mensaje['type'] == 'lifespan.shutdown':
+            if _estado['http'] is not None:
+                await _estado['http'].aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    handler = None
+    args = None
+    if scope['type'] == 'http' and scope['method'] == 'GET' and _estado['http'] is not None:
+        handler = RUTAS_ASYNC.get(scope['path'])
+    if handler is not None:
+        args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+        # El perfilador vive en los hooks de Flask
+        if args.get('_perfil') or any(k.lower() == b'x-perfil' for k, _ in scope['headers']):
+            handler = None
+    if handler is None:
+        return await _flask(scope, receive, send)
+    status, cuerpo, content_type = await handler(scope, args)
+    await _responder(send, scope, cuerpo, status, content_type)
@@ -0,0 +1,141 @@
+-- Particiona goti.inventario_ciego_conteos por mes (RANGE sobre fecha)
+-- Ejecutar una sola vez en BD Azure (InventariosLocales), fuera del horario de conteo:
+-- toma lock exclusivo de la tabla mientras copia las filas.
+-- Requiere PostgreSQL 13+ (triggers BEFORE ROW en tablas particionadas).
+--
+-- Despues de esto:
+--   - las consultas con fecha >= / <= / = / BETWEEN solo leen los meses del rango
+--   - cada mes tiene sus propios indices (se crean solos al crear la particion)
+--   - init_db y un thread diario de app.py llaman goti.crear_particiones_conteos para
+--     tener siempre creados los meses que vienen; lo que caiga fuera va a la particion default
+--   - la tabla original queda como goti.inventario_ciego_conteos_sin_particion para volver
+--     atras; borrarla a mano cuando se confirme que todo esta bien
+
+BEGIN;
+
+LOCK TABLE goti.inventario_ciego_conteos IN ACCESS EXCLUSIVE MODE;
+
+-- Las vistas quedan atadas a la tabla original al renombrarla: abortar si hay alguna
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        WHERE d.refobjid = 'goti.inventario_ciego_conteos'::regclass AND r.ev_class <> d.refobjid
+    ) THEN
+        RAISE EXCEPTION 'Hay vistas sobre goti.inventario_ciego_conteos: recrearlas despues de particionar';
+    END IF;
+END
+$$;
+
+-- ---- Tabla particionada con las mismas columnas ----
+CREATE TABLE goti.inventario_ciego_conteos_p (
+    LIKE goti.inventario_ciego_conteos INCLUDING DEFAULTS
+) PARTITION BY RANGE (fecha);
+
+-- PK y UNIQUE deben incluir la columna de particion (ON CONFLICT de cargar_inventario usa la UNIQUE)
+ALTER TABLE goti.inventario_ciego_conteos_p ADD PRIMARY KEY (id, fecha);
+ALTER TABLE goti.inventario_ciego_conteos_p ADD UNIQUE (fecha, local, codigo);
+
+ALTER TABLE goti.inventario_ciego_conteos RENAME TO inventario_ciego_conteos_sin_particion;
+ALTER TABLE goti.inventario_ciego_conteos_p RENAME TO inventario_ciego_conteos;
+
+-- Los nombres de indice son por schema: liberar los de la tabla original (idx_conteos_*)
+DO $$
+DECLARE
+    idx RECORD;
+BEGIN
+    FOR idx IN SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+               WHERE i.indrelid = 'goti.inventario_ciego_conteos_sin_particion'::regclass LOOP
+        EXECUTE format('ALTER INDEX goti.%I RENAME TO %I', idx.relname, left(idx.relname, 50) || '_sin_part');
+    END LOOP;
+END
+$$;
+
+CREATE TABLE goti.inventario_ciego_conteos_default PARTITION OF goti.inventario_ciego_conteos DEFAULT;
+
+-- ---- Particiones mensuales: goti.inventario_ciego_conteos_yYYYYmMM ----
+-- Crea los meses de [p_desde, p_hasta] que falten; devuelve cuantos creo.
+-- Si la default ya tiene filas de un mes, se mueven a la particion nueva.
+CREATE OR REPLACE FUNCTION goti.crear_particiones_conteos(p_desde DATE, p_hasta DATE) RETURNS INT AS $$
+DECLARE
+    mes DATE := date_trunc('month', p_desde)::date;
+    nombre TEXT;
+    creadas INT := 0;
+BEGIN
+    -- Varios workers arrancan a la vez: uno solo crea
+    PERFORM pg_advisory_xact_lock(hashtext('goti.crear_particiones_conteos'));
+    WHILE mes <= p_hasta LOOP
+        nombre := 'inventario_ciego_conteos_' || to_char(mes, '"y"YYYY"m"MM');
+        IF to_regclass('goti.' || nombre) IS NULL THEN
+            IF EXISTS (SELECT 1 FROM goti.inventario_ciego_conteos_default
+                       WHERE fecha >= mes AND fecha < (mes + INTERVAL '1 month')::date) THEN
+                EXECUTE format('CREATE TABLE goti.%I (LIKE goti.inventario_ciego_conteos INCLUDING DEFAULTS)', nombre);
+                EXECUTE format('WITH movidas AS (DELETE FROM goti.inventario_ciego_conteos_default
+                                    WHERE fecha >= %L AND fecha < %L RETURNING *)
+                                INSERT INTO goti.%I SELECT * FROM movidas',
+                               mes, (mes + INTERVAL '1 month')::date, nombre);
+                EXECUTE format('ALTER TABLE goti.inventario_ciego_conteos ATTACH PARTITION goti.%I
+                                FOR VALUES FROM (%L) TO (%L)', nombre, mes, (mes + INTERVAL '1 month')::date);
+            ELSE
+                EXECUTE format('CREATE TABLE goti.%I PARTITION OF goti.inventario_ciego_conteos
+                                FOR VALUES FROM (%L) TO (%L)', nombre, mes, (mes + INTERVAL '1 month')::date);
+            END IF;
+            creadas := creadas + 1;
+        END IF;
+        mes := (mes + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN creadas;
+END
+$$ LANGUAGE plpgsql;
+
+-- Todos los meses con datos + los 3 que vienen
+SELECT goti.crear_particiones_conteos(
+    COALESCE((SELECT MIN(fecha) FROM goti.inventario_ciego_conteos_sin_particion), CURRENT_DATE),
+    (date_trunc('month', CURRENT_DATE) + INTERVAL '3 months')::date);
+
+-- ---- Copia (antes de los triggers: no sube versiones ni row_version) ----
+INSERT INTO goti.inventario_ciego_conteos SELECT * FROM goti.inventario_ciego_conteos_sin_particion;
+
+-- La secuencia del id pasa a la tabla nueva (sigue siendo la misma, sin huecos ni repetidos)
+DO $$
+DECLARE
+    seq TEXT := pg_get_serial_sequence('goti.inventario_ciego_conteos_sin_particion', 'id');
+BEGIN
+    IF seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY goti.inventario_ciego_conteos.id', seq);
+    END IF;
+END
+$$;
+
+-- ---- Indices: se definen en la tabla padre y Postgres crea uno por particion ----
+-- consultar_inventario, historico, reportes (fecha + bodega)
+CREATE INDEX IF NOT EXISTS idx_conteos_fecha_local ON goti.inventario_ciego_conteos (fecha, local);
+-- busqueda por codigo
+CREATE INDEX IF NOT EXISTS idx_conteos_codigo ON goti.inventario_ciego_conteos (codigo);
+-- guardar/corregir conteo por id (sin fecha: un probe de indice por particion)
+CREATE INDEX IF NOT EXISTS idx_conteos_id ON goti.inventario_ciego_conteos (id);
+-- delta sync (/api/inventario/cambios)
+CREATE INDEX IF NOT EXISTS idx_conteos_row_version ON goti.inventario_ciego_conteos (fecha, local, row_version);
+
+-- ---- Triggers (mismas funciones que crea init_db) ----
+DROP TRIGGER IF EXISTS trg_row_version ON goti.inventario_ciego_conteos_sin_particion;
+DROP TRIGGER IF EXISTS trg_borrado ON goti.inventario_ciego_conteos_sin_particion;
+DROP TRIGGER IF EXISTS trg_version ON goti.inventario_ciego_conteos_sin_particion;
+CREATE TRIGGER trg_row_version BEFORE INSERT OR UPDATE ON goti.inventario_ciego_conteos
+    FOR EACH ROW EXECUTE FUNCTION goti.trg_conteo_row_version();
+CREATE TRIGGER trg_borrado AFTER DELETE ON goti.inventario_ciego_conteos
+    FOR EACH ROW EXECUTE FUNCTION goti.trg_conteo_borrado();
+CREATE TRIGGER trg_version AFTER INSERT OR UPDATE OR DELETE ON goti.inventario_ciego_conteos
+    FOR EACH ROW EXECUTE FUNCTION goti.trg_version_fecha_local();
+
+COMMIT;
+
+ANALYZE goti.inventario_ciego_conteos;
+
+-- Volver atras (solo si no hubo escrituras despues de la migracion):
+--   BEGIN;
+--   ALTER TABLE goti.inventario_ciego_conteos RENAME TO inventario_ciego_conteos_particionada;
+--   ALTER TABLE goti.inventario_ciego_conteos_sin_particion RENAME TO inventario_ciego_conteos;
+--   COMMIT;
+--   -- reiniciar la app: init_db recrea los triggers sobre la tabla original
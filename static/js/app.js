@@ -1030,6 +1030,7 @@ let state = {
     productosFallidos: [],  // Productos con diferencia después del primer conteo
     personas: [],           // Lista de personas asignables
     asignaciones: {},       // Asignaciones por conteo_id
+    secciones: [],          // Secciones ya guardadas del slice (vienen en /api/conteo/sesion)
     cruceEjecuciones: [],   // Ejecuciones de cruce operativo
     cruceDetalleId: null,   // ID de ejecucion activa en detalle
     cruceSoloDif: false     // Filtro solo diferencias
@@ -1516,16 +1517,24 @@ async function consultarInventario() {
     `;
 
     try {
-        const response = await fetch(`${CONFIG.API_URL}/api/inventario/consultar?fecha=${fecha}&local=${local}`);
+        // Sesion: productos, personas y asignaciones en una sola llamada
+        const response = await fetch(`${CONFIG.API_URL}/api/conteo/sesion?fecha=${fecha}&local=${local}`);
 
         if (response.ok) {
             const data = await response.json();
+            state.asignaciones = data.asignaciones || {};
 
-            // Guardar personas si vienen en la respuesta (del cache del servidor)
+            // Personas y secciones tambien vienen en la sesion: no se piden aparte
             if (data.personas && data.personas.length > 0) {
                 state.personas = data.personas;
                 try { localStorage.setItem('personas_cache', JSON.stringify(data.personas)); } catch(e) {}
+            } else if (!state.personas || state.personas.length === 0) {
+                try {
+                    const cache = localStorage.getItem('personas_cache');
+                    if (cache) { state.personas = JSON.parse(cache); }
+                } catch(e) {}
             }
+            cargarSecciones(data.secciones);
 
             if (data.productos.length === 0) {
                 const bodegasOperativas = ['bodega_principal', 'materia_prima'];
@@ -1570,7 +1579,6 @@ async function consultarInventario() {
                 if (state.productosFallidos.length === 0) {
                     // Todo coincidió en el primer conteo, está finalizado
                     state.etapaConteo = 3;
-                    await Promise.all([cargarAsignaciones(fecha, local), cargarPersonas(), cargarSecciones(fecha, local)]);
                     renderProductosInventario();
                     showToast('Conteo ya completado - todos los productos coinciden.', 'success');
                     return;
@@ -1580,31 +1588,13 @@ async function consultarInventario() {
                 const todosConConteo2 = state.productos.every(p => p.cantidad_contada_2 !== null);
                 if (todosConConteo2) {
                     state.etapaConteo = 3;
-                    await Promise.all([cargarAsignaciones(fecha, local), cargarPersonas(), cargarSecciones(fecha, local)]);
                     renderProductosInventario();
                     showToast('Este conteo ya fue finalizado. Solo lectura.', 'warning');
                     return;
                 }
 
-                // Auto-llenar conteo 2 para productos sin diferencia
-                try {
-                    const resp = await fetch(`${CONFIG.API_URL}/api/inventario/autofill-conteo2`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ fecha, local })
-                    });
-                    const result = await resp.json();
-                    if (result.success && result.actualizados > 0) {
-                        state.productos.forEach(p => {
-                            if (p.cantidad_contada !== null && p.cantidad_contada === p.cantidad_sistema && p.cantidad_contada_2 === null) {
-                                p.cantidad_contada_2 = p.cantidad_contada;
-                            }
-                        });
-                        console.log(`Auto-fill conteo 2: ${result.actualizados} productos`);
-                    }
-                } catch (e) {
-                    console.error('Error en autofill conteo2:', e);
-                }
+                // Auto-llenar conteo 2 para productos sin diferencia (solo con la cola ya enviada)
+                await autollenarConteo2(fecha, local);
 
                 // Verificar de nuevo si ahora todos tienen conteo 2
                 const fallidosSinConteo2 = state.productos.filter(p =>
@@ -1615,7 +1605,6 @@ async function consultarInventario() {
                 if (fallidosSinConteo2.length === 0) {
                     // Todos los que tenían diferencia ya tienen conteo 2
                     state.etapaConteo = 3;
-                    await Promise.all([cargarAsignaciones(fecha, local), cargarPersonas(), cargarSecciones(fecha, local)]);
                     renderProductosInventario();
                     showToast('Este conteo ya fue finalizado. Solo lectura.', 'warning');
                     return;
@@ -1808,6 +1797,156 @@ function renderProductosInventario() {
     actualizarContador();
 }
 
+// ==================== COLA OFFLINE (IndexedDB) ====================
+// Conteos y observaciones se guardan primero en una cola local y se envian por lotes a
+// /api/inventario/sincronizar. Sin señal la cola sigue creciendo y se vacia al volver la conexion.
+// Cada operacion lleva una clave unica: reenviar un lote no repite cambios en el servidor.
+
+const COLA_DB = 'inventario-ciego';
+const COLA_STORE = 'cola';
+const COLA_LOTE = 100;
+let _colaDbPromise = null;
+let _colaMemoria = [];          // respaldo si IndexedDB no esta disponible (modo privado)
+let _colaPromesa = null;       // sincronizacion en curso (una a la vez)
+let _colaTimer = null;
+
+function _colaAbrir() {
+    if (!window.indexedDB) return Promise.resolve(null);
+    if (!_colaDbPromise) {
+        _colaDbPromise = new Promise((resolve) => {
+            const req = indexedDB.open(COLA_DB, 1);
+            req.onupgradeneeded = () => req.result.createObjectStore(COLA_STORE, { keyPath: 'clave' });
+            req.onsuccess = () => resolve(req.result);
+            req.onerror = () => resolve(null);
+        });
+    }
+    return _colaDbPromise;
+}
+
+function _colaClave() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}${Math.random().toString(36).slice(2)}`;
+}
+
+async function _colaLeer() {
+    const db = await _colaAbrir();
+    if (!db) return _colaMemoria.slice();
+    return new Promise((resolve) => {
+        const req = db.transaction(COLA_STORE).objectStore(COLA_STORE).getAll();
+        req.onsuccess = () => resolve((req.result || []).concat(_colaMemoria));
+        req.onerror = () => resolve(_colaMemoria.slice());
+    });
+}
+
+async function _colaBorrar(claves) {
+    if (!claves.length) return;
+    _colaMemoria = _colaMemoria.filter(op => !claves.includes(op.clave));
+    const db = await _colaAbrir();
+    if (!db) return;
+    await new Promise((resolve) => {
+        const tx = db.transaction(COLA_STORE, 'readwrite');
+        const store = tx.objectStore(COLA_STORE);
+        claves.forEach(c => store.delete(c));
+        tx.oncomplete = resolve;
+        tx.onerror = resolve;
+    });
+}
+
+async function encolarOperacion(op) {
+    const item = { ...op, clave: _colaClave(), capturado_at: new Date().toISOString() };
+    const db = await _colaAbrir();
+    if (db) {
+        await new Promise((resolve) => {
+            const tx = db.transaction(COLA_STORE, 'readwrite');
+            tx.objectStore(COLA_STORE).put(item);
+            tx.oncomplete = resolve;
+            tx.onerror = () => { _colaMemoria.push(item); resolve(); };
+        });
+    } else {
+        _colaMemoria.push(item);
+    }
+    programarSincronizacion(300);
+    return item;
+}
+
+function programarSincronizacion(ms) {
+    clearTimeout(_colaTimer);
+    _colaTimer = setTimeout(sincronizarCola, ms);
+}
+
+function sincronizarCola() {
+    if (_colaPromesa) return _colaPromesa;
+    if (!navigator.onLine) return Promise.resolve();
+    _colaPromesa = _sincronizarCola().finally(() => { _colaPromesa = null; });
+    return _colaPromesa;
+}
+
+async function _sincronizarCola() {
+    let obsoletos = 0;
+    try {
+        let pendientes = await _colaLeer();
+        pendientes.sort((a, b) => a.capturado_at.localeCompare(b.capturado_at));
+        while (pendientes.length) {
+            const lote = pendientes.slice(0, COLA_LOTE);
+            const response = await fetch(`${CONFIG.API_URL}/api/inventario/sincronizar`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ operaciones: lote })
+            });
+            if (!response.ok) break;   // se reintenta en el proximo ciclo
+            const data = await response.json();
+            const resultados = data.resultados || [];
+            await _colaBorrar(resultados.map(r => r.clave));
+            obsoletos += resultados.filter(r => r.resultado === 'obsoleto').length;
+            pendientes = pendientes.slice(COLA_LOTE);
+        }
+    } catch (e) {
+        // Sin conexion: la cola queda para el proximo intento
+    }
+    if (obsoletos) {
+        showToast(`${obsoletos} conteo(s) ya tenian un valor mas reciente de otro dispositivo`, 'warning');
+    }
+}
+
+// Envia todo lo pendiente; true si la cola quedo vacia.
+// Una sincronizacion en curso pudo leer la cola antes del ultimo encolado: se espera y se corre otra.
+async function vaciarCola() {
+    if (_colaPromesa) await _colaPromesa;
+    await sincronizarCola();
+    return (await _colaLeer()).length === 0;
+}
+
+// Autofill de conteo 2 en el servidor (conteo 1 == sistema). Solo con la cola vacia: un conteo 1
+// todavia encolado no estaria en la BD. El estado local se actualiza con los ids que devolvio.
+async function autollenarConteo2(fecha, local) {
+    if (!(await vaciarCola())) {
+        showToast('Hay conteos sin enviar: el conteo 2 automatico queda para cuando se envien', 'warning');
+        return;
+    }
+    try {
+        const resp = await fetch(`${CONFIG.API_URL}/api/inventario/autofill-conteo2`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ fecha, local })
+        });
+        const result = await resp.json();
+        if (result.success && result.actualizados > 0) {
+            const ids = new Set(result.ids || []);
+            state.productos.forEach(p => {
+                if (ids.has(p.id)) p.cantidad_contada_2 = p.cantidad_contada;
+            });
+            console.log(`Auto-fill conteo 2: ${result.actualizados} productos`);
+        }
+    } catch (e) {
+        console.error('Error en autofill conteo2:', e);
+    }
+}
+
+window.addEventListener('online', () => programarSincronizacion(0));
+window.addEventListener('offline', () => showToast('Sin conexion: los conteos se guardan en este dispositivo', 'warning'));
+setInterval(sincronizarCola, 30000);
+programarSincronizacion(2000);
+
 async function guardarConteoDirecto(input) {
     if (!_puede('conteo', 'editar')) { showToast('No tienes permiso para contar', 'error'); return; }
     const id = parseInt(input.dataset.id);
@@ -1829,40 +1968,35 @@ async function guardarConteoDirecto(input) {
     }
 
     try {
-        const response = await fetch(`${CONFIG.API_URL}/api/inventario/guardar-conteo`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id, cantidad_contada: cantidad, conteo: conteoNum, usuario: state.user ? state.user.username : '' })
+        // Se encola (IndexedDB) y se actualiza el estado local; el envio lo hace sincronizarCola
+        await encolarOperacion({
+            tipo: 'conteo', id, conteo: conteoNum, cantidad_contada: cantidad,
+            usuario: state.user ? state.user.username : ''
         });
 
-        if (response.ok) {
-            // Actualizar estado local
-            const prod = state.productos.find(p => p.id === id);
-            if (prod) {
-                if (conteoNum === 2) {
-                    prod.cantidad_contada_2 = cantidad;
-                    if (state.user && !prod.contado2_por_nombre) {
-                        prod.contado2_por_nombre = state.user.nombre || state.user.username || '';
-                    }
-                } else {
-                    prod.cantidad_contada = cantidad;
-                    if (state.user && !prod.contado_por_nombre) {
-                        prod.contado_por_nombre = state.user.nombre || state.user.username || '';
-                    }
+        if (prod) {
+            if (conteoNum === 2) {
+                prod.cantidad_contada_2 = cantidad;
+                if (state.user && !prod.contado2_por_nombre) {
+                    prod.contado2_por_nombre = state.user.nombre || state.user.username || '';
+                }
+            } else {
+                prod.cantidad_contada = cantidad;
+                if (state.user && !prod.contado_por_nombre) {
+                    prod.contado_por_nombre = state.user.nombre || state.user.username || '';
                 }
             }
-
-            actualizarContador();
-            input.classList.add('guardado');
-            setTimeout(() => input.classList.remove('guardado'), 500);
-        } else {
-            showToast('Error al guardar', 'error');
-            input.classList.add('error');
-            setTimeout(() => input.classList.remove('error'), 500);
         }
+
+        actualizarContador();
+        const clase = navigator.onLine ? 'guardado' : 'pendiente';
+        input.classList.add(clase);
+        setTimeout(() => input.classList.remove(clase), 500);
     } catch (error) {
         console.error('Error:', error);
-        showToast('Error de conexion', 'error');
+        showToast('Error al guardar', 'error');
+        input.classList.add('error');
+        setTimeout(() => input.classList.remove('error'), 500);
     }
 }
 
@@ -2027,27 +2161,19 @@ async function guardarObservacion(input) {
     const observaciones = input.value.trim();
 
     try {
-        const response = await fetch(`${CONFIG.API_URL}/api/inventario/guardar-observacion`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id, observaciones })
-        });
-
-        if (response.ok) {
-            const prod = _obsProductos.find(p => p.id === id);
-            if (prod) {
-                prod.observaciones = observaciones;
-            }
-            input.classList.add('guardado');
-            setTimeout(() => input.classList.remove('guardado'), 500);
-        } else {
-            showToast('Error al guardar observacion', 'error');
-            input.classList.add('error');
-            setTimeout(() => input.classList.remove('error'), 500);
+        await encolarOperacion({ tipo: 'observacion', id, observaciones });
+        const prod = _obsProductos.find(p => p.id === id);
+        if (prod) {
+            prod.observaciones = observaciones;
         }
+        const clase = navigator.onLine ? 'guardado' : 'pendiente';
+        input.classList.add(clase);
+        setTimeout(() => input.classList.remove(clase), 500);
     } catch (error) {
         console.error('Error:', error);
-        showToast('Error de conexion', 'error');
+        showToast('Error al guardar observacion', 'error');
+        input.classList.add('error');
+        setTimeout(() => input.classList.remove('error'), 500);
     }
 }
 
@@ -2122,7 +2248,7 @@ async function cargarObservaciones() {
     obsContainer.innerHTML = `<div class="empty-state"><i class="fas fa-spinner fa-spin"></i><p>Cargando...</p></div>`;
 
     try {
-        const response = await fetch(`${CONFIG.API_URL}/api/inventario/consultar?fecha=${fecha}&local=${bodega}`);
+        const response = await fetch(`${CONFIG.API_URL}/api/conteo/sesion?fecha=${fecha}&local=${bodega}`);
         if (!response.ok) throw new Error('Error al consultar');
         const data = await response.json();
 
@@ -2144,15 +2270,8 @@ async function cargarObservaciones() {
             contado2_por_nombre: p.contado2_por_nombre || ''
         }));
 
-        // Cargar observaciones manuales
-        try {
-            const resManuales = await fetch(`${CONFIG.API_URL}/api/observaciones-manuales?fecha=${fecha}&local=${bodega}`);
-            if (resManuales.ok) {
-                _obsManuales = await resManuales.json();
-            } else {
-                _obsManuales = [];
-            }
-        } catch(e) { _obsManuales = []; }
+        // Observaciones manuales vienen en la misma sesion
+        _obsManuales = data.observaciones_manuales || [];
 
         renderObservaciones();
     } catch (error) {
@@ -3307,45 +3426,13 @@ async function guardarTodasAsignaciones() {
 
 // ==================== GUARDAR CONTEO POR ETAPA ====================
 
-// Guardar todos los inputs visibles (para celulares donde onchange no dispara bien)
+// Guardar todos los inputs visibles (para celulares donde onchange no dispara bien).
+// Pasa por la cola como cualquier conteo: un envio directo sin clave podria ser pisado
+// despues por un valor mas viejo que seguia en la cola.
 async function guardarTodosLosConteos() {
     const inputs = document.querySelectorAll('.input-contado');
-    const promesas = [];
-
     for (const input of inputs) {
-        const id = parseInt(input.dataset.id);
-        const conteoNum = parseInt(input.dataset.conteo) || 1;
-        const cantidad = input.value !== '' ? parseFloat(input.value) : null;
-
-        // Verificar si el valor cambio
-        const prod = state.productos.find(p => p.id === id);
-        if (prod) {
-            const valorActual = conteoNum === 2 ? prod.cantidad_contada_2 : prod.cantidad_contada;
-            if (valorActual !== cantidad) {
-                promesas.push(
-                    fetch(`${CONFIG.API_URL}/api/inventario/guardar-conteo`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ id, cantidad_contada: cantidad, conteo: conteoNum, usuario: state.user ? state.user.username : '' })
-                    }).then(response => {
-                        if (response.ok && prod) {
-                            if (conteoNum === 2) {
-                                prod.cantidad_contada_2 = cantidad;
-                            } else {
-                                prod.cantidad_contada = cantidad;
-                            }
-                        }
-                    }).catch(err => console.error('Error guardando:', err))
-                );
-            }
-        }
-    }
-
-    if (promesas.length > 0) {
-        await Promise.all(promesas).catch(err => {
-            console.error('Error guardando conteos:', err);
-            showToast('Error al guardar algunos conteos', 'error');
-        });
+        await guardarConteoDirecto(input);   // no encola si el valor no cambio
     }
 }
 
@@ -3353,6 +3440,11 @@ async function guardarConteoEtapa() {
     if (!_puede('conteo', 'editar')) { showToast('No tienes permiso para contar', 'error'); return; }
     // Primero guardar todos los inputs pendientes (importante para celulares)
     await guardarTodosLosConteos();
+    // El cambio de etapa y el autofill del servidor necesitan todos los conteos en la BD
+    if (!(await vaciarCola())) {
+        showToast('Hay conteos sin enviar al servidor. Revisa la conexion e intenta de nuevo', 'error');
+        return;
+    }
 
     if (state.etapaConteo === 1) {
         // Verificar que TODOS los productos tengan conteo
@@ -3391,25 +3483,7 @@ async function guardarConteoEtapa() {
             // Auto-llenar conteo 2 para productos que coinciden con el sistema
             const fecha = document.getElementById('fecha-conteo').value;
             const local = document.getElementById('bodega-select').value;
-            try {
-                const resp = await fetch(`${CONFIG.API_URL}/api/inventario/autofill-conteo2`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ fecha, local })
-                });
-                const result = await resp.json();
-                if (result.success && result.actualizados > 0) {
-                    // Actualizar estado local: copiar conteo1 a conteo2 donde coinciden
-                    state.productos.forEach(p => {
-                        if (p.cantidad_contada !== null && p.cantidad_contada === p.cantidad_sistema && p.cantidad_contada_2 === null) {
-                            p.cantidad_contada_2 = p.cantidad_contada;
-                        }
-                    });
-                    console.log(`Auto-fill conteo 2: ${result.actualizados} productos`);
-                }
-            } catch (e) {
-                console.error('Error en autofill conteo2:', e);
-            }
+            await autollenarConteo2(fecha, local);
             state.etapaConteo = 2;
             showToast(`⚠️ ${state.productosFallidos.length} productos tienen diferencias. Realiza el segundo conteo.`, 'warning');
         }
@@ -3655,27 +3729,22 @@ async function guardarCantidad() {
 
     if (id) {
         try {
-            const response = await fetch(`${CONFIG.API_URL}/api/inventario/guardar-conteo`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ id, cantidad_contada: cantidad, usuario: state.user ? state.user.username : '' })
+            // Por la cola, igual que los inputs de la tabla (orden y clave de idempotencia)
+            await encolarOperacion({
+                tipo: 'conteo', id, conteo: 1, cantidad_contada: cantidad,
+                usuario: state.user ? state.user.username : ''
             });
-
-            if (response.ok) {
-                const prod = state.productos.find(p => p.id === id);
-                if (prod) {
-                    prod.cantidad_contada = cantidad;
-                }
-                state.conteos[codigo] = cantidad;
-                renderProductosInventario();
-                cerrarModal();
-                showToast('Conteo guardado', 'success');
-            } else {
-                showToast('Error al guardar', 'error');
+            const prod = state.productos.find(p => p.id === id);
+            if (prod) {
+                prod.cantidad_contada = cantidad;
             }
+            state.conteos[codigo] = cantidad;
+            renderProductosInventario();
+            cerrarModal();
+            showToast('Conteo guardado', 'success');
         } catch (error) {
             console.error('Error guardando conteo:', error);
-            showToast('Error de conexion', 'error');
+            showToast('Error al guardar', 'error');
         }
     } else {
         state.conteos[codigo] = cantidad;
@@ -5250,8 +5319,10 @@ let _seccionesLocal = [];      // [{seccion_id, nombre, productos:[...], persona
 let _prodConDifCache = [];     // cache de productos con diferencia del conteo actual
 let _secPersonasLista = [];    // lista filtrada para onclick por índice
 
-// Las secciones son estado local temporal — se guardan en asignacion_diferencias al confirmar
-async function cargarSecciones(fecha, local) {
+// Las secciones son estado local temporal — se guardan en asignacion_diferencias al confirmar.
+// Las ya guardadas llegan en la sesion y solo se recuerdan (sus cantidades estan en state.asignaciones).
+function cargarSecciones(secciones) {
+    state.secciones = secciones || [];
     _seccionesLocal = [];
 }
 
@@ -5669,7 +5740,7 @@ function renderTablaCorreccion(productos) {
     }
 
     const rows = productos.map((p, i) => `
-        <tr id="corr-row-${p.id}" class="corr-tr${i % 2 === 1 ? ' corr-tr-alt' : ''}">
+        <tr id="corr-row-${p.id}" data-version="${corrValor(p.row_version)}" class="corr-tr${i % 2 === 1 ? ' corr-tr-alt' : ''}">
             <td class="corr-td-codigo"><span class="producto-codigo">${p.codigo}</span></td>
             <td class="corr-td-nombre">${p.nombre}</td>
             <td class="corr-td-num">
@@ -5730,6 +5801,17 @@ function renderTablaCorreccion(productos) {
     `;
 }
 
+// Si otro usuario cambio el conteo (409), se muestran los valores vigentes en la fila
+function corrAplicarConflicto(id, actual) {
+    const row = document.getElementById(`corr-row-${id}`);
+    if (!actual || !row) return;
+    row.dataset.version = actual.row_version;
+    document.getElementById(`corr-sis-${id}`).value = corrValor(actual.cantidad);
+    document.getElementById(`corr-c1-${id}`).value = corrValor(actual.cantidad_contada);
+    document.getElementById(`corr-c2-${id}`).value = corrValor(actual.cantidad_contada_2);
+    row.classList.remove('corr-tr-modified');
+}
+
 function corrMarcarCambio(id) {
     const row = document.getElementById(`corr-row-${id}`);
     if (row) row.classList.add('corr-tr-modified');
@@ -5755,10 +5837,18 @@ async function guardarCorreccionFila(id) {
         const res = await fetch('/api/admin/corregir-conteo', {
             method: 'PUT',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ id, cantidad: sis, cantidad_contada: c1, cantidad_contada_2: c2, usuario: state.user ? state.user.username : '' })
+            body: JSON.stringify({ id, cantidad: sis, cantidad_contada: c1, cantidad_contada_2: c2, usuario: state.user ? state.user.username : '',
+                                  row_version: row && row.dataset.version !== '' ? parseInt(row.dataset.version) : null })
         });
         const data = await res.json();
+        if (res.status === 409) {
+            corrAplicarConflicto(id, data.actual);
+            showToast('Otro usuario modifico este conteo; se cargaron los valores actuales', 'warning');
+            if (btn) { btn.innerHTML = '<i class="fas fa-save"></i>'; btn.disabled = false; }
+            return;
+        }
         if (data.success) {
+            if (row) { row.dataset.version = corrValor(data.row_version); }
             if (row) { row.classList.remove('corr-tr-modified'); row.classList.add('corr-tr-saved'); }
             if (btn) { btn.innerHTML = '<i class="fas fa-check"></i>'; btn.classList.remove('corr-btn-save-active'); }
             setTimeout(() => {
@@ -5780,7 +5870,7 @@ async function guardarTodasCorrecciones() {
     const btnTodos = document.querySelector('.corr-btn-guardar-todos');
     if (btnTodos) { btnTodos.disabled = true; btnTodos.innerHTML = '<i class="fas fa-spinner fa-spin"></i> Guardando...'; }
 
-    let ok = 0, errores = 0;
+    let ok = 0, errores = 0, conflictos = 0;
     for (const row of rows) {
         const id = parseInt(row.id.replace('corr-row-', ''));
         if (!id) continue;
@@ -5795,11 +5885,16 @@ async function guardarTodasCorrecciones() {
             const res = await fetch('/api/admin/corregir-conteo', {
                 method: 'PUT',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ id, cantidad: sis, cantidad_contada: c1, cantidad_contada_2: c2, usuario: state.user ? state.user.username : '' })
+                body: JSON.stringify({ id, cantidad: sis, cantidad_contada: c1, cantidad_contada_2: c2, usuario: state.user ? state.user.username : '',
+                                      row_version: row && row.dataset.version !== '' ? parseInt(row.dataset.version) : null })
             });
             const data = await res.json();
-            if (data.success) {
+            if (res.status === 409) {
+                conflictos++;
+                corrAplicarConflicto(id, data.actual);
+            } else if (data.success) {
                 ok++;
+                row.dataset.version = corrValor(data.row_version);
                 row.classList.remove('corr-tr-modified');
                 row.classList.add('corr-tr-saved');
                 setTimeout(() => row.classList.remove('corr-tr-saved'), 2000);
@@ -5808,7 +5903,9 @@ async function guardarTodasCorrecciones() {
     }
 
     if (btnTodos) { btnTodos.disabled = false; btnTodos.innerHTML = '<i class="fas fa-save"></i> Guardar Todos'; }
-    if (errores === 0) {
+    if (conflictos) {
+        showToast(`${ok} guardados, ${conflictos} modificados por otro usuario (se cargaron los valores actuales)`, 'warning');
+    } else if (errores === 0) {
         showToast(`✓ ${ok} productos guardados correctamente`, 'success');
     } else {
         showToast(`${ok} guardados, ${errores} con error`, 'error');